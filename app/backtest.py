@@ -0,0 +1,299 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Optional, Sequence
+
+import numpy as np
+from sqlalchemy import delete, func, update
+from sqlmodel import Session, select
+
+from app.db import get_engine
+from app.db_models import BacktestRun, BacktestStreamResult, PriorConfig, StreamConfig, utcnow
+from app.replay import ReplayResult, action_flags, replay_stream
+from app.storage import (
+    naive_timestamp,
+    prior_config_history,
+    stream_config_history,
+    stream_history_arrays,
+    stream_lot_offsets,
+)
+
+# A policy alarms on a row when:
+#   rules    - any enabled rule fires,
+#   bayesian - the risk score reaches risk_threshold_warn,
+#   hybrid   - the live disposition would stop the run: an action-severity rule fires ("reject") or the
+#              risk score reaches risk_threshold_hold ("hold-for-review").
+POLICIES = ("rules", "bayesian", "hybrid")
+CANDIDATE_FIELDS = ("rule_set", "warning_limit_sd", "action_limit_sd", "risk_threshold_warn", "risk_threshold_hold")
+COUNT_FIELDS = ("tp", "fp", "tn", "fn", "alerts", "episodes", "detected", "delay_total")
+
+
+def default_workers() -> int:
+    return int(os.getenv("BAYESIANQC_BACKTEST_WORKERS", str(os.cpu_count() or 1)))
+
+
+def candidate_configs(configs: Sequence[StreamConfig], candidate: dict) -> list[StreamConfig]:
+    update = {field: candidate[field] for field in CANDIDATE_FIELDS if candidate.get(field) is not None}
+    return [config.model_copy(update=update) for config in configs]
+
+
+def candidate_priors(stream_id: str, priors: Sequence[PriorConfig], candidate: dict) -> list[PriorConfig]:
+    if candidate.get("prior"):
+        return [PriorConfig(stream_id=stream_id, **candidate["prior"])]
+    return list(priors)
+
+
+def synthetic_series(stream_id: str, config: StreamConfig, scenario: dict) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # In-control noise around the config target with a step ("shift") or a linear ramp ("drift") of
+    # magnitude_sd SDs from `onset`. Seeded per stream, so a resumed run regenerates the same data.
+    rng = np.random.default_rng([scenario["seed"], zlib.crc32(stream_id.encode())])
+    count, onset = scenario["points"], scenario["onset"]
+    offset = np.zeros(count)
+    if scenario["kind"] == "drift":
+        offset[onset:] = scenario["magnitude_sd"] * np.arange(1, count - onset + 1) / (count - onset)
+    else:
+        offset[onset:] = scenario["magnitude_sd"]
+    values = config.target_value + config.sigma * (rng.standard_normal(count) + offset)
+    start = np.datetime64(naive_timestamp(config.effective_from), "us")
+    times = start + np.arange(count) * np.timedelta64(1, "h")
+    return times, values, np.arange(count) >= onset
+
+
+def policy_alarms(result: ReplayResult, configs: Sequence[StreamConfig]) -> dict[str, np.ndarray]:
+    fired = np.zeros(len(result.values), dtype=bool)
+    for flags in result.flags.values():
+        fired |= flags
+    warn = np.array([config.risk_threshold_warn for config in configs])[result.config_index]
+    hold = np.array([config.risk_threshold_hold for config in configs])[result.config_index]
+    return {
+        "rules": fired,
+        "bayesian": result.risk_score >= warn,
+        "hybrid": action_flags(result, configs) | (result.risk_score >= hold),
+    }
+
+
+def confusion_counts(alarm: np.ndarray, truth: np.ndarray) -> dict[str, int]:
+    # An episode is a maximal run of out-of-control rows. Its detection delay is the number of rows from
+    # its first row to the first alarm inside it, so 0 means it was caught immediately.
+    count = len(truth)
+    starts = np.flatnonzero(truth & ~np.concatenate([[False], truth[:-1]]))
+    ends = np.flatnonzero(truth & ~np.concatenate([truth[1:], [False]])) + 1
+    next_alarm = np.minimum.accumulate(np.where(alarm, np.arange(count), count)[::-1])[::-1]
+    first = next_alarm[starts]
+    detected = first < ends
+    return {
+        "tp": int(np.count_nonzero(alarm & truth)),
+        "fp": int(np.count_nonzero(alarm & ~truth)),
+        "tn": int(np.count_nonzero(~alarm & ~truth)),
+        "fn": int(np.count_nonzero(~alarm & truth)),
+        "alerts": int(np.count_nonzero(alarm)),
+        "episodes": int(starts.size),
+        "detected": int(np.count_nonzero(detected)),
+        "delay_total": int((first - starts)[detected].sum()),
+    }
+
+
+def with_rates(counts: dict, points: int) -> dict:
+    positives = counts["tp"] + counts["fn"]
+    negatives = counts["tn"] + counts["fp"]
+    return {
+        **counts,
+        "sensitivity": counts["tp"] / positives if positives else None,
+        "specificity": counts["tn"] / negatives if negatives else None,
+        "detection_delay": counts["delay_total"] / counts["detected"] if counts["detected"] else None,
+        "alerts_per_1000": 1000 * counts["alerts"] / points if points else None,
+    }
+
+
+def aggregate(metrics: Sequence[dict]) -> dict:
+    # Pooled over streams: counts are summed before the rates are taken.
+    points = sum(item["points"] for item in metrics)
+    policies = {}
+    for policy in POLICIES:
+        counts = {field: sum(item["policies"][policy][field] for item in metrics) for field in COUNT_FIELDS}
+        policies[policy] = with_rates(counts, points)
+    return {
+        "streams": len(metrics),
+        "points": points,
+        "positives": sum(item["positives"] for item in metrics),
+        "policies": policies,
+    }
+
+
+def backtest_stream(stream_id: str, candidate: dict, scenario: Optional[dict]) -> dict[str, Any]:
+    # Runs in a pool worker and loads its own stream, so database reads fan out along with the replay.
+    started = time.perf_counter()
+    try:
+        with Session(get_engine()) as session:
+            configs = stream_config_history(session, stream_id).versions
+            priors = prior_config_history(session, stream_id).versions
+            if not configs:
+                raise ValueError("Stream not configured")
+            offsets = None
+            if scenario is None:
+                times, values, included = stream_history_arrays(session, stream_id)
+                offsets = stream_lot_offsets(session, stream_id)
+        if scenario is None:
+            # Every point is scored as it arrived; the ones reviewers later excluded should have alarmed.
+            truth = ~included
+        else:
+            configs = configs[-1:]
+            times, values, truth = synthetic_series(stream_id, configs[0], scenario)
+        configs = candidate_configs(configs, candidate)
+        result = replay_stream(
+            values, times, configs, candidate_priors(stream_id, priors, candidate), lot_offsets=offsets
+        )
+        alarms = policy_alarms(result, configs)
+        metrics = {
+            "points": len(values),
+            "positives": int(np.count_nonzero(truth)),
+            "policies": {policy: with_rates(confusion_counts(alarms[policy], truth), len(values)) for policy in POLICIES},
+        }
+        status, error = "completed", None
+    except Exception as exc:  # noqa: BLE001 - a bad stream fails its own result, not the run
+        metrics, status, error = {}, "failed", str(exc)
+    return {
+        "stream_id": stream_id,
+        "status": status,
+        "metrics": metrics,
+        "error": error,
+        "elapsed_ms": (time.perf_counter() - started) * 1000,
+    }
+
+
+def _init_worker() -> None:
+    # Forked workers must not share the parent's pooled database connections.
+    get_engine().dispose(close=False)
+
+
+def configured_streams(session: Session) -> list[str]:
+    return list(session.exec(select(StreamConfig.stream_id).distinct().order_by(StreamConfig.stream_id)).all())
+
+
+def create_run(
+    session: Session,
+    name: str,
+    candidate: dict,
+    scenario: Optional[dict],
+    stream_ids: list[str],
+    created_by: str,
+) -> BacktestRun:
+    latest = session.exec(select(func.max(BacktestRun.version)).where(BacktestRun.name == name)).first()
+    run = BacktestRun(
+        name=name,
+        version=(latest or 0) + 1,
+        candidate=candidate,
+        scenario=scenario,
+        stream_ids=stream_ids,
+        created_by=created_by,
+    )
+    session.add(run)
+    session.commit()
+    session.refresh(run)
+    return run
+
+
+def run_results(session: Session, run_id: int) -> list[BacktestStreamResult]:
+    return session.exec(
+        select(BacktestStreamResult)
+        .where(BacktestStreamResult.run_id == run_id)
+        .order_by(BacktestStreamResult.stream_id.asc())
+    ).all()
+
+
+def _save_result(session: Session, run_id: int, outcome: dict) -> None:
+    # Committed one stream at a time so an interrupted run resumes from the streams still missing.
+    session.add(BacktestStreamResult(run_id=run_id, **outcome))
+    session.commit()
+
+
+def _claim(session: Session, run_id: int, statuses: Sequence[str], status: str) -> bool:
+    # One conditional UPDATE, so of two concurrent callers only one moves the run on.
+    result = session.exec(
+        update(BacktestRun).where(BacktestRun.id == run_id, BacktestRun.status.in_(statuses)).values(status=status)
+    )
+    session.commit()
+    return result.rowcount == 1
+
+
+def reopen_run(session: Session, run_id: int) -> bool:
+    # Puts a failed run back to pending for one resume; False for a run in any other state.
+    return _claim(session, run_id, ("failed",), "pending")
+
+
+def run_backtest(session: Session, run_id: int, workers: Optional[int] = None) -> BacktestRun:
+    run = session.get(BacktestRun, run_id)
+    if run is None:
+        raise ValueError(f"Backtest run {run_id} not found")
+    claimed = _claim(session, run_id, ("pending", "failed"), "running")
+    session.refresh(run)
+    if not claimed:
+        # Completed, or already being executed by another caller.
+        return run
+    # Failed streams are retried; completed ones are kept.
+    session.exec(
+        delete(BacktestStreamResult).where(
+            BacktestStreamResult.run_id == run_id, BacktestStreamResult.status != "completed"
+        )
+    )
+    done = {result.stream_id for result in run_results(session, run_id)}
+    pending = [stream_id for stream_id in run.stream_ids if stream_id not in done]
+    run.started_at = run.started_at or utcnow()
+    session.add(run)
+    session.commit()
+
+    workers = min(default_workers() if workers is None else workers, len(pending))
+    try:
+        if workers <= 1:
+            for stream_id in pending:
+                _save_result(session, run_id, backtest_stream(stream_id, run.candidate, run.scenario))
+        else:
+            # Streams are independent, so throughput scales with workers until the database reads saturate.
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+                futures = [
+                    pool.submit(backtest_stream, stream_id, run.candidate, run.scenario) for stream_id in pending
+                ]
+                for future in as_completed(futures):
+                    _save_result(session, run_id, future.result())
+    except BaseException:
+        # An interrupted run is left failed, so it can be resumed from the streams already saved.
+        session.rollback()
+        run.status = "failed"
+        session.add(run)
+        session.commit()
+        raise
+    return finalize_run(session, run)
+
+
+def artifact_digest(run: BacktestRun, results: Sequence[BacktestStreamResult]) -> str:
+    # Covers everything that defines the validation evidence and nothing run-specific like timings, so
+    # re-running the same candidate on the same data reproduces the digest.
+    artifact = {
+        "candidate": run.candidate,
+        "scenario": run.scenario,
+        "stream_ids": run.stream_ids,
+        "results": [{"stream_id": result.stream_id, "metrics": result.metrics} for result in results],
+        "summary": run.summary,
+    }
+    return hashlib.sha256(json.dumps(artifact, sort_keys=True).encode()).hexdigest()
+
+
+def finalize_run(session: Session, run: BacktestRun) -> BacktestRun:
+    results = run_results(session, run.id)
+    completed = [result for result in results if result.status == "completed"]
+    run.summary = aggregate([result.metrics for result in completed])
+    run.completed_at = utcnow()
+    if len(completed) == len(run.stream_ids):
+        run.status = "completed"
+        run.artifact_digest = artifact_digest(run, completed)
+    else:
+        run.status = "failed"
+    session.add(run)
+    session.commit()
+    session.refresh(run)
+    return run
@@ -1,19 +1,27 @@
 from __future__ import annotations
 
 import math
-from typing import Optional
+from datetime import datetime
+from typing import Optional, Sequence
 
+import numpy as np
+from sqlalchemy import func, insert
 from sqlmodel import Session, select
 
-from app.db_models import PosteriorState, QCRecord, StreamConfig
+from app import drift, risk, robust
+from app.cache import VersionHistory
+from app.db_models import PosteriorCheckpoint, PosteriorHistory, PosteriorState, QCRecord, StreamConfig
 from app.models import BayesianRisk
-from app.storage import get_active_prior
-
-
-def _normal_cdf(x: float, mean: float, std: float) -> float:
-    if std <= 0:
-        return 0.5
-    return 0.5 * (1 + math.erf((x - mean) / (std * math.sqrt(2))))
+from app.storage import (
+    CHECKPOINT_INTERVAL,
+    LOT_ADJUSTED_VALUE,
+    get_active_prior,
+    naive_timestamp,
+    prior_config_history,
+    records_after,
+    restart_checkpoint,
+    stream_config_history,
+)
 
 
 def _update_posterior(
@@ -30,93 +38,367 @@ def _update_posterior(
     return mu_n, kappa_n, alpha_n, beta_n
 
 
-def rebuild_posterior_state(session: Session, stream_id: str) -> Optional[PosteriorState]:
-    records = session.exec(
-        select(QCRecord)
-        .where(QCRecord.stream_id == stream_id, QCRecord.include_in_stats == True)
-        .order_by(QCRecord.timestamp.asc())
+def _update_posterior_array(
+    mu0: float,
+    kappa0: float,
+    alpha0: float,
+    beta0: float,
+    values: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # Posterior after each prefix of `values`, equivalent to folding _update_posterior over them in order.
+    steps = np.arange(1, len(values) + 1, dtype=float)
+    kappa_n = kappa0 + steps
+    mu_n = (kappa0 * mu0 + np.cumsum(values)) / kappa_n
+    kappa_prev = kappa_n - 1
+    mu_prev = np.concatenate([[mu0], mu_n[:-1]])
+    alpha_n = alpha0 + 0.5 * steps
+    beta_n = beta0 + np.cumsum(0.5 * kappa_prev * (values - mu_prev) ** 2 / kappa_n)
+    return mu_n, kappa_n, alpha_n, beta_n
+
+
+def _fold_posterior(
+    start: Sequence[float],
+    values: np.ndarray,
+    params: Optional[Sequence[Optional[tuple[float, float]]]] = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # The posterior after each value plus its outlier probability (NaN for conjugate steps). `params` holds
+    # each row's robust parameters; without any, the vectorized conjugate fold is used.
+    if params is None or all(row_params is None for row_params in params):
+        return (*_update_posterior_array(*start, values), np.full(len(values), np.nan))
+    return robust.robust_fold(start, values, params)
+
+
+def _robust_rows(session: Session, stream_id: str, timestamps: Sequence[datetime]):
+    # Robust parameters of the config active at each timestamp, or None when no version is robust.
+    configs = stream_config_history(session, stream_id)
+    if not any(robust.robust_params(config) for config in configs):
+        return None
+    return [robust.robust_params(configs.active_at(timestamp)) for timestamp in timestamps]
+
+
+def _posterior_from_stats(
+    mu0: float,
+    kappa0: float,
+    alpha0: float,
+    beta0: float,
+    n: int,
+    mean: float,
+    sum_sq_dev: float,
+) -> tuple[float, float, float, float]:
+    # Closed-form Normal-Inverse-Gamma update from (n, mean, sum of squared deviations);
+    # identical to folding _update_posterior over the same values in any order.
+    if n <= 0:
+        return mu0, kappa0, alpha0, beta0
+    kappa_n = kappa0 + n
+    mu_n = (kappa0 * mu0 + n * mean) / kappa_n
+    alpha_n = alpha0 + 0.5 * n
+    beta_n = beta0 + 0.5 * sum_sq_dev + 0.5 * kappa0 * n * (mean - mu0) ** 2 / kappa_n
+    return mu_n, kappa_n, alpha_n, beta_n
+
+
+def _aggregate_posterior(
+    session: Session, stream_id: str, priors: VersionHistory, before: Optional[datetime] = None
+) -> tuple[Optional[tuple[float, float, float, float]], int, Optional[datetime]]:
+    # One aggregate over the included values (before `before`), shifted by a prior mean to keep the sums
+    # well conditioned. Returns the posterior with the record count and the last timestamp.
+    shift = priors.versions[-1].mu0
+    deviation = LOT_ADJUSTED_VALUE - shift
+    query = select(
+        func.count(QCRecord.id),
+        func.min(QCRecord.timestamp),
+        func.max(QCRecord.timestamp),
+        func.sum(deviation),
+        func.sum(deviation * deviation),
+    ).where(QCRecord.stream_id == stream_id, QCRecord.include_in_stats == True)
+    if before is not None:
+        query = query.where(QCRecord.timestamp < naive_timestamp(before))
+    count, first_timestamp, last_timestamp, total, total_sq = session.exec(query).one()
+    if not count:
+        return None, 0, None
+    prior = priors.active_at(first_timestamp)
+    mean_offset = total / count
+    sum_sq_dev = max(total_sq - count * mean_offset**2, 0.0)
+    posterior = _posterior_from_stats(
+        prior.mu0, prior.kappa0, prior.alpha0, prior.beta0, count, shift + mean_offset, sum_sq_dev
+    )
+    return posterior, count, last_timestamp
+
+
+def posterior_before(
+    session: Session, stream_id: str, before: datetime, priors: VersionHistory
+) -> Optional[tuple[float, float, float, float]]:
+    # The posterior after the included records before `before` under these prior versions, or None when
+    # there are none. Aggregated in closed form unless a config version is robust, whose weights depend
+    # on the order of the points.
+    if not priors:
+        return None
+    if not any(robust.robust_params(config) for config in stream_config_history(session, stream_id)):
+        posterior, _, _ = _aggregate_posterior(session, stream_id, priors, before)
+        return posterior
+    rows = session.exec(
+        select(QCRecord.timestamp, LOT_ADJUSTED_VALUE)
+        .where(
+            QCRecord.stream_id == stream_id,
+            QCRecord.include_in_stats == True,
+            QCRecord.timestamp < naive_timestamp(before),
+        )
+        .order_by(QCRecord.timestamp.asc(), QCRecord.id.asc())
     ).all()
+    if not rows:
+        return None
+    prior = priors.active_at(rows[0][0])
+    timestamps = [row[0] for row in rows]
+    folded = _fold_posterior(
+        (prior.mu0, prior.kappa0, prior.alpha0, prior.beta0),
+        np.array([row[1] for row in rows], dtype=float),
+        _robust_rows(session, stream_id, timestamps),
+    )
+    return tuple(float(column[-1]) for column in folded[:4])
+
+
+def rebuild_posterior_state(session: Session, stream_id: str) -> Optional[PosteriorState]:
     state = session.exec(select(PosteriorState).where(PosteriorState.stream_id == stream_id)).first()
-    if not records:
+    priors = prior_config_history(session, stream_id)
+    if not priors:
         if state:
             session.delete(state)
             session.commit()
         return None
+    if any(robust.robust_params(config) for config in stream_config_history(session, stream_id)):
+        # Robust weights depend on the order of the points, so there is no aggregate form; refold instead.
+        state, _, _ = _replay_posterior(session, stream_id, datetime.min)
+        session.commit()
+        return state
 
-    prior = get_active_prior(session, stream_id, records[0].timestamp)
-    if prior is None:
+    posterior, count, last_timestamp = _aggregate_posterior(session, stream_id, priors)
+    if not count:
         if state:
             session.delete(state)
             session.commit()
         return None
-
-    mu_n, kappa_n, alpha_n, beta_n = prior.mu0, prior.kappa0, prior.alpha0, prior.beta0
-    for record in records:
-        mu_n, kappa_n, alpha_n, beta_n = _update_posterior(
-            mu_n, kappa_n, alpha_n, beta_n, record.result_value
-        )
+    mu_n, kappa_n, alpha_n, beta_n = posterior
 
     if state:
         state.mu_n = mu_n
         state.kappa_n = kappa_n
         state.alpha_n = alpha_n
         state.beta_n = beta_n
-        state.n_obs = len(records)
-        state.updated_at = records[-1].timestamp
-        session.add(state)
+        state.n_obs = count
+        state.updated_at = last_timestamp
     else:
-        session.add(
-            PosteriorState(
-                stream_id=stream_id,
-                mu_n=mu_n,
-                kappa_n=kappa_n,
-                alpha_n=alpha_n,
-                beta_n=beta_n,
-                n_obs=len(records),
-                updated_at=records[-1].timestamp,
-            )
+        state = PosteriorState(
+            stream_id=stream_id,
+            mu_n=mu_n,
+            kappa_n=kappa_n,
+            alpha_n=alpha_n,
+            beta_n=beta_n,
+            n_obs=count,
+            updated_at=last_timestamp,
         )
+    session.add(state)
     session.commit()
     return state
 
 
-def infer_risk(
+def _replay_posterior(
+    session: Session,
+    stream_id: str,
+    since: datetime,
+    record_id: Optional[int] = None,
+) -> tuple[Optional[PosteriorState], list[int], tuple[np.ndarray, ...]]:
+    # Refold the included records after the nearest checkpoint strictly before (since, record_id),
+    # rewriting the later checkpoints and the stream's PosteriorState. Returns the replayed record ids
+    # with the posterior and outlier probability after each of them.
+    checkpoint = restart_checkpoint(session, PosteriorCheckpoint, stream_id, since, record_id)
+    query = (
+        select(QCRecord.id, QCRecord.timestamp, LOT_ADJUSTED_VALUE)
+        .where(QCRecord.stream_id == stream_id, QCRecord.include_in_stats == True)
+        .order_by(QCRecord.timestamp.asc(), QCRecord.id.asc())
+    )
+    rows = session.exec(records_after(query, checkpoint)).all()
+    state = session.exec(select(PosteriorState).where(PosteriorState.stream_id == stream_id)).first()
+
+    start = None
+    n_start = 0
+    updated_at = None
+    if checkpoint:
+        start = (checkpoint.mu_n, checkpoint.kappa_n, checkpoint.alpha_n, checkpoint.beta_n)
+        n_start = checkpoint.n_obs
+        updated_at = checkpoint.checkpoint_at
+    elif rows:
+        prior = get_active_prior(session, stream_id, rows[0][1])
+        if prior is not None:
+            start = (prior.mu0, prior.kappa0, prior.alpha0, prior.beta0)
+    empty = np.empty(0)
+    if start is None:
+        if state:
+            session.delete(state)
+        return None, [], (empty, empty, empty, empty, empty)
+
+    record_ids = [row[0] for row in rows]
+    values = np.array([row[2] for row in rows], dtype=float)
+    posterior = _fold_posterior(start, values, _robust_rows(session, stream_id, [row[1] for row in rows]))
+    mu_n, kappa_n, alpha_n, beta_n, _ = posterior
+    for i, (qc_record_id, timestamp, _) in enumerate(rows):
+        if (n_start + i + 1) % CHECKPOINT_INTERVAL == 0:
+            session.add(
+                PosteriorCheckpoint(
+                    stream_id=stream_id,
+                    checkpoint_at=timestamp,
+                    qc_record_id=qc_record_id,
+                    n_obs=n_start + i + 1,
+                    mu_n=float(mu_n[i]),
+                    kappa_n=float(kappa_n[i]),
+                    alpha_n=float(alpha_n[i]),
+                    beta_n=float(beta_n[i]),
+                )
+            )
+    final = (float(mu_n[-1]), float(kappa_n[-1]), float(alpha_n[-1]), float(beta_n[-1])) if rows else start
+    if rows:
+        updated_at = rows[-1][1]
+
+    if not state:
+        state = PosteriorState(stream_id=stream_id, mu_n=final[0], kappa_n=final[1], alpha_n=final[2], beta_n=final[3])
+    state.mu_n, state.kappa_n, state.alpha_n, state.beta_n = final
+    state.n_obs = n_start + len(rows)
+    state.updated_at = updated_at
+    session.add(state)
+    return state, record_ids, posterior
+
+
+def replay_posterior_state(
+    session: Session,
+    stream_id: str,
+    since: datetime,
+    record_id: Optional[int] = None,
+    commit: bool = True,
+) -> Optional[PosteriorState]:
+    state, _, _ = _replay_posterior(session, stream_id, since, record_id)
+    if commit:
+        session.commit()
+    return state
+
+
+def _is_late(state: Optional[PosteriorState], timestamp: datetime) -> bool:
+    return state is not None and naive_timestamp(timestamp) < naive_timestamp(state.updated_at)
+
+
+def _checkpoint(
+    stream_id: str,
+    record_id: int,
+    timestamp: datetime,
+    n_obs: int,
+    mu_n: float,
+    kappa_n: float,
+    alpha_n: float,
+    beta_n: float,
+) -> PosteriorCheckpoint:
+    return PosteriorCheckpoint(
+        stream_id=stream_id,
+        checkpoint_at=naive_timestamp(timestamp),
+        qc_record_id=record_id,
+        n_obs=n_obs,
+        mu_n=mu_n,
+        kappa_n=kappa_n,
+        alpha_n=alpha_n,
+        beta_n=beta_n,
+    )
+
+
+def _history(
+    stream_id: str,
+    record_id: int,
+    timestamp: datetime,
+    posterior: Sequence[float],
+    scored: BayesianRisk,
+) -> dict:
+    mu_n, kappa_n, alpha_n, beta_n = (float(value) for value in posterior[:4])
+    return {
+        "qc_record_id": record_id,
+        "stream_id": stream_id,
+        "timestamp": naive_timestamp(timestamp),
+        "mu_n": mu_n,
+        "kappa_n": kappa_n,
+        "alpha_n": alpha_n,
+        "beta_n": beta_n,
+        "probability_outside_limits": scored.probability_outside_limits,
+        "probability_bias_exceeded": scored.probability_bias_exceeded,
+        "risk_score": scored.risk_score,
+        "probability_outlier": scored.probability_outlier,
+    }
+
+
+def _risk_from_posterior(
+    mu_n: float,
+    kappa_n: float,
+    alpha_n: float,
+    beta_n: float,
+    config: StreamConfig,
+    probability_outlier: float = math.nan,
+) -> BayesianRisk:
+    posterior_sigma = math.sqrt(beta_n / (alpha_n - 1)) if alpha_n > 1 else None
+    predictive_sigma = math.sqrt(beta_n * (kappa_n + 1) / (alpha_n * kappa_n)) if alpha_n > 0 else None
+    probability_outside_limits, probability_bias_exceeded = risk.exceedance_probability(
+        mu_n,
+        kappa_n,
+        alpha_n,
+        beta_n,
+        config.target_value,
+        config.action_limit_sd * config.sigma,
+        risk.bias_threshold(config),
+    )
+    credible_interval = None
+    if posterior_sigma and kappa_n > 0:
+        stderr = posterior_sigma / math.sqrt(kappa_n)
+        credible_interval = (mu_n - 1.96 * stderr, mu_n + 1.96 * stderr)
+
+    return BayesianRisk(
+        probability_outside_limits=probability_outside_limits,
+        risk_score=risk.risk_score(probability_outside_limits),
+        posterior_mean=mu_n,
+        posterior_sigma=posterior_sigma,
+        predictive_sigma=predictive_sigma,
+        credible_interval=credible_interval,
+        probability_bias_exceeded=probability_bias_exceeded,
+        probability_outlier=probability_outlier if math.isfinite(probability_outlier) else None,
+    )
+
+
+def _posterior_risk(
     session: Session,
     record_value: float,
     record_timestamp,
     stream_id: str,
     config: StreamConfig,
+    record_id: Optional[int] = None,
 ) -> BayesianRisk:
     prior = get_active_prior(session, stream_id, record_timestamp)
     if prior is None:
         return BayesianRisk(probability_outside_limits=0.0, risk_score=0)
 
     state = session.exec(select(PosteriorState).where(PosteriorState.stream_id == stream_id)).first()
+    if record_id is not None and _is_late(state, record_timestamp):
+        # An older point: score it against the posterior as of its own timestamp and refold what follows.
+        _, record_ids, posterior = _replay_posterior(session, stream_id, record_timestamp, record_id)
+        i = record_ids.index(record_id)
+        scored_posterior = [float(array[i]) for array in posterior]
+        scored = _risk_from_posterior(*scored_posterior[:4], config, scored_posterior[4])
+        session.add(PosteriorHistory(**_history(stream_id, record_id, record_timestamp, scored_posterior, scored)))
+        return scored
+
     if state:
         mu0, kappa0, alpha0, beta0 = state.mu_n, state.kappa_n, state.alpha_n, state.beta_n
     else:
         mu0, kappa0, alpha0, beta0 = prior.mu0, prior.kappa0, prior.alpha0, prior.beta0
 
-    mu_n, kappa_n, alpha_n, beta_n = _update_posterior(
-        mu0, kappa0, alpha0, beta0, record_value
-    )
-
-    posterior_sigma = math.sqrt(beta_n / (alpha_n - 1)) if alpha_n > 1 else None
-    predictive_sigma = math.sqrt(beta_n * (kappa_n + 1) / (alpha_n * kappa_n)) if alpha_n > 0 else None
-
-    if predictive_sigma and predictive_sigma > 0:
-        lower = config.target_value - config.action_limit_sd * config.sigma
-        upper = config.target_value + config.action_limit_sd * config.sigma
-        prob_inside = _normal_cdf(upper, mu_n, predictive_sigma) - _normal_cdf(lower, mu_n, predictive_sigma)
-        probability_outside_limits = max(0.0, min(1.0, 1 - prob_inside))
+    params = robust.robust_params(config)
+    if params is None:
+        mu_n, kappa_n, alpha_n, beta_n = _update_posterior(mu0, kappa0, alpha0, beta0, record_value)
+        probability_outlier = math.nan
     else:
-        probability_outside_limits = 0.0
-
-    risk_score = int(min(100, max(0, round(probability_outside_limits * 100))))
-    credible_interval = None
-    if posterior_sigma and kappa_n > 0:
-        stderr = posterior_sigma / math.sqrt(kappa_n)
-        credible_interval = (mu_n - 1.96 * stderr, mu_n + 1.96 * stderr)
+        mu_n, kappa_n, alpha_n, beta_n, probability_outlier = robust.robust_step(
+            mu0, kappa0, alpha0, beta0, record_value, *params
+        )
 
     if state:
         state.mu_n = mu_n
@@ -125,26 +407,193 @@ def infer_risk(
         state.beta_n = beta_n
         state.n_obs += 1
         state.updated_at = record_timestamp
+    else:
+        state = PosteriorState(
+            stream_id=stream_id,
+            mu_n=mu_n,
+            kappa_n=kappa_n,
+            alpha_n=alpha_n,
+            beta_n=beta_n,
+            n_obs=1,
+            updated_at=record_timestamp,
+        )
+    session.add(state)
+    if record_id is not None and state.n_obs % CHECKPOINT_INTERVAL == 0:
+        session.add(_checkpoint(stream_id, record_id, record_timestamp, state.n_obs, mu_n, kappa_n, alpha_n, beta_n))
+
+    scored = _risk_from_posterior(mu_n, kappa_n, alpha_n, beta_n, config, probability_outlier)
+    if record_id is not None:
+        posterior = (mu_n, kappa_n, alpha_n, beta_n)
+        session.add(PosteriorHistory(**_history(stream_id, record_id, record_timestamp, posterior, scored)))
+    return scored
+
+
+def _predictive_sigma_array(kappa_n: np.ndarray, alpha_n: np.ndarray, beta_n: np.ndarray) -> np.ndarray:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(alpha_n > 0, np.sqrt(beta_n * (kappa_n + 1) / (alpha_n * kappa_n)), np.nan)
+
+
+def _risks_from_posterior_arrays(
+    mu_n: np.ndarray,
+    kappa_n: np.ndarray,
+    alpha_n: np.ndarray,
+    beta_n: np.ndarray,
+    probability_outlier: np.ndarray,
+    configs: Sequence[StreamConfig],
+) -> list[BayesianRisk]:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        posterior_sigma = np.where(alpha_n > 1, np.sqrt(beta_n / (alpha_n - 1)), np.nan)
+    predictive_sigma = _predictive_sigma_array(kappa_n, alpha_n, beta_n)
+
+    targets = np.array([config.target_value for config in configs], dtype=float)
+    spreads = np.array([config.action_limit_sd * config.sigma for config in configs], dtype=float)
+    biases = np.array([risk.bias_threshold(config) for config in configs], dtype=float)
+    probability_outside_limits, probability_bias_exceeded = risk.exceedance_probabilities(
+        mu_n, kappa_n, alpha_n, beta_n, targets, spreads, biases
+    )
+    risk_scores = risk.risk_scores(probability_outside_limits)
+    stderr = posterior_sigma / np.sqrt(kappa_n)
+
+    risks = []
+    for i in range(len(mu_n)):
+        sigma_i = float(posterior_sigma[i]) if np.isfinite(posterior_sigma[i]) else None
+        predictive_i = float(predictive_sigma[i]) if np.isfinite(predictive_sigma[i]) else None
+        credible_interval = None
+        if sigma_i and kappa_n[i] > 0:
+            credible_interval = (float(mu_n[i] - 1.96 * stderr[i]), float(mu_n[i] + 1.96 * stderr[i]))
+        risks.append(
+            BayesianRisk(
+                probability_outside_limits=float(probability_outside_limits[i]),
+                risk_score=int(risk_scores[i]),
+                posterior_mean=float(mu_n[i]),
+                posterior_sigma=sigma_i,
+                predictive_sigma=predictive_i,
+                credible_interval=credible_interval,
+                probability_bias_exceeded=float(probability_bias_exceeded[i]),
+                probability_outlier=float(probability_outlier[i]) if np.isfinite(probability_outlier[i]) else None,
+            )
+        )
+    return risks
+
+
+def _write_history(
+    session: Session,
+    stream_id: str,
+    record_ids: Sequence[int],
+    timestamps: Sequence[datetime],
+    posterior: Sequence[np.ndarray],
+    risks: Sequence[BayesianRisk],
+) -> None:
+    # One executemany in the ingest transaction instead of an ORM object per record.
+    rows = [
+        _history(stream_id, record_id, timestamps[i], [array[i] for array in posterior], risks[i])
+        for i, record_id in enumerate(record_ids)
+    ]
+    session.exec(insert(PosteriorHistory), params=rows)
+
+
+def _posterior_risks(
+    session: Session,
+    values: np.ndarray,
+    timestamps: Sequence[datetime],
+    stream_id: str,
+    configs: Sequence[StreamConfig],
+    record_ids: Optional[Sequence[int]] = None,
+) -> list[BayesianRisk]:
+    # _posterior_risk over one stream's time-sorted batch, vectorized for conjugate configs; the posterior
+    # state is written once.
+    prior = get_active_prior(session, stream_id, timestamps[0])
+    if prior is None:
+        return [BayesianRisk(probability_outside_limits=0.0, risk_score=0) for _ in range(len(values))]
+
+    state = session.exec(select(PosteriorState).where(PosteriorState.stream_id == stream_id)).first()
+    if record_ids is not None and _is_late(state, timestamps[0]):
+        _, replayed_ids, posterior = _replay_posterior(session, stream_id, timestamps[0], record_ids[0])
+        positions = {qc_record_id: i for i, qc_record_id in enumerate(replayed_ids)}
+        picked = np.array([positions[qc_record_id] for qc_record_id in record_ids])
+        posterior = [array[picked] for array in posterior]
+        risks = _risks_from_posterior_arrays(*posterior, configs)
+        _write_history(session, stream_id, record_ids, timestamps, posterior, risks)
+        return risks
+
+    if state:
+        mu0, kappa0, alpha0, beta0 = state.mu_n, state.kappa_n, state.alpha_n, state.beta_n
+        n_start = state.n_obs
+    else:
+        mu0, kappa0, alpha0, beta0 = prior.mu0, prior.kappa0, prior.alpha0, prior.beta0
+        n_start = 0
+
+    params = [robust.robust_params(config) for config in configs]
+    posterior = _fold_posterior((mu0, kappa0, alpha0, beta0), values, params)
+    mu_n, kappa_n, alpha_n, beta_n, _ = posterior
+    risks = _risks_from_posterior_arrays(*posterior, configs)
+
+    if state:
+        state.mu_n = float(mu_n[-1])
+        state.kappa_n = float(kappa_n[-1])
+        state.alpha_n = float(alpha_n[-1])
+        state.beta_n = float(beta_n[-1])
+        state.n_obs += len(values)
+        state.updated_at = timestamps[-1]
         session.add(state)
     else:
         session.add(
             PosteriorState(
                 stream_id=stream_id,
-                mu_n=mu_n,
-                kappa_n=kappa_n,
-                alpha_n=alpha_n,
-                beta_n=beta_n,
-                n_obs=1,
-                updated_at=record_timestamp,
+                mu_n=float(mu_n[-1]),
+                kappa_n=float(kappa_n[-1]),
+                alpha_n=float(alpha_n[-1]),
+                beta_n=float(beta_n[-1]),
+                n_obs=len(values),
+                updated_at=timestamps[-1],
             )
         )
-    session.commit()
+    if record_ids is not None:
+        for i, qc_record_id in enumerate(record_ids):
+            n_obs = n_start + i + 1
+            if n_obs % CHECKPOINT_INTERVAL == 0:
+                session.add(
+                    _checkpoint(
+                        stream_id,
+                        qc_record_id,
+                        timestamps[i],
+                        n_obs,
+                        float(mu_n[i]),
+                        float(kappa_n[i]),
+                        float(alpha_n[i]),
+                        float(beta_n[i]),
+                    )
+                )
+        _write_history(session, stream_id, record_ids, timestamps, posterior, risks)
+    return risks
 
-    return BayesianRisk(
-        probability_outside_limits=probability_outside_limits,
-        risk_score=risk_score,
-        posterior_mean=mu_n,
-        posterior_sigma=posterior_sigma,
-        predictive_sigma=predictive_sigma,
-        credible_interval=credible_interval,
-    )
+
+def infer_risk(
+    session: Session,
+    record_value: float,
+    record_timestamp,
+    stream_id: str,
+    config: StreamConfig,
+    record_id: Optional[int] = None,
+) -> BayesianRisk:
+    # The drift model, when configured, is filtered next to the NIG posterior and adds its fields.
+    scored = _posterior_risk(session, record_value, record_timestamp, stream_id, config, record_id)
+    if config.drift_model is None:
+        return scored
+    fields = drift.update_drift(session, stream_id, record_value, record_timestamp, config, record_id)
+    return scored.model_copy(update=fields)
+
+
+def infer_risk_batch(
+    session: Session,
+    values: np.ndarray,
+    timestamps: Sequence[datetime],
+    stream_id: str,
+    configs: Sequence[StreamConfig],
+    record_ids: Optional[Sequence[int]] = None,
+) -> list[BayesianRisk]:
+    risks = _posterior_risks(session, values, timestamps, stream_id, configs, record_ids)
+    if all(config.drift_model is None for config in configs):
+        return risks
+    fields = drift.update_drift_batch(session, stream_id, values, timestamps, configs, record_ids)
+    return [scored.model_copy(update=update) if update else scored for scored, update in zip(risks, fields)]
@@ -0,0 +1,468 @@
+from __future__ import annotations
+
+import math
+import os
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Any, Callable, NamedTuple, Optional, Sequence
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class WindowPoint(NamedTuple):
+    timestamp: datetime
+    value: float
+    include_in_stats: bool
+
+
+class _Window:
+    __slots__ = ("points", "complete")
+
+    def __init__(self, capacity: int, points: Sequence[WindowPoint], complete: bool):
+        self.points: deque[WindowPoint] = deque(points, maxlen=capacity)
+        # True while the buffer still holds the stream's entire included history.
+        self.complete = complete
+
+
+class RollingWindowCache:
+    # Per-stream ring buffers of the most recent included QC points, in timestamp order.
+    # Timestamps are naive, matching what SQLite hands back.
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._windows: dict[str, _Window] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def recent(self, stream_id: str, before: datetime, limit: int) -> Optional[list[WindowPoint]]:
+        with self._lock:
+            window = self._windows.get(stream_id)
+            if window is None or limit > self.capacity or (window.points and before <= window.points[-1].timestamp):
+                self.misses += 1
+                return None
+            points = [point for point in window.points if point.include_in_stats]
+            if len(points) < limit and not window.complete:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return points[-limit:] if limit else []
+
+    def load(self, stream_id: str, points: Sequence[WindowPoint]) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._windows[stream_id] = _Window(self.capacity, points, complete=len(points) < self.capacity)
+
+    def append(self, stream_id: str, point: WindowPoint) -> bool:
+        # Returns False when the stream is not cached and the caller should load it.
+        if not self.enabled:
+            return True
+        with self._lock:
+            window = self._windows.get(stream_id)
+            if window is None:
+                return False
+            if window.points and point.timestamp < window.points[-1].timestamp:
+                # A late point lands inside the window; reload on the next access.
+                del self._windows[stream_id]
+                self.invalidations += 1
+                return True
+            if len(window.points) == self.capacity:
+                self.evictions += 1
+                window.complete = False
+            window.points.append(point)
+            return True
+
+    def invalidate(self, stream_id: Optional[str] = None) -> None:
+        with self._lock:
+            if stream_id is None:
+                self.invalidations += len(self._windows)
+                self._windows.clear()
+            elif self._windows.pop(stream_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._windows.clear()
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "streams": len(self._windows),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+class VersionHistory:
+    # Effective-dated versions of one stream's config (or prior), sorted by (effective_from, version).
+
+    def __init__(self, versions: Sequence[Any]):
+        self.versions = list(versions)
+        self._effective = [version.effective_from.replace(tzinfo=None) for version in self.versions]
+
+    def __bool__(self) -> bool:
+        return bool(self.versions)
+
+    def __iter__(self):
+        return iter(self.versions)
+
+    def __len__(self) -> int:
+        return len(self.versions)
+
+    def active_at(self, at_time: datetime) -> Optional[Any]:
+        # Latest version effective at `at_time`; before the first version takes effect, the first one.
+        if not self.versions:
+            return None
+        index = bisect_right(self._effective, at_time.replace(tzinfo=None))
+        return self.versions[index - 1] if index else self.versions[0]
+
+
+class VersionHistoryCache:
+    # LRU-bounded map of stream_id -> VersionHistory, invalidated when a new version is created.
+
+    def __init__(self, max_streams: int):
+        self.max_streams = max_streams
+        self._histories: OrderedDict[str, VersionHistory] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_load(self, stream_id: str, loader: Callable[[], Sequence[Any]]) -> VersionHistory:
+        with self._lock:
+            history = self._histories.get(stream_id)
+            if history is not None:
+                self._histories.move_to_end(stream_id)
+                self.hits += 1
+                return history
+            self.misses += 1
+        history = VersionHistory(loader())
+        if self.max_streams <= 0:
+            return history
+        with self._lock:
+            self._histories[stream_id] = history
+            self._histories.move_to_end(stream_id)
+            while len(self._histories) > self.max_streams:
+                self._histories.popitem(last=False)
+                self.evictions += 1
+        return history
+
+    def invalidate(self, stream_id: Optional[str] = None) -> None:
+        with self._lock:
+            if stream_id is None:
+                self._histories.clear()
+            else:
+                self._histories.pop(stream_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._histories.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "streams": len(self._histories),
+                "max_streams": self.max_streams,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+class TTLCache:
+    # Small thread-safe key -> value map whose entries expire `ttl_seconds` after they were stored.
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._entries: dict[str, tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: Any) -> None:
+        if self.ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+
+    def invalidate(self, key: Optional[str] = None) -> None:
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class RollingBaseline:
+    # Welford mean/variance over a sliding run of included points; the oldest point is evicted first.
+
+    def __init__(self, points: Sequence[tuple[datetime, float]] = (), sketch: Optional[Any] = None):
+        self.points: deque[tuple[datetime, float]] = deque()
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        # Optional quantile sketch kept in step with the points, for the robust baseline methods.
+        self.sketch = sketch
+        for timestamp, value in points:
+            self.add(timestamp, value)
+
+    @property
+    def last_timestamp(self) -> Optional[datetime]:
+        return self.points[-1][0] if self.points else None
+
+    @property
+    def sd(self) -> float:
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n >= 2 else 0.0
+
+    def add(self, timestamp: datetime, value: float) -> None:
+        self.points.append((timestamp, value))
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+        if self.sketch is not None:
+            self.sketch.add(value)
+
+    def evict_oldest(self) -> None:
+        _, value = self.points.popleft()
+        if self.sketch is not None:
+            self.sketch.remove(value)
+        self.n -= 1
+        if not self.n:
+            self.mean = self.m2 = 0.0
+            return
+        delta = value - self.mean
+        self.mean -= delta / self.n
+        self.m2 = max(self.m2 - delta * (value - self.mean), 0.0)
+
+    def evict_before(self, cutoff: datetime) -> None:
+        while self.points and self.points[0][0] < cutoff:
+            self.evict_oldest()
+
+    def trim_to(self, count: int) -> None:
+        while self.n > count:
+            self.evict_oldest()
+
+
+class _TransactionalStateCache:
+    # LRU-bounded map of stream_id -> state that transactions update and check back in after they commit.
+    # Every check-in and invalidation bumps the stream's generation, and a check-in from an older
+    # generation than the current one is stale: another transaction or an exclusion moved the stream on
+    # meanwhile, so the state is dropped and reloaded on next use.
+
+    def __init__(self, max_streams: int):
+        self.max_streams = max_streams
+        self._states: OrderedDict[str, Any] = OrderedDict()
+        self._generations: dict[str, int] = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _generation(self, stream_id: str) -> tuple[int, int]:
+        return self._epoch, self._generations.get(stream_id, 0)
+
+    def check_in(self, stream_id: str, generation: tuple[int, int], state: Any) -> None:
+        with self._lock:
+            current = self._generation(stream_id)
+            self._generations[stream_id] = current[1] + 1
+            if state is None or generation != current or self.max_streams <= 0:
+                self._states.pop(stream_id, None)
+                return
+            self._states[stream_id] = state
+            self._states.move_to_end(stream_id)
+            while len(self._states) > self.max_streams:
+                self._states.popitem(last=False)
+
+    def invalidate(self, stream_id: Optional[str] = None) -> None:
+        with self._lock:
+            if stream_id is None:
+                self._epoch += 1
+                self.invalidations += len(self._states)
+                self._states.clear()
+                return
+            self._generations[stream_id] = self._generations.get(stream_id, 0) + 1
+            if self._states.pop(stream_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._epoch += 1
+            self._states.clear()
+            self.hits = self.misses = self.invalidations = 0
+
+
+class BaselineStateCache(_TransactionalStateCache):
+    # stream_id -> (config id, RollingBaseline) for the rolling baseline modes. A transaction takes the
+    # state out of the cache while it slides it forward, so no other request reads it half-updated.
+
+    def check_out(self, stream_id: str) -> tuple[Optional[tuple[int, RollingBaseline]], tuple[int, int]]:
+        with self._lock:
+            entry = self._states.pop(stream_id, None)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry, self._generation(stream_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "streams": len(self._states),
+                "max_streams": self.max_streams,
+                "points": sum(len(baseline.points) for _, baseline in self._states.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+            }
+
+
+class LotStats:
+    # Welford statistics of one lot's deviations from target, mirrored from its LotState row.
+    __slots__ = ("state_id", "n", "mean", "m2")
+
+    def __init__(self, state_id: Optional[int] = None, n: int = 0, mean: float = 0.0, m2: float = 0.0):
+        self.state_id = state_id
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+
+    def add(self, value: float) -> None:
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+
+
+class LotStateCache(_TransactionalStateCache):
+    # stream_id -> {(control_material_lot, reagent_lot): LotStats}. The cached lots stay readable while a
+    # transaction updates its own copy of them.
+
+    def get_or_load(self, stream_id: str, loader: Callable[[], dict[tuple, LotStats]]) -> dict[tuple, LotStats]:
+        with self._lock:
+            lots = self._states.get(stream_id)
+            if lots is not None:
+                self._states.move_to_end(stream_id)
+                self.hits += 1
+                return lots
+            self.misses += 1
+            generation = self._generation(stream_id)
+        lots = loader()
+        self.check_in(stream_id, generation, lots)
+        return lots
+
+    def check_out(self, stream_id: str) -> tuple[Optional[dict[tuple, LotStats]], tuple[int, int]]:
+        with self._lock:
+            lots = self._states.get(stream_id)
+            if lots is None:
+                self.misses += 1
+                return None, self._generation(stream_id)
+            self._states.move_to_end(stream_id)
+            self.hits += 1
+            copy = {key: LotStats(lot.state_id, lot.n, lot.mean, lot.m2) for key, lot in lots.items()}
+            return copy, self._generation(stream_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "streams": len(self._states),
+                "max_streams": self.max_streams,
+                "lots": sum(len(lots) for lots in self._states.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+            }
+
+
+# States checked out by the session's open transaction: (cache, stream_id) -> [state, generation].
+_CHECKED_OUT = "checked_out_states"
+
+
+def check_out(session: Session, cache: Any, stream_id: str) -> Any:
+    # The stream's state for this transaction; later calls in the same transaction get the same state.
+    states = session.info.setdefault(_CHECKED_OUT, {})
+    if (cache, stream_id) not in states:
+        states[(cache, stream_id)] = list(cache.check_out(stream_id))
+    return states[(cache, stream_id)][0]
+
+
+def stage(session: Session, cache: Any, stream_id: str, state: Any) -> None:
+    # The state to check in when the transaction commits; None leaves the stream to be reloaded.
+    session.info.setdefault(_CHECKED_OUT, {}).setdefault((cache, stream_id), [None, None])[0] = state
+
+
+@event.listens_for(Session, "after_commit")
+def _check_in(session: Session) -> None:
+    for (cache, stream_id), (state, generation) in session.info.pop(_CHECKED_OUT, {}).items():
+        if generation is None:
+            cache.invalidate(stream_id)
+        else:
+            cache.check_in(stream_id, generation, state)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _drop_checked_out(session: Session, transaction: Any) -> None:
+    # A rolled-back or abandoned transaction checks nothing back in.
+    if transaction.parent is None:
+        session.info.pop(_CHECKED_OUT, None)
+
+
+window_cache = RollingWindowCache(capacity=int(os.getenv("BAYESIANQC_WINDOW_CACHE_SIZE", "32")))
+stream_config_cache = VersionHistoryCache(max_streams=int(os.getenv("BAYESIANQC_CONFIG_CACHE_SIZE", "10000")))
+prior_config_cache = VersionHistoryCache(max_streams=int(os.getenv("BAYESIANQC_CONFIG_CACHE_SIZE", "10000")))
+api_key_cache = TTLCache(ttl_seconds=float(os.getenv("BAYESIANQC_AUTH_CACHE_TTL", "60")))
+baseline_state_cache = BaselineStateCache(max_streams=int(os.getenv("BAYESIANQC_BASELINE_CACHE_SIZE", "1000")))
+lot_state_cache = LotStateCache(max_streams=int(os.getenv("BAYESIANQC_LOT_CACHE_SIZE", "1000")))
@@ -0,0 +1,311 @@
+from __future__ import annotations
+
+import math
+from datetime import datetime
+from typing import Any, Iterator, NamedTuple, Optional, Sequence
+
+import numpy as np
+from sqlmodel import Session, select
+
+from app.bayesian import _update_posterior
+from app.cache import VersionHistory
+from app.db_models import (
+    DEFAULT_CHANGEPOINT,
+    DEFAULT_RULE_SET,
+    ChangePointCheckpoint,
+    ChangePointState,
+    QCRecord,
+    StreamConfig,
+)
+from app.models import FrequentistSignal
+from app.storage import (
+    CHECKPOINT_INTERVAL,
+    get_active_prior,
+    naive_timestamp,
+    nearest_checkpoint,
+    prior_config_history,
+    records_after,
+    restart_checkpoint,
+    stream_config_history,
+)
+
+# Online Bayesian change-point detection (Adams & MacKay) with a constant hazard. Each run-length
+# hypothesis carries the NIG posterior of its segment; a new segment starts from the active prior and
+# includes the point that opened it. The run-length distribution is pruned to the `max_run_lengths` most
+# probable hypotheses, so a step costs O(max_run_lengths) whatever the stream length.
+# probability_changepoint is the posterior mass on segments that started within the last `window` points.
+PRUNE_LOG_PROB = math.log(1e-12)
+
+_lgamma_array = np.frompyfunc(math.lgamma, 1, 1)
+
+
+class RunLengths(NamedTuple):
+    length: np.ndarray
+    log_prob: np.ndarray
+    mu_n: np.ndarray
+    kappa_n: np.ndarray
+    alpha_n: np.ndarray
+    beta_n: np.ndarray
+    n_obs: int
+
+
+def changepoint_params(config: StreamConfig) -> dict[str, Any]:
+    rule_set = config.rule_set or DEFAULT_RULE_SET
+    return {**DEFAULT_CHANGEPOINT, **(rule_set.get("changepoint") or {})}
+
+
+def enabled(config: StreamConfig) -> bool:
+    return "CHANGEPOINT" in (config.rule_set or DEFAULT_RULE_SET).get("rules", [])
+
+
+def empty() -> RunLengths:
+    return RunLengths(np.empty(0, dtype=int), *(np.empty(0) for _ in range(5)), n_obs=0)
+
+
+def _log_predictive(value: float, mu_n, kappa_n, alpha_n, beta_n) -> np.ndarray:
+    # Student-t posterior predictive log density of each hypothesis.
+    scale_sq = beta_n * (kappa_n + 1) / (alpha_n * kappa_n)
+    log_norm = _lgamma_array(alpha_n + 0.5).astype(float) - _lgamma_array(alpha_n).astype(float)
+    return log_norm - 0.5 * np.log(2 * math.pi * alpha_n * scale_sq) - (alpha_n + 0.5) * np.log1p(
+        (value - mu_n) ** 2 / (2 * alpha_n * scale_sq)
+    )
+
+
+def _logsumexp(values: np.ndarray) -> float:
+    top = float(values.max())
+    return top + math.log(float(np.exp(values - top).sum()))
+
+
+def bocpd_step(state: RunLengths, value: float, prior: Any, params: dict) -> tuple[RunLengths, float]:
+    hazard = float(params["hazard"])
+    prior_params = np.array([[prior.mu0], [prior.kappa0], [prior.alpha0], [prior.beta0]])
+    log_change = _log_predictive(value, *prior_params)
+    if state.n_obs:
+        log_growth = state.log_prob + _log_predictive(value, *state[2:6]) + math.log1p(-hazard)
+        # The change mass is the whole previous distribution (which sums to one) times the hazard.
+        log_change = log_change + math.log(hazard)
+        log_prob = np.concatenate([log_change, log_growth])
+        length = np.concatenate([[1], state.length + 1])
+        posterior = np.concatenate([prior_params, np.array(state[2:6])], axis=1)
+    else:
+        log_prob, length, posterior = np.zeros(1), np.ones(1, dtype=int), prior_params
+    log_prob = log_prob - _logsumexp(log_prob)
+    mu_n, kappa_n, alpha_n, beta_n = _update_posterior(*posterior, value)
+
+    keep = np.flatnonzero(log_prob >= PRUNE_LOG_PROB)
+    limit = int(params["max_run_lengths"])
+    if keep.size > limit:
+        keep = keep[np.argsort(log_prob[keep])[::-1][:limit]]
+        keep.sort()
+    log_prob = log_prob[keep] - _logsumexp(log_prob[keep])
+    n_obs = state.n_obs + 1
+    state = RunLengths(length[keep], log_prob, mu_n[keep], kappa_n[keep], alpha_n[keep], beta_n[keep], n_obs)
+    recent = (state.length <= int(params["window"])) & (state.length < n_obs)
+    return state, float(np.exp(state.log_prob[recent]).sum())
+
+
+def changepoint_signals(probability: Optional[float], config: StreamConfig) -> list[FrequentistSignal]:
+    if probability is None or not enabled(config):
+        return []
+    params = changepoint_params(config)
+    if probability < params["threshold"]:
+        return []
+    return [
+        FrequentistSignal(
+            rule="CHANGEPOINT",
+            severity="warn",
+            evidence=f"Change-point probability {probability:.2f} within the last {params['window']} runs",
+        )
+    ]
+
+
+def changepoint_probabilities(
+    values: np.ndarray, configs: Sequence[Any], priors: Sequence[Any], state: Optional[RunLengths] = None
+) -> np.ndarray:
+    # bocpd_step over a stream's included points with their active config and prior, from `state` if the
+    # detector has already stepped. Sequential by nature, so this walks the points one by one.
+    state = empty() if state is None else state
+    probabilities = np.empty(len(values))
+    for i, value in enumerate(values.tolist()):
+        state, probabilities[i] = bocpd_step(state, value, priors[i], changepoint_params(configs[i]))
+    return probabilities
+
+
+def _stored(state: ChangePointState) -> RunLengths:
+    columns = state.run_lengths
+    return RunLengths(
+        np.array(columns["length"], dtype=int),
+        *(np.array(columns[name], dtype=float) for name in ("log_prob", "mu_n", "kappa_n", "alpha_n", "beta_n")),
+        n_obs=state.n_obs,
+    )
+
+
+def _columns(run_lengths: RunLengths) -> dict[str, list]:
+    return {
+        name: getattr(run_lengths, name).tolist()
+        for name in ("length", "log_prob", "mu_n", "kappa_n", "alpha_n", "beta_n")
+    }
+
+
+def _store(
+    session: Session,
+    state: Optional[ChangePointState],
+    stream_id: str,
+    run_lengths: RunLengths,
+    updated_at: datetime,
+) -> None:
+    if state is None:
+        state = ChangePointState(stream_id=stream_id)
+    state.run_lengths = _columns(run_lengths)
+    state.n_obs = run_lengths.n_obs
+    state.updated_at = updated_at
+    session.add(state)
+
+
+def _checkpoint(
+    session: Session, stream_id: str, record_id: Optional[int], timestamp: datetime, run_lengths: RunLengths
+) -> None:
+    if record_id is not None and run_lengths.n_obs % CHECKPOINT_INTERVAL == 0:
+        session.add(
+            ChangePointCheckpoint(
+                stream_id=stream_id,
+                checkpoint_at=naive_timestamp(timestamp),
+                qc_record_id=record_id,
+                n_obs=run_lengths.n_obs,
+                run_lengths=_columns(run_lengths),
+            )
+        )
+
+
+def _is_late(state: Optional[ChangePointState], timestamp: datetime) -> bool:
+    return state is not None and naive_timestamp(timestamp) < naive_timestamp(state.updated_at)
+
+
+def _steps(
+    session: Session,
+    stream_id: str,
+    configs: VersionHistory,
+    priors: VersionHistory,
+    checkpoint: Optional[ChangePointCheckpoint],
+    before: Optional[datetime] = None,
+) -> Iterator[tuple[int, datetime, RunLengths, float]]:
+    # Detector steps over the included records after the checkpoint (and before `before`) whose config
+    # enables it, from the checkpoint's distribution: (record id, timestamp, run lengths, probability).
+    query = (
+        select(QCRecord.id, QCRecord.timestamp, QCRecord.result_value)
+        .where(QCRecord.stream_id == stream_id, QCRecord.include_in_stats == True)
+        .order_by(QCRecord.timestamp.asc(), QCRecord.id.asc())
+    )
+    if before is not None:
+        query = query.where(QCRecord.timestamp < naive_timestamp(before))
+    run_lengths = _stored(checkpoint) if checkpoint else empty()
+    for row_id, timestamp, value in session.exec(records_after(query, checkpoint)).all():
+        config = configs.active_at(timestamp)
+        if enabled(config):
+            run_lengths, probability = bocpd_step(
+                run_lengths, value, priors.active_at(timestamp), changepoint_params(config)
+            )
+            yield row_id, timestamp, run_lengths, probability
+
+
+def state_before(session: Session, stream_id: str, before: datetime) -> Optional[RunLengths]:
+    # The run-length distribution after the included records before `before`, from the nearest checkpoint;
+    # None when the detector has not stepped by then.
+    configs = stream_config_history(session, stream_id)
+    priors = prior_config_history(session, stream_id)
+    if not priors or not any(enabled(config) for config in configs):
+        return None
+    checkpoint = nearest_checkpoint(session, ChangePointCheckpoint, stream_id, before)
+    run_lengths = _stored(checkpoint) if checkpoint else None
+    for _, _, run_lengths, _ in _steps(session, stream_id, configs, priors, checkpoint, before):
+        pass
+    return run_lengths
+
+
+def replay_changepoint_state(
+    session: Session,
+    stream_id: str,
+    since: datetime = datetime.min,
+    record_id: Optional[int] = None,
+) -> dict[int, float]:
+    # Re-runs the detector over the included records after the nearest checkpoint strictly before
+    # (since, record_id), rewriting the later checkpoints and the stream's ChangePointState. Used for
+    # exclusions, reinstatements and late points. Returns each re-run record's change-point probability.
+    configs = stream_config_history(session, stream_id)
+    if not any(enabled(config) for config in configs):
+        return {}
+    priors = prior_config_history(session, stream_id)
+    state = session.exec(select(ChangePointState).where(ChangePointState.stream_id == stream_id)).first()
+    if not priors:
+        if state:
+            session.delete(state)
+        return {}
+    checkpoint = restart_checkpoint(session, ChangePointCheckpoint, stream_id, since, record_id)
+    run_lengths = _stored(checkpoint) if checkpoint else empty()
+    updated_at = checkpoint.checkpoint_at if checkpoint else None
+    probabilities: dict[int, float] = {}
+    for row_id, timestamp, run_lengths, probability in _steps(session, stream_id, configs, priors, checkpoint):
+        probabilities[row_id] = probability
+        _checkpoint(session, stream_id, row_id, timestamp, run_lengths)
+        updated_at = timestamp
+    if updated_at is None:
+        if state:
+            session.delete(state)
+        return probabilities
+    _store(session, state, stream_id, run_lengths, updated_at)
+    return probabilities
+
+
+def update_changepoint(
+    session: Session,
+    stream_id: str,
+    value: float,
+    timestamp: datetime,
+    config: StreamConfig,
+    record_id: Optional[int] = None,
+) -> Optional[float]:
+    # One detector step for an ingested record; None when the stream does not run the detector.
+    if not enabled(config):
+        return None
+    prior = get_active_prior(session, stream_id, timestamp)
+    if prior is None:
+        return None
+    state = session.exec(select(ChangePointState).where(ChangePointState.stream_id == stream_id)).first()
+    if record_id is not None and _is_late(state, timestamp):
+        return replay_changepoint_state(session, stream_id, timestamp, record_id).get(record_id)
+    run_lengths, probability = bocpd_step(
+        _stored(state) if state else empty(), value, prior, changepoint_params(config)
+    )
+    _store(session, state, stream_id, run_lengths, timestamp)
+    _checkpoint(session, stream_id, record_id, timestamp, run_lengths)
+    return probability
+
+
+def update_changepoints_batch(
+    session: Session,
+    stream_id: str,
+    values: np.ndarray,
+    timestamps: Sequence[datetime],
+    configs: Sequence[StreamConfig],
+    record_ids: Optional[Sequence[int]] = None,
+) -> list[Optional[float]]:
+    # update_changepoint over one stream's time-sorted batch with a single state write.
+    probabilities: list[Optional[float]] = [None] * len(values)
+    rows = [i for i, config in enumerate(configs) if enabled(config)]
+    priors = prior_config_history(session, stream_id)
+    if not rows or not priors:
+        return probabilities
+    state = session.exec(select(ChangePointState).where(ChangePointState.stream_id == stream_id)).first()
+    if record_ids is not None and _is_late(state, timestamps[rows[0]]):
+        replayed = replay_changepoint_state(session, stream_id, timestamps[rows[0]], record_ids[rows[0]])
+        for i in rows:
+            probabilities[i] = replayed.get(record_ids[i])
+        return probabilities
+    run_lengths = _stored(state) if state else empty()
+    for i in rows:
+        run_lengths, probabilities[i] = bocpd_step(
+            run_lengths, float(values[i]), priors.active_at(timestamps[i]), changepoint_params(configs[i])
+        )
+        _checkpoint(session, stream_id, record_ids[i] if record_ids is not None else None, timestamps[i], run_lengths)
+    _store(session, state, stream_id, run_lengths, timestamps[rows[-1]])
+    return probabilities
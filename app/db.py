@@ -41,7 +41,8 @@ def get_engine() -> Engine:
 
 def get_session():
     engine = get_engine()
-    with Session(engine) as session:
+    # Request handlers keep using their objects after the audit commit, so don't expire them.
+    with Session(engine, expire_on_commit=False) as session:
         yield session
 
 
@@ -67,7 +68,84 @@ def _ensure_sqlite_columns(engine: Engine) -> None:
             cursor.execute("ALTER TABLE qcrecord ADD COLUMN resolved_by VARCHAR")
         if "resolved_reason" not in columns:
             cursor.execute("ALTER TABLE qcrecord ADD COLUMN resolved_reason VARCHAR")
+        if "baseline_mode" not in columns:
+            cursor.execute("ALTER TABLE qcrecord ADD COLUMN baseline_mode VARCHAR")
+        if "baseline_method" not in columns:
+            cursor.execute("ALTER TABLE qcrecord ADD COLUMN baseline_method VARCHAR")
+        if "baseline_mean" not in columns:
+            cursor.execute("ALTER TABLE qcrecord ADD COLUMN baseline_mean FLOAT")
+        if "baseline_sd" not in columns:
+            cursor.execute("ALTER TABLE qcrecord ADD COLUMN baseline_sd FLOAT")
+        if "baseline_n" not in columns:
+            cursor.execute("ALTER TABLE qcrecord ADD COLUMN baseline_n INTEGER")
+        if "lot_offset" not in columns:
+            cursor.execute("ALTER TABLE qcrecord ADD COLUMN lot_offset FLOAT")
+        if "chart_n" not in columns:
+            cursor.execute("ALTER TABLE qcrecord ADD COLUMN chart_n INTEGER")
+        if "cusum_upper" not in columns:
+            cursor.execute("ALTER TABLE qcrecord ADD COLUMN cusum_upper FLOAT")
+        if "cusum_lower" not in columns:
+            cursor.execute("ALTER TABLE qcrecord ADD COLUMN cusum_lower FLOAT")
+        if "ewma" not in columns:
+            cursor.execute("ALTER TABLE qcrecord ADD COLUMN ewma FLOAT")
+        if "ewma_limit" not in columns:
+            cursor.execute("ALTER TABLE qcrecord ADD COLUMN ewma_limit FLOAT")
         cursor.execute("UPDATE qcrecord SET include_in_stats = 1 WHERE include_in_stats IS NULL")
+        cursor.execute("PRAGMA table_info(streamconfig)")
+        columns = {row[1] for row in cursor.fetchall()}
+        if "baseline_mode" not in columns:
+            cursor.execute("ALTER TABLE streamconfig ADD COLUMN baseline_mode VARCHAR(14) DEFAULT 'FIXED'")
+        if "baseline_window_hours" not in columns:
+            cursor.execute("ALTER TABLE streamconfig ADD COLUMN baseline_window_hours FLOAT")
+        if "baseline_runs" not in columns:
+            cursor.execute("ALTER TABLE streamconfig ADD COLUMN baseline_runs INTEGER")
+        if "baseline_method" not in columns:
+            cursor.execute("ALTER TABLE streamconfig ADD COLUMN baseline_method VARCHAR(12) DEFAULT 'CLASSICAL'")
+        if "baseline_trim" not in columns:
+            cursor.execute("ALTER TABLE streamconfig ADD COLUMN baseline_trim FLOAT DEFAULT 0.1")
+        if "bias_threshold" not in columns:
+            cursor.execute("ALTER TABLE streamconfig ADD COLUMN bias_threshold FLOAT")
+        if "drift_model" not in columns:
+            cursor.execute("ALTER TABLE streamconfig ADD COLUMN drift_model VARCHAR(11)")
+        if "drift_level_noise_sd" not in columns:
+            cursor.execute("ALTER TABLE streamconfig ADD COLUMN drift_level_noise_sd FLOAT DEFAULT 0.02")
+        if "drift_rate_noise_sd" not in columns:
+            cursor.execute("ALTER TABLE streamconfig ADD COLUMN drift_rate_noise_sd FLOAT DEFAULT 0.0002")
+        if "drift_delta_sd" not in columns:
+            cursor.execute("ALTER TABLE streamconfig ADD COLUMN drift_delta_sd FLOAT DEFAULT 0.005")
+        if "prior_pooling" not in columns:
+            cursor.execute("ALTER TABLE streamconfig ADD COLUMN prior_pooling BOOLEAN DEFAULT 0")
+        if "lot_model" not in columns:
+            cursor.execute("ALTER TABLE streamconfig ADD COLUMN lot_model BOOLEAN DEFAULT 0")
+        if "robust_contamination" not in columns:
+            cursor.execute("ALTER TABLE streamconfig ADD COLUMN robust_contamination FLOAT")
+        if "robust_outlier_scale" not in columns:
+            cursor.execute("ALTER TABLE streamconfig ADD COLUMN robust_outlier_scale FLOAT DEFAULT 10.0")
+        cursor.execute("PRAGMA table_info(posteriorhistory)")
+        columns = {row[1] for row in cursor.fetchall()}
+        if "probability_outlier" not in columns:
+            cursor.execute("ALTER TABLE posteriorhistory ADD COLUMN probability_outlier FLOAT")
+        cursor.execute("PRAGMA table_info(baselinestats)")
+        columns = {row[1] for row in cursor.fetchall()}
+        if "sketch" not in columns:
+            cursor.execute("ALTER TABLE baselinestats ADD COLUMN sketch JSON")
+        cursor.execute("PRAGMA table_info(ingestionreceipt)")
+        columns = {row[1] for row in cursor.fetchall()}
+        if "status" not in columns:
+            cursor.execute("ALTER TABLE ingestionreceipt ADD COLUMN status VARCHAR DEFAULT 'completed'")
+        if "completed_at" not in columns:
+            cursor.execute("ALTER TABLE ingestionreceipt ADD COLUMN completed_at DATETIME")
+        if "error" not in columns:
+            cursor.execute("ALTER TABLE ingestionreceipt ADD COLUMN error VARCHAR")
+        cursor.execute("DROP INDEX IF EXISTS ix_lotstate_stream_lots")
+        cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_lotstate_stream_lots "
+            "ON lotstate (stream_id, control_material_lot, coalesce(reagent_lot, ''))"
+        )
+        cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_backteststreamresult_run_stream "
+            "ON backteststreamresult (run_id, stream_id)"
+        )
         connection.commit()
     finally:
         cursor.close()
@@ -3,12 +3,15 @@ from __future__ import annotations
 from datetime import datetime, timezone
 from typing import Optional
 
-from sqlalchemy import Column, Enum as SAEnum, JSON
+from sqlalchemy import Column, Enum as SAEnum, Index, JSON, text
 from sqlmodel import Field, SQLModel
 
 from app.models import (
     AlertStatus,
+    BaselineMethod,
+    BaselineMode,
     CapaStatus,
+    DriftModel,
     DuplicateStatus,
     EntrySource,
     EventType,
@@ -22,6 +25,9 @@ def utcnow() -> datetime:
 
 
 DEFAULT_RULE_SET = {"rules": ["1-3s", "2-2s", "R-4s", "4-1s", "10x"]}
+DEFAULT_CUSUM = {"k": 0.5, "h": 5.0}
+DEFAULT_EWMA = {"lambda": 0.2, "L": 3.0}
+DEFAULT_CHANGEPOINT = {"hazard": 0.004, "threshold": 0.5, "window": 10, "max_run_lengths": 100}
 
 
 class ApiKey(SQLModel, table=True):
@@ -89,11 +95,40 @@ class StreamConfig(SQLModel, table=True):
     unit_conversions: Optional[dict] = Field(default=None, sa_column=Column(JSON))
     baseline_start: Optional[datetime] = None
     baseline_end: Optional[datetime] = None
+    baseline_mode: BaselineMode = Field(default=BaselineMode.FIXED, sa_column=Column(SAEnum(BaselineMode)))
+    baseline_window_hours: Optional[float] = None
+    baseline_runs: Optional[int] = None
+    baseline_method: BaselineMethod = Field(
+        default=BaselineMethod.CLASSICAL, sa_column=Column(SAEnum(BaselineMethod))
+    )
+    baseline_trim: float = 0.1
     risk_threshold_warn: int = 50
     risk_threshold_hold: int = 80
+    bias_threshold: Optional[float] = None
+    drift_model: Optional[DriftModel] = Field(default=None, sa_column=Column(SAEnum(DriftModel)))
+    drift_level_noise_sd: float = 0.02
+    drift_rate_noise_sd: float = 0.0002
+    drift_delta_sd: float = 0.005
+    prior_pooling: bool = False
+    lot_model: bool = False
+    robust_contamination: Optional[float] = None
+    robust_outlier_scale: float = 10.0
     rule_set: dict = Field(default_factory=lambda: DEFAULT_RULE_SET.copy(), sa_column=Column(JSON))
 
 
+class BaselineStats(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    stream_config_id: int = Field(index=True, unique=True)
+    stream_id: str = Field(index=True)
+    baseline_start: datetime
+    baseline_end: datetime
+    n: int = 0
+    mean: float = 0.0
+    m2: float = 0.0
+    sketch: Optional[dict] = Field(default=None, sa_column=Column(JSON))
+    updated_at: datetime = Field(default_factory=utcnow)
+
+
 class PriorConfig(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     stream_id: str = Field(index=True)
@@ -118,6 +153,139 @@ class PosteriorState(SQLModel, table=True):
     n_obs: int = 0
 
 
+class DriftState(SQLModel, table=True):
+    # Kalman filter state of the drift model: the level/rate mean and their covariance.
+    id: Optional[int] = Field(default=None, primary_key=True)
+    stream_id: str = Field(index=True)
+    updated_at: datetime = Field(default_factory=utcnow)
+    level: float
+    rate: float
+    level_var: float
+    level_rate_cov: float
+    rate_var: float
+    n_obs: int = 0
+
+
+class DriftCheckpoint(SQLModel, table=True):
+    # The drift filter state after every CHECKPOINT_INTERVAL-th filtered record, for replays from there.
+    id: Optional[int] = Field(default=None, primary_key=True)
+    stream_id: str = Field(index=True)
+    checkpoint_at: datetime = Field(index=True)
+    qc_record_id: int
+    n_obs: int
+    level: float
+    rate: float
+    level_var: float
+    level_rate_cov: float
+    rate_var: float
+    created_at: datetime = Field(default_factory=utcnow)
+
+
+class ChangePointState(SQLModel, table=True):
+    # Pruned run-length distribution of the change-point detector: per hypothesis its run length, log
+    # probability and segment posterior, stored as parallel lists.
+    id: Optional[int] = Field(default=None, primary_key=True)
+    stream_id: str = Field(index=True)
+    updated_at: datetime = Field(default_factory=utcnow)
+    run_lengths: dict = Field(default_factory=dict, sa_column=Column(JSON))
+    n_obs: int = 0
+
+
+class ChangePointCheckpoint(SQLModel, table=True):
+    # The run-length distribution after every CHECKPOINT_INTERVAL-th detector step, for replays from there.
+    id: Optional[int] = Field(default=None, primary_key=True)
+    stream_id: str = Field(index=True)
+    checkpoint_at: datetime = Field(index=True)
+    qc_record_id: int
+    n_obs: int
+    run_lengths: dict = Field(default_factory=dict, sa_column=Column(JSON))
+    created_at: datetime = Field(default_factory=utcnow)
+
+
+class LotState(SQLModel, table=True):
+    # Welford count/mean/m2 of one lot's included deviations from target, per control material and
+    # reagent lot. One row per lot; a missing reagent lot counts as one lot, not as distinct NULLs.
+    __table_args__ = (
+        Index(
+            "uq_lotstate_stream_lots",
+            "stream_id",
+            "control_material_lot",
+            text("coalesce(reagent_lot, '')"),
+            unique=True,
+        ),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    stream_id: str
+    control_material_lot: str
+    reagent_lot: Optional[str] = None
+    n: int = 0
+    mean: float = 0.0
+    m2: float = 0.0
+    updated_at: datetime = Field(default_factory=utcnow)
+
+
+class HierarchyFit(SQLModel, table=True):
+    # Group-level hyperparameters of one analyte/method/QC level group from a hierarchy refit. Every
+    # refit stores a row per group under one fitted_at.
+    id: Optional[int] = Field(default=None, primary_key=True)
+    analyte: str = Field(index=True)
+    method: str
+    qc_level: str
+    streams: int
+    points: int
+    offset: float
+    between_sd: float
+    within_sd: float
+    kappa0: float
+    alpha0: float
+    fitted_at: datetime = Field(default_factory=utcnow, index=True)
+    created_by: str = Field(default="system")
+
+
+class ControlChartState(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    stream_id: str = Field(index=True, unique=True)
+    qc_record_id: Optional[int] = None
+    timestamp: Optional[datetime] = None
+    n: int = 0
+    cusum_upper: float = 0.0
+    cusum_lower: float = 0.0
+    ewma: float = 0.0
+    updated_at: datetime = Field(default_factory=utcnow)
+
+
+class PosteriorCheckpoint(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    stream_id: str = Field(index=True)
+    checkpoint_at: datetime = Field(index=True)
+    qc_record_id: int
+    n_obs: int
+    mu_n: float
+    kappa_n: float
+    alpha_n: float
+    beta_n: float
+    created_at: datetime = Field(default_factory=utcnow)
+
+
+class PosteriorHistory(SQLModel, table=True):
+    # The posterior and risk each record was scored with, written once at ingest alongside the record.
+    __table_args__ = (Index("ix_posteriorhistory_stream_timestamp", "stream_id", "timestamp"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    qc_record_id: int = Field(unique=True)
+    stream_id: str
+    timestamp: datetime
+    mu_n: float
+    kappa_n: float
+    alpha_n: float
+    beta_n: float
+    probability_outside_limits: float
+    probability_bias_exceeded: Optional[float] = None
+    risk_score: int
+    probability_outlier: Optional[float] = None
+
+
 class QCRecord(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     stream_id: str = Field(index=True)
@@ -140,6 +308,17 @@ class QCRecord(SQLModel, table=True):
     resolved_at: Optional[datetime] = None
     resolved_by: Optional[str] = None
     resolved_reason: Optional[str] = None
+    baseline_mode: Optional[str] = None
+    baseline_method: Optional[str] = None
+    baseline_mean: Optional[float] = None
+    baseline_sd: Optional[float] = None
+    baseline_n: Optional[int] = None
+    lot_offset: Optional[float] = None
+    chart_n: Optional[int] = None
+    cusum_upper: Optional[float] = None
+    cusum_lower: Optional[float] = None
+    ewma: Optional[float] = None
+    ewma_limit: Optional[float] = None
     raw_payload: dict = Field(sa_column=Column(JSON))
     duplicate_status: DuplicateStatus = Field(sa_column=Column(SAEnum(DuplicateStatus)))
     created_at: datetime = Field(default_factory=utcnow)
@@ -238,3 +417,51 @@ class IngestionReceipt(SQLModel, table=True):
     created_at: datetime = Field(default_factory=utcnow)
     response: dict = Field(sa_column=Column(JSON))
     qc_record_id: Optional[int] = Field(default=None, index=True)
+    status: str = Field(default="completed", index=True)
+    completed_at: Optional[datetime] = None
+    error: Optional[str] = None
+
+
+class IngestionOutbox(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    receipt_id: int = Field(index=True)
+    stream_id: str = Field(index=True)
+    payload: dict = Field(sa_column=Column(JSON))
+    actor_role: Role = Field(sa_column=Column(SAEnum(Role)))
+    idempotency_key: Optional[str] = None
+    status: str = Field(default="pending", index=True)
+    attempts: int = 0
+    claim_token: Optional[str] = Field(default=None, index=True)
+    enqueued_at: datetime = Field(default_factory=utcnow, index=True)
+    started_at: Optional[datetime] = None
+    completed_at: Optional[datetime] = None
+    error: Optional[str] = None
+
+
+class BacktestRun(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str = Field(index=True)
+    version: int = Field(default=1, index=True)
+    status: str = Field(default="pending", index=True)
+    candidate: dict = Field(sa_column=Column(JSON))
+    scenario: Optional[dict] = Field(default=None, sa_column=Column(JSON))
+    stream_ids: list[str] = Field(sa_column=Column(JSON))
+    summary: Optional[dict] = Field(default=None, sa_column=Column(JSON))
+    artifact_digest: Optional[str] = None
+    created_at: datetime = Field(default_factory=utcnow)
+    created_by: str = Field(default="system")
+    started_at: Optional[datetime] = None
+    completed_at: Optional[datetime] = None
+
+
+class BacktestStreamResult(SQLModel, table=True):
+    __table_args__ = (Index("uq_backteststreamresult_run_stream", "run_id", "stream_id", unique=True),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    run_id: int = Field(index=True)
+    stream_id: str = Field(index=True)
+    status: str = Field(default="completed")
+    metrics: dict = Field(sa_column=Column(JSON))
+    error: Optional[str] = None
+    elapsed_ms: float = 0.0
+    created_at: datetime = Field(default_factory=utcnow)
@@ -0,0 +1,377 @@
+from __future__ import annotations
+
+import math
+from datetime import datetime
+from typing import Any, NamedTuple, Optional, Sequence
+
+import numpy as np
+from sqlmodel import Session, select
+
+from app import risk
+from app.cache import VersionHistory
+from app.db_models import DriftCheckpoint, DriftState, QCRecord, StreamConfig
+from app.models import DriftModel
+from app.storage import (
+    CHECKPOINT_INTERVAL,
+    LOT_ADJUSTED_VALUE,
+    naive_timestamp,
+    nearest_checkpoint,
+    records_after,
+    restart_checkpoint,
+    stream_config_history,
+)
+
+# Dynamic linear model for a drifting mean, run next to the static-mean NIG posterior:
+#   level_t = level_{t-1} + rate_{t-1} + w_level,  w_level ~ N(0, (drift_level_noise_sd * sigma)^2)
+#   rate_t  = rate_{t-1} + w_rate,                 w_rate  ~ N(0, (drift_rate_noise_sd * sigma)^2)
+#   y_t     = level_t + v,                         v       ~ N(0, sigma^2)
+# The local_level model has no rate term. Steps are included runs, not wall-clock time, so rates are per
+# run. probability_drift is P(|rate| > drift_delta_sd * sigma) for local_trend, and
+# P(|level - target| > bias_threshold) for local_level.
+DRIFT_INITIAL_RATE_SD = 0.1
+# Once the covariance stops changing, the gain is constant and the mean recursion is evaluated blockwise.
+CONVERGENCE_TOL = 1e-13
+FILTER_BLOCK = 128
+
+_erfc_array = np.frompyfunc(math.erfc, 1, 1)
+
+
+class FilterState(NamedTuple):
+    level: Any
+    rate: Any
+    level_var: Any
+    level_rate_cov: Any
+    rate_var: Any
+
+
+def _noise(config: StreamConfig) -> tuple[bool, float, float, float]:
+    trend = config.drift_model == DriftModel.LOCAL_TREND
+    q_level = (config.drift_level_noise_sd * config.sigma) ** 2
+    q_rate = (config.drift_rate_noise_sd * config.sigma) ** 2 if trend else 0.0
+    return trend, q_level, q_rate, config.sigma**2
+
+
+def initial_state(config: StreamConfig) -> FilterState:
+    trend = config.drift_model == DriftModel.LOCAL_TREND
+    rate_var = (DRIFT_INITIAL_RATE_SD * config.sigma) ** 2 if trend else 0.0
+    return FilterState(config.target_value, 0.0, config.sigma**2, 0.0, rate_var)
+
+
+def kalman_step(state: FilterState, value: float, config: StreamConfig) -> FilterState:
+    # One predict/update step: constant time and memory per point.
+    trend, q_level, q_rate, r = _noise(config)
+    level, rate, p_ll, p_lr, p_rr = state
+    if trend:
+        level, p_ll, p_lr = level + rate, p_ll + 2 * p_lr + p_rr, p_lr + p_rr
+    p_ll += q_level
+    p_rr += q_rate
+    s = p_ll + r
+    k_level, k_rate = p_ll / s, p_lr / s
+    innovation = value - level
+    return FilterState(
+        level + k_level * innovation,
+        rate + k_rate * innovation,
+        p_ll - k_level * p_ll,
+        p_lr - k_level * p_lr,
+        p_rr - k_rate * p_lr,
+    )
+
+
+def _steady_means(values: np.ndarray, transition: np.ndarray, gain: np.ndarray, start: np.ndarray) -> np.ndarray:
+    # x_i = A x_{i-1} + K y_i with constant A and K, one matrix product per block of rows as in the replay
+    # EWMA; only the last state of each block is carried forward sequentially.
+    block = FILTER_BLOCK
+    padded = np.concatenate([values, np.zeros(-values.size % block)]).reshape(-1, block)
+    powers = np.empty((block + 1, 2, 2))
+    powers[0] = np.eye(2)
+    for k in range(1, block + 1):
+        powers[k] = transition @ powers[k - 1]
+    impulse = powers[:block] @ gain
+    lags = np.arange(block)[:, None] - np.arange(block)[None, :]
+    valid = lags >= 0
+    means = np.empty((2, len(padded), block))
+    carried = np.empty((len(padded), 2))
+    for component in range(2):
+        weights = np.where(valid, impulse[np.maximum(lags, 0), component], 0.0)
+        means[component] = padded @ weights.T
+    previous = start
+    for b in range(len(padded)):
+        carried[b] = previous
+        previous = means[:, b, -1] + powers[block] @ previous
+    means += np.einsum("jcd,bd->cbj", powers[1:], carried)
+    return means.reshape(2, -1)[:, : values.size]
+
+
+def kalman_filter(
+    values: np.ndarray,
+    configs: Sequence[StreamConfig],
+    version: np.ndarray,
+    state: Optional[FilterState] = None,
+) -> FilterState:
+    # kalman_step over arrays; row i uses configs[version[i]]. Returns the filtered state after each row.
+    # The covariance does not depend on the data, so each config segment steps it until it converges and
+    # runs the rest of the segment at the steady-state gain.
+    count = len(values)
+    output = FilterState(*(np.empty(count) for _ in range(5)))
+    if not count:
+        return output
+    state = state if state is not None else initial_state(configs[version[0]])
+    boundaries = np.flatnonzero(np.diff(version)) + 1
+    for segment in np.split(np.arange(count), boundaries):
+        config = configs[version[segment[0]]]
+        i = segment[0]
+        while i <= segment[-1]:
+            previous = state
+            state = kalman_step(state, float(values[i]), config)
+            for column, value in zip(output, state):
+                column[i] = value
+            i += 1
+            scale = previous.level_var + previous.rate_var
+            if all(abs(a - b) <= CONVERGENCE_TOL * scale for a, b in zip(state[2:], previous[2:])):
+                break
+        if i > segment[-1]:
+            continue
+        trend, q_level, _, r = _noise(config)
+        p_ll = state.level_var + q_level + (2 * state.level_rate_cov + state.rate_var if trend else 0.0)
+        p_lr = state.level_rate_cov + (state.rate_var if trend else 0.0)
+        gain = np.array([p_ll, p_lr]) / (p_ll + r)
+        transition = np.array([[1.0, 1.0 if trend else 0.0], [0.0, 1.0]])
+        transition = transition - np.outer(gain, transition[0])
+        rows = np.arange(i, segment[-1] + 1)
+        level, rate = _steady_means(values[rows], transition, gain, np.array([state.level, state.rate]))
+        output.level[rows], output.rate[rows] = level, rate
+        for column, value in zip(output[2:], state[2:]):
+            column[rows] = value
+        state = FilterState(float(level[-1]), float(rate[-1]), *state[2:])
+    return output
+
+
+def drift_probability(state: FilterState, config: StreamConfig) -> float:
+    if config.drift_model == DriftModel.LOCAL_TREND:
+        mean, sd, threshold = state.rate, math.sqrt(max(state.rate_var, 0.0)), config.drift_delta_sd * config.sigma
+    else:
+        mean, sd = state.level - config.target_value, math.sqrt(max(state.level_var, 0.0))
+        threshold = risk.bias_threshold(config)
+    if sd == 0:
+        return float(abs(mean) > threshold)
+    scaled = sd * math.sqrt(2)
+    return 0.5 * (math.erfc((threshold + mean) / scaled) + math.erfc((threshold - mean) / scaled))
+
+
+def drift_probabilities(filtered: FilterState, configs: Sequence[StreamConfig], version: np.ndarray) -> np.ndarray:
+    trend = np.array([config.drift_model == DriftModel.LOCAL_TREND for config in configs])[version]
+    targets = np.array([config.target_value for config in configs])[version]
+    deltas = np.array([config.drift_delta_sd * config.sigma for config in configs])[version]
+    biases = np.array([risk.bias_threshold(config) for config in configs])[version]
+    mean = np.where(trend, filtered.rate, filtered.level - targets)
+    sd = np.sqrt(np.maximum(np.where(trend, filtered.rate_var, filtered.level_var), 0.0))
+    threshold = np.where(trend, deltas, biases)
+    probability = (np.abs(mean) > threshold).astype(float)
+    spread = sd > 0
+    scaled = sd[spread] * math.sqrt(2)
+    upper = _erfc_array((threshold[spread] - mean[spread]) / scaled).astype(float)
+    lower = _erfc_array((threshold[spread] + mean[spread]) / scaled).astype(float)
+    probability[spread] = 0.5 * (lower + upper)
+    return probability
+
+
+def drift_fields(state: FilterState, config: StreamConfig) -> dict:
+    trend = config.drift_model == DriftModel.LOCAL_TREND
+    return {
+        "drift_level": float(state.level),
+        "drift_level_sd": math.sqrt(max(float(state.level_var), 0.0)),
+        "drift_rate": float(state.rate) if trend else None,
+        "drift_rate_sd": math.sqrt(max(float(state.rate_var), 0.0)) if trend else None,
+        "probability_drift": drift_probability(FilterState(*(float(value) for value in state)), config),
+    }
+
+
+def _store(
+    session: Session,
+    state: Optional[DriftState],
+    stream_id: str,
+    filtered: FilterState,
+    n_obs: int,
+    updated_at: datetime,
+) -> None:
+    if state is None:
+        state = DriftState(stream_id=stream_id, level=0.0, rate=0.0, level_var=0.0, level_rate_cov=0.0, rate_var=0.0)
+    state.level, state.rate, state.level_var, state.level_rate_cov, state.rate_var = (float(value) for value in filtered)
+    state.n_obs = n_obs
+    state.updated_at = updated_at
+    session.add(state)
+
+
+def _checkpoint(stream_id: str, record_id: int, timestamp: datetime, n_obs: int, state: FilterState) -> DriftCheckpoint:
+    level, rate, level_var, level_rate_cov, rate_var = (float(value) for value in state)
+    return DriftCheckpoint(
+        stream_id=stream_id,
+        checkpoint_at=naive_timestamp(timestamp),
+        qc_record_id=record_id,
+        n_obs=n_obs,
+        level=level,
+        rate=rate,
+        level_var=level_var,
+        level_rate_cov=level_rate_cov,
+        rate_var=rate_var,
+    )
+
+
+def _checkpoints(
+    session: Session,
+    stream_id: str,
+    record_ids: Sequence[int],
+    timestamps: Sequence[datetime],
+    n_start: int,
+    filtered: FilterState,
+) -> None:
+    for i, record_id in enumerate(record_ids):
+        if (n_start + i + 1) % CHECKPOINT_INTERVAL == 0:
+            row = FilterState(*(column[i] for column in filtered))
+            session.add(_checkpoint(stream_id, record_id, timestamps[i], n_start + i + 1, row))
+
+
+def _stored(state: DriftState) -> FilterState:
+    return FilterState(state.level, state.rate, state.level_var, state.level_rate_cov, state.rate_var)
+
+
+def _is_late(state: Optional[DriftState], timestamp: datetime) -> bool:
+    return state is not None and naive_timestamp(timestamp) < naive_timestamp(state.updated_at)
+
+
+def _version_index(configs: Sequence[StreamConfig]) -> tuple[list[StreamConfig], np.ndarray]:
+    # Distinct config objects in order of first use, and each row's index into them.
+    positions: dict[int, int] = {}
+    versions: list[StreamConfig] = []
+    for config in configs:
+        if id(config) not in positions:
+            positions[id(config)] = len(versions)
+            versions.append(config)
+    return versions, np.array([positions[id(config)] for config in configs], dtype=int)
+
+
+def _refilter(
+    session: Session,
+    stream_id: str,
+    history: VersionHistory,
+    checkpoint: Optional[DriftCheckpoint],
+    before: Optional[datetime] = None,
+) -> tuple[list, Optional[FilterState]]:
+    # Filters the included records under a drift model after the checkpoint (and before `before`) from its
+    # state. Returns the filtered (id, timestamp, value) rows with the state after each.
+    query = (
+        select(QCRecord.id, QCRecord.timestamp, LOT_ADJUSTED_VALUE)
+        .where(QCRecord.stream_id == stream_id, QCRecord.include_in_stats == True)
+        .order_by(QCRecord.timestamp.asc(), QCRecord.id.asc())
+    )
+    if before is not None:
+        query = query.where(QCRecord.timestamp < naive_timestamp(before))
+    rows = session.exec(records_after(query, checkpoint)).all()
+    configs = [history.active_at(row[1]) for row in rows]
+    rows = [row for row, config in zip(rows, configs) if config is not None and config.drift_model is not None]
+    configs = [config for config in configs if config is not None and config.drift_model is not None]
+    if not rows:
+        return [], None
+    versions, version = _version_index(configs)
+    values = np.array([row[2] for row in rows], dtype=float)
+    return rows, kalman_filter(values, versions, version, _stored(checkpoint) if checkpoint else None)
+
+
+def state_before(session: Session, stream_id: str, before: datetime) -> Optional[FilterState]:
+    # The filter state after the included records before `before`, from the nearest checkpoint; None when
+    # no record has been filtered by then.
+    history = stream_config_history(session, stream_id)
+    if not any(config.drift_model is not None for config in history):
+        return None
+    checkpoint = nearest_checkpoint(session, DriftCheckpoint, stream_id, before)
+    rows, filtered = _refilter(session, stream_id, history, checkpoint, before)
+    if not rows:
+        return _stored(checkpoint) if checkpoint else None
+    return FilterState(*(float(column[-1]) for column in filtered))
+
+
+def replay_drift_state(
+    session: Session,
+    stream_id: str,
+    since: datetime = datetime.min,
+    record_id: Optional[int] = None,
+) -> tuple[list[int], FilterState]:
+    # Refilters the included records under a drift model after the nearest checkpoint strictly before
+    # (since, record_id), rewriting the later checkpoints and the stream's DriftState. Used for exclusions,
+    # reinstatements and late points. Returns the refiltered record ids with the state after each.
+    state = session.exec(select(DriftState).where(DriftState.stream_id == stream_id)).first()
+    history = stream_config_history(session, stream_id)
+    empty = FilterState(*(np.empty(0) for _ in range(5)))
+    if not any(config.drift_model is not None for config in history):
+        if state:
+            session.delete(state)
+        return [], empty
+    checkpoint = restart_checkpoint(session, DriftCheckpoint, stream_id, since, record_id)
+    rows, filtered = _refilter(session, stream_id, history, checkpoint)
+    n_start = checkpoint.n_obs if checkpoint else 0
+    if not rows:
+        if checkpoint:
+            _store(session, state, stream_id, _stored(checkpoint), n_start, checkpoint.checkpoint_at)
+        elif state:
+            session.delete(state)
+        return [], empty
+    record_ids = [row[0] for row in rows]
+    _checkpoints(session, stream_id, record_ids, [row[1] for row in rows], n_start, filtered)
+    final = FilterState(*(column[-1] for column in filtered))
+    _store(session, state, stream_id, final, n_start + len(rows), rows[-1][1])
+    return record_ids, filtered
+
+
+def update_drift(
+    session: Session,
+    stream_id: str,
+    value: float,
+    timestamp: datetime,
+    config: StreamConfig,
+    record_id: Optional[int] = None,
+) -> dict:
+    state = session.exec(select(DriftState).where(DriftState.stream_id == stream_id)).first()
+    if record_id is not None and _is_late(state, timestamp):
+        record_ids, filtered = replay_drift_state(session, stream_id, timestamp, record_id)
+        i = record_ids.index(record_id)
+        return drift_fields(FilterState(*(column[i] for column in filtered)), config)
+    filtered = kalman_step(_stored(state) if state else initial_state(config), value, config)
+    n_obs = (state.n_obs if state else 0) + 1
+    _store(session, state, stream_id, filtered, n_obs, timestamp)
+    if record_id is not None and n_obs % CHECKPOINT_INTERVAL == 0:
+        session.add(_checkpoint(stream_id, record_id, timestamp, n_obs, filtered))
+    return drift_fields(filtered, config)
+
+
+def update_drift_batch(
+    session: Session,
+    stream_id: str,
+    values: np.ndarray,
+    timestamps: Sequence[datetime],
+    configs: Sequence[StreamConfig],
+    record_ids: Optional[Sequence[int]] = None,
+) -> list[dict]:
+    # update_drift over one stream's time-sorted batch; rows whose config has no drift model get {}.
+    rows = [i for i, config in enumerate(configs) if config.drift_model is not None]
+    fields: list[dict] = [{} for _ in range(len(values))]
+    if not rows:
+        return fields
+    state = session.exec(select(DriftState).where(DriftState.stream_id == stream_id)).first()
+    if record_ids is not None and _is_late(state, timestamps[rows[0]]):
+        replayed_ids, filtered = replay_drift_state(session, stream_id, timestamps[rows[0]], record_ids[rows[0]])
+        positions = {record_id: i for i, record_id in enumerate(replayed_ids)}
+        picked = [positions[record_ids[row]] for row in rows]
+    else:
+        versions, version = _version_index([configs[row] for row in rows])
+        start = _stored(state) if state else None
+        filtered = kalman_filter(np.asarray(values, dtype=float)[rows], versions, version, start)
+        final = FilterState(*(column[-1] for column in filtered))
+        n_start = state.n_obs if state else 0
+        _store(session, state, stream_id, final, n_start + len(rows), timestamps[rows[-1]])
+        if record_ids is not None:
+            row_ids = [record_ids[row] for row in rows]
+            _checkpoints(session, stream_id, row_ids, [timestamps[row] for row in rows], n_start, filtered)
+        picked = list(range(len(rows)))
+    for row, i in zip(rows, picked):
+        fields[row] = drift_fields(FilterState(*(column[i] for column in filtered)), configs[row])
+    return fields
@@ -1,12 +1,25 @@
 from __future__ import annotations
 
-from typing import List
+import math
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
 
-from sqlmodel import Session
+import numpy as np
+from sqlalchemy import and_, or_
+from sqlmodel import Session, select
 
-from app.db_models import DEFAULT_RULE_SET, StreamConfig
+from app.cache import WindowPoint, window_cache
+from app.db_models import DEFAULT_CUSUM, DEFAULT_EWMA, DEFAULT_RULE_SET, ControlChartState, QCRecord, StreamConfig
 from app.models import FrequentistSignal
-from app.storage import baseline_stats, get_recent_records
+from app.rules import CompiledRuleSet, compile_rules
+from app.storage import (
+    baseline_stats,
+    get_recent_records,
+    latest_window_points,
+    naive_timestamp,
+    stream_config_history,
+    utcnow,
+)
 
 
 def evaluate_rules(
@@ -15,49 +28,206 @@ def evaluate_rules(
     record_timestamp,
     stream_id: str,
     config: StreamConfig,
+    baseline: Optional[Tuple[float, float]] = None,
 ) -> List[FrequentistSignal]:
-    baseline = baseline_stats(session, config, record_timestamp)
+    if baseline is None:
+        baseline = baseline_stats(session, config, record_timestamp)
     if baseline is None:
         return [FrequentistSignal(rule="no-baseline", severity="warn", evidence="No baseline available for stream")]
 
     target, sigma = baseline
-    z_score = (record_value - target) / sigma
-    signals: List[FrequentistSignal] = []
-    rules = (config.rule_set or DEFAULT_RULE_SET).get("rules", [])
+    compiled = compile_rules(config)
+    # Only as much history as the longest enabled rule needs; none at all for single-point rules.
+    lookback = compiled.lookback
+    if lookback:
+        recent = window_cache.recent(stream_id, naive_timestamp(record_timestamp), lookback)
+        if recent is not None:
+            recent_values = [point.value for point in recent]
+        else:
+            recent_values = [
+                r.result_value for r in get_recent_records(session, stream_id, record_timestamp, limit=lookback)
+            ]
+    else:
+        recent_values = []
+    history = np.full((1, lookback), np.nan)
+    if recent_values:
+        history[0, lookback - len(recent_values) :] = recent_values
+    z = np.array([(record_value - target) / sigma])
+    return compiled.evaluate(z, (history - target) / sigma)[0]
+
+
+def remember_record(session: Session, record: QCRecord) -> None:
+    # Called after the record is committed so the window cache never holds rolled-back points.
+    point = WindowPoint(naive_timestamp(record.timestamp), record.result_value, record.include_in_stats)
+    if not window_cache.append(record.stream_id, point):
+        window_cache.load(record.stream_id, latest_window_points(session, record.stream_id, window_cache.capacity))
+
 
-    def _signal(rule: str, severity: str, evidence: str) -> None:
-        signals.append(FrequentistSignal(rule=rule, severity=severity, evidence=evidence))
+def rules_lookback(configs: Sequence[StreamConfig]) -> int:
+    return max((compile_rules(config).lookback for config in configs), default=0)
 
-    warn_limit = config.warning_limit_sd
-    action_limit = config.action_limit_sd
 
-    if "1-3s" in rules and abs(z_score) >= action_limit:
-        _signal("1-3s", "action", f"|z|={abs(z_score):.2f} exceeds action limit")
+def evaluate_rules_batch(
+    values: np.ndarray,
+    targets: np.ndarray,
+    sigmas: np.ndarray,
+    history: np.ndarray,
+    configs: Sequence[StreamConfig],
+) -> List[List[FrequentistSignal]]:
+    # Same rules as evaluate_rules for a whole batch. `history` holds at least rules_lookback(configs)
+    # preceding values of each row, oldest first and NaN-padded on the left. Rows sharing a compiled
+    # rule set are evaluated together.
+    z = (values - targets) / sigmas
+    recent_z = (history - targets[:, None]) / sigmas[:, None]
+    groups: dict[int, tuple[CompiledRuleSet, list[int]]] = {}
+    for i, config in enumerate(configs):
+        compiled = compile_rules(config)
+        groups.setdefault(id(compiled), (compiled, []))[1].append(i)
 
-    recent = get_recent_records(session, stream_id, record_timestamp, limit=9)
-    recent_z = [((r.result_value - target) / sigma, r) for r in recent]
+    results: List[List[FrequentistSignal]] = [[] for _ in range(len(values))]
+    for compiled, rows in groups.values():
+        for i, signals in zip(rows, compiled.evaluate(z[rows], recent_z[rows])):
+            results[i] = signals
+    return results
 
-    if "2-2s" in rules and abs(z_score) >= warn_limit and recent_z:
-        prev_z = recent_z[-1][0]
-        if (z_score >= warn_limit and prev_z >= warn_limit) or (z_score <= -warn_limit and prev_z <= -warn_limit):
-            direction = "high" if z_score > 0 else "low"
-            _signal("2-2s", "warn", f"Consecutive warning-level deviations in same direction ({direction})")
 
-    if "R-4s" in rules and recent_z:
-        prev_z = recent_z[-1][0]
-        if (z_score >= warn_limit and prev_z <= -warn_limit) or (z_score <= -warn_limit and prev_z >= warn_limit):
-            _signal("R-4s", "action", "Consecutive results exceed 4 SD range in opposite directions")
+def _chart_params(config: StreamConfig) -> tuple[float, float, float, float]:
+    # rule_set may override {"cusum": {"k", "h"}, "ewma": {"lambda", "L"}}, all in units of the baseline SD.
+    rule_set = config.rule_set or DEFAULT_RULE_SET
+    cusum = {**DEFAULT_CUSUM, **(rule_set.get("cusum") or {})}
+    ewma = {**DEFAULT_EWMA, **(rule_set.get("ewma") or {})}
+    return float(cusum["k"]), float(cusum["h"]), float(ewma["lambda"]), float(ewma["L"])
 
-    if "4-1s" in rules:
-        last_four = recent_z[-3:] + [(z_score, None)]
-        if len(last_four) == 4:
-            if all(z >= 1 for z, _ in last_four) or all(z <= -1 for z, _ in last_four):
-                _signal("4-1s", "warn", "Four consecutive results exceed 1 SD on the same side")
 
-    if "10x" in rules:
-        last_ten = recent_z[-9:] + [(z_score, None)]
-        if len(last_ten) == 10:
-            if all(z > 0 for z, _ in last_ten) or all(z < 0 for z, _ in last_ten):
-                _signal("10x", "warn", "Ten consecutive results on the same side of the mean")
+def _fold_chart(record: QCRecord, state: tuple[int, float, float, float], config: StreamConfig):
+    # One CUSUM/EWMA step on the record's z-score against the baseline stamped on it, stamping the result.
+    mean = record.baseline_mean if record.baseline_mean is not None else config.target_value
+    sd = record.baseline_sd if record.baseline_sd is not None else config.sigma
+    if not sd or sd <= 0:
+        return state
+    k, _, lam, width = _chart_params(config)
+    z = (record.result_value - mean) / sd
+    n, upper, lower, ewma = state
+    n += 1
+    upper = max(0.0, upper + z - k)
+    lower = max(0.0, lower - z - k)
+    ewma = lam * z + (1 - lam) * ewma
+    record.chart_n = n
+    record.cusum_upper = upper
+    record.cusum_lower = lower
+    record.ewma = ewma
+    record.ewma_limit = width * math.sqrt(lam / (2 - lam) * (1 - (1 - lam) ** (2 * n)))
+    return n, upper, lower, ewma
+
+
+def _clear_chart(record: QCRecord) -> None:
+    record.chart_n = None
+    record.cusum_upper = None
+    record.cusum_lower = None
+    record.ewma = None
+    record.ewma_limit = None
+
+
+def _save_chart_state(
+    session: Session,
+    stream_id: str,
+    chart: Optional[ControlChartState],
+    state: tuple[int, float, float, float],
+    last: Optional[QCRecord],
+) -> None:
+    if chart is None:
+        chart = ControlChartState(stream_id=stream_id)
+    chart.n, chart.cusum_upper, chart.cusum_lower, chart.ewma = state
+    chart.qc_record_id = last.id if last else None
+    chart.timestamp = naive_timestamp(last.timestamp) if last else None
+    chart.updated_at = utcnow()
+    session.add(chart)
 
+
+def replay_control_charts(
+    session: Session,
+    stream_id: str,
+    since: datetime,
+    record_id: Optional[int] = None,
+    commit: bool = True,
+) -> None:
+    # Every included record carries the chart state after it, so refolding starts from the last
+    # included record strictly before (since, record_id) rather than from the start of the stream.
+    at = naive_timestamp(since)
+    before = QCRecord.timestamp < at
+    if record_id is not None:
+        before = or_(before, and_(QCRecord.timestamp == at, QCRecord.id < record_id))
+    anchor = session.exec(
+        select(QCRecord)
+        .where(QCRecord.stream_id == stream_id, QCRecord.include_in_stats == True, before)
+        .order_by(QCRecord.timestamp.desc(), QCRecord.id.desc())
+        .limit(1)
+    ).first()
+    if anchor is not None and anchor.chart_n is None:
+        anchor = None
+
+    query = select(QCRecord).where(QCRecord.stream_id == stream_id).order_by(QCRecord.timestamp.asc(), QCRecord.id.asc())
+    if anchor is not None:
+        query = query.where(
+            or_(
+                QCRecord.timestamp > anchor.timestamp,
+                and_(QCRecord.timestamp == anchor.timestamp, QCRecord.id > anchor.id),
+            )
+        )
+        state = (anchor.chart_n, anchor.cusum_upper, anchor.cusum_lower, anchor.ewma)
+    else:
+        state = (0, 0.0, 0.0, 0.0)
+
+    history = stream_config_history(session, stream_id)
+    last = anchor
+    for record in session.exec(query).all():
+        if not record.include_in_stats:
+            _clear_chart(record)
+            continue
+        config = history.active_at(record.timestamp)
+        if config is not None:
+            state = _fold_chart(record, state, config)
+            last = record
+        session.add(record)
+    chart = session.exec(select(ControlChartState).where(ControlChartState.stream_id == stream_id)).first()
+    _save_chart_state(session, stream_id, chart, state, last)
+    if commit:
+        session.commit()
+
+
+def update_control_charts(session: Session, stream_id: str, records: Sequence[QCRecord]) -> None:
+    # `records` are newly flushed, included records of one stream in (timestamp, id) order. In-order
+    # points are one step each from the stored state; a late point refolds the records after it.
+    chart = session.exec(select(ControlChartState).where(ControlChartState.stream_id == stream_id)).first()
+    first = records[0]
+    if chart is None or (chart.timestamp is not None and naive_timestamp(first.timestamp) < chart.timestamp):
+        replay_control_charts(session, stream_id, first.timestamp, first.id, commit=False)
+        return
+    history = stream_config_history(session, stream_id)
+    state = (chart.n, chart.cusum_upper, chart.cusum_lower, chart.ewma)
+    for record in records:
+        state = _fold_chart(record, state, history.active_at(record.timestamp))
+    _save_chart_state(session, stream_id, chart, state, records[-1])
+
+
+def chart_signals(record: QCRecord, config: StreamConfig) -> List[FrequentistSignal]:
+    rules = (config.rule_set or DEFAULT_RULE_SET).get("rules", [])
+    if record.chart_n is None:
+        return []
+    _, h, _, _ = _chart_params(config)
+    signals: List[FrequentistSignal] = []
+    if "CUSUM" in rules:
+        for side, value in (("upper", record.cusum_upper), ("lower", record.cusum_lower)):
+            if value > h:
+                signals.append(
+                    FrequentistSignal(rule="CUSUM", severity="warn", evidence=f"{side} CUSUM {value:.2f} exceeds h={h:g}")
+                )
+    if "EWMA" in rules and abs(record.ewma) > record.ewma_limit:
+        signals.append(
+            FrequentistSignal(
+                rule="EWMA",
+                severity="warn",
+                evidence=f"EWMA {record.ewma:.2f} outside +/-{record.ewma_limit:.2f} SD",
+            )
+        )
     return signals
@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import math
+from datetime import datetime
+from typing import NamedTuple
+
+import numpy as np
+from sqlalchemy import func
+from sqlmodel import Session, select
+
+from app import bayesian, changepoint
+from app.db_models import HierarchyFit, QCRecord, StreamConfig, utcnow
+from app.models import PriorConfigIn
+from app.storage import (
+    LOT_ADJUSTED_VALUE,
+    create_prior_config,
+    naive_timestamp,
+    prior_config_history,
+    record_audit,
+)
+
+# Streams that run the same analyte, method and QC level form a group. Each stream's mean offset from its
+# target is drawn from N(offset, between_var) and each within-stream variance from an inverse gamma around
+# the pooled within variance. The moments are fitted for every group at once from per-stream sufficient
+# statistics, and streams with prior_pooling get the group's distribution as their NIG prior:
+#   mu0 = target + offset, kappa0 = within_var / between_var,
+#   alpha0 from the spread of the stream variances, beta0 = within_var * (alpha0 - 1),
+# all fitted without the stream's own data when it has any.
+GROUP_FIELDS = ("analyte", "method", "qc_level")
+# A pooled prior is worth at most this many runs of the stream's own data.
+KAPPA0_MAX = 20.0
+ALPHA0_MIN = 2.5
+ALPHA0_MAX = 25.0
+
+
+class Refit(NamedTuple):
+    fitted_at: datetime
+    fits: list[HierarchyFit]
+    pooled_streams: list[str]
+
+
+class GroupFit(NamedTuple):
+    streams: np.ndarray
+    points: np.ndarray
+    offset: np.ndarray
+    between_var: np.ndarray
+    within_var: np.ndarray
+    kappa0: np.ndarray
+    alpha0: np.ndarray
+
+
+def fit_groups(group: np.ndarray, n: np.ndarray, offset: np.ndarray, m2: np.ndarray, groups: int) -> GroupFit:
+    # One row per stream with at least two points; `group` indexes the stream's group. Groups with fewer
+    # than two such streams come out NaN.
+    def total(weights: np.ndarray) -> np.ndarray:
+        return np.bincount(group, weights=weights, minlength=groups)
+
+    streams = np.bincount(group, minlength=groups).astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        within_var = total(m2) / total(n - 1.0)
+        mean_offset = total(offset) / streams
+        # Method of moments: the spread of stream means less what their sampling noise explains.
+        spread = total((offset - mean_offset[group]) ** 2) / (streams - 1)
+        sampling = total(within_var[group] / n) / streams
+        between_var = np.maximum(spread - sampling, within_var / KAPPA0_MAX)
+        variances = m2 / (n - 1.0)
+        excess = total((variances - within_var[group]) ** 2) / (streams - 1) - total(
+            2 * within_var[group] ** 2 / (n - 1.0)
+        ) / streams
+        alpha0 = np.clip(2 + within_var**2 / np.where(excess > 0, excess, np.nan), ALPHA0_MIN, ALPHA0_MAX)
+    alpha0 = np.where(excess > 0, alpha0, ALPHA0_MAX)
+    fitted = streams >= 2
+    return GroupFit(
+        streams=streams,
+        points=total(n),
+        offset=np.where(fitted, mean_offset, np.nan),
+        between_var=np.where(fitted, between_var, np.nan),
+        within_var=np.where(fitted, within_var, np.nan),
+        kappa0=np.where(fitted, within_var / between_var, np.nan),
+        alpha0=np.where(fitted, alpha0, np.nan),
+    )
+
+
+def _latest_configs(session: Session) -> dict[str, StreamConfig]:
+    configs = session.exec(
+        select(StreamConfig).order_by(StreamConfig.stream_id, StreamConfig.effective_from, StreamConfig.version)
+    ).all()
+    return {config.stream_id: config for config in configs}
+
+
+def _stream_statistics(session: Session) -> dict[str, tuple[int, float, float, datetime]]:
+    # (n, sum, sum of squares, first timestamp) of the included points of every stream, in one aggregate,
+    # on the lot-adjusted scale the posterior folds.
+    value = LOT_ADJUSTED_VALUE
+    rows = session.exec(
+        select(QCRecord.stream_id, func.count(QCRecord.id), func.sum(value), func.sum(value * value), func.min(QCRecord.timestamp))
+        .where(QCRecord.include_in_stats == True)
+        .group_by(QCRecord.stream_id)
+    ).all()
+    return {row[0]: tuple(row[1:]) for row in rows}
+
+
+def _same_prior(prior, payload: PriorConfigIn) -> bool:
+    return prior is not None and all(
+        math.isclose(getattr(prior, field), getattr(payload, field), rel_tol=1e-9)
+        for field in ("mu0", "kappa0", "alpha0", "beta0")
+    )
+
+
+def refit_hierarchy(session: Session, created_by: str = "hierarchy") -> Refit:
+    # Refits every group, then gives each opted-in stream whose pooled prior changed a new prior version.
+    configs = _latest_configs(session)
+    statistics = _stream_statistics(session)
+    keys = sorted({tuple(getattr(config, field) for field in GROUP_FIELDS) for config in configs.values()})
+    index = {key: i for i, key in enumerate(keys)}
+
+    observed = [
+        stream_id for stream_id, config in configs.items() if statistics.get(stream_id, (0,))[0] >= 2
+    ]
+    group = np.array([index[tuple(getattr(configs[s], field) for field in GROUP_FIELDS)] for s in observed], dtype=int)
+    n = np.array([statistics[s][0] for s in observed], dtype=float)
+    total = np.array([statistics[s][1] for s in observed], dtype=float)
+    m2 = np.maximum(np.array([statistics[s][2] for s in observed], dtype=float) - total**2 / np.maximum(n, 1), 0.0)
+    offset = total / np.maximum(n, 1) - np.array([configs[s].target_value for s in observed], dtype=float)
+    fit = fit_groups(group, n, offset, m2, len(keys))
+    # An opted-in stream with data of its own is given its group refitted without it, so none of its data
+    # is counted twice; each such stream is its own group of the other streams' rows.
+    position = {stream_id: j for j, stream_id in enumerate(observed)}
+    held_out_streams = [s for s, config in configs.items() if config.prior_pooling and s in position]
+    rows = [
+        np.flatnonzero((group == group[position[s]]) & (np.arange(len(observed)) != position[s]))
+        for s in held_out_streams
+    ]
+    others = np.concatenate(rows) if rows else np.array([], dtype=int)
+    held_out = fit_groups(
+        np.repeat(np.arange(len(rows)), [len(r) for r in rows]),
+        n[others],
+        offset[others],
+        m2[others],
+        len(rows),
+    )
+    held_out_index = {stream_id: j for j, stream_id in enumerate(held_out_streams)}
+
+    fitted_at = naive_timestamp(utcnow())
+    fits = []
+    for key, i in index.items():
+        if not np.isfinite(fit.offset[i]):
+            continue
+        fits.append(
+            HierarchyFit(
+                **dict(zip(GROUP_FIELDS, key)),
+                streams=int(fit.streams[i]),
+                points=int(fit.points[i]),
+                offset=float(fit.offset[i]),
+                between_sd=math.sqrt(fit.between_var[i]),
+                within_sd=math.sqrt(fit.within_var[i]),
+                kappa0=float(fit.kappa0[i]),
+                alpha0=float(fit.alpha0[i]),
+                fitted_at=fitted_at,
+                created_by=created_by,
+            )
+        )
+    session.add_all(fits)
+    session.commit()
+
+    pooled = []
+    for stream_id, config in configs.items():
+        if not config.prior_pooling:
+            continue
+        if stream_id in held_out_index:
+            source, i = held_out, held_out_index[stream_id]
+        else:
+            source, i = fit, index[tuple(getattr(config, field) for field in GROUP_FIELDS)]
+        if not np.isfinite(source.offset[i]):
+            continue
+        alpha0 = float(source.alpha0[i])
+        payload = PriorConfigIn(
+            stream_id=stream_id,
+            mu0=config.target_value + float(source.offset[i]),
+            kappa0=float(source.kappa0[i]),
+            alpha0=alpha0,
+            beta0=float(source.within_var[i]) * (alpha0 - 1),
+            effective_from=_stream_start(session, stream_id, statistics),
+        )
+        priors = prior_config_history(session, stream_id)
+        if _same_prior(priors.active_at(payload.effective_from) if priors else None, payload):
+            continue
+        prior = create_prior_config(session, stream_id, payload, created_by)
+        record_audit(
+            session,
+            actor=created_by,
+            action="pool_prior",
+            entity_type="prior_config",
+            entity_id=str(prior.id),
+            before=None,
+            after=prior.model_dump(mode="json"),
+            reason="hierarchy refit",
+        )
+        # The pooled prior applies from the stream's first point, so the posterior is refolded under it.
+        bayesian.rebuild_posterior_state(session, stream_id)
+        changepoint.replay_changepoint_state(session, stream_id)
+        session.commit()
+        pooled.append(stream_id)
+    return Refit(fitted_at, fits, pooled)
+
+
+def _stream_start(session: Session, stream_id: str, statistics: dict) -> datetime:
+    first_config = session.exec(
+        select(func.min(StreamConfig.effective_from)).where(StreamConfig.stream_id == stream_id)
+    ).one()
+    starts = [naive_timestamp(first_config)]
+    if stream_id in statistics:
+        starts.append(naive_timestamp(statistics[stream_id][3]))
+    return min(starts)
+
+
+def latest_fits(session: Session) -> list[HierarchyFit]:
+    fitted_at = session.exec(select(func.max(HierarchyFit.fitted_at))).one()
+    if fitted_at is None:
+        return []
+    return session.exec(
+        select(HierarchyFit)
+        .where(HierarchyFit.fitted_at == fitted_at)
+        .order_by(*(getattr(HierarchyFit, field) for field in GROUP_FIELDS))
+    ).all()
+
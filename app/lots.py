@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import math
+from typing import Iterable, NamedTuple, Optional, Sequence
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, delete, select
+
+from app.cache import LotStats, check_out, lot_state_cache, stage
+from app.db_models import LotState, QCRecord, StreamConfig, utcnow
+from app.risk import bias_threshold
+from app.storage import stream_config_history
+
+# Lot-effect model. Each (control material lot, reagent lot) of a stream has its own offset from target:
+#   lot offset ~ N(pooled offset, between_var),   deviation from target | lot offset ~ N(lot offset, within_var).
+# The pooled offset and between-lot variance are fitted to the stream's lots by the method of moments, and a
+# lot's offset posterior is the normal-normal update of that pooled prior with the lot's own mean. A lot
+# without data gets the pooled prior as is, so the first point of a new lot is scored without a replay.
+# within_var is the lots' pooled variance once it has LOT_MIN_DF degrees of freedom, the config sigma^2 before.
+LOT_MIN_DF = 10
+# The pooled prior is worth at most this many runs of the lot's own data.
+LOT_KAPPA_MAX = 20.0
+_SQRT2 = math.sqrt(2.0)
+
+
+class PooledLotPrior(NamedTuple):
+    offset: float
+    between_var: float
+    within_var: float
+
+
+class LotOffset(NamedTuple):
+    mean: float
+    sd: float
+    probability_shift: float
+
+
+def lot_key(record) -> tuple[str, Optional[str]]:
+    return record.control_material_lot, record.reagent_lot
+
+
+def pooled_prior(lots: Iterable[LotStats], sigma: float) -> PooledLotPrior:
+    observed = [lot for lot in lots if lot.n]
+    df = sum(lot.n - 1 for lot in observed)
+    m2 = sum(lot.m2 for lot in observed)
+    within_var = m2 / df if df >= LOT_MIN_DF and m2 > 0 else sigma**2
+    if len(observed) < 2:
+        # Until there are two lots to compare, a lot is expected within one SD of target.
+        return PooledLotPrior(0.0, within_var, within_var)
+    offset = sum(lot.mean for lot in observed) / len(observed)
+    spread = sum((lot.mean - offset) ** 2 for lot in observed) / (len(observed) - 1)
+    sampling = sum(within_var / lot.n for lot in observed) / len(observed)
+    return PooledLotPrior(offset, max(spread - sampling, within_var / LOT_KAPPA_MAX), within_var)
+
+
+def lot_offset(lot: LotStats, prior: PooledLotPrior, threshold: float) -> LotOffset:
+    # Posterior of the lot's offset from target and P(|offset| > threshold).
+    precision = 1 / prior.between_var + lot.n / prior.within_var
+    mean = (prior.offset / prior.between_var + lot.n * lot.mean / prior.within_var) / precision
+    sd = math.sqrt(1 / precision)
+    shift = 0.5 * (math.erfc((threshold - mean) / (sd * _SQRT2)) + math.erfc((threshold + mean) / (sd * _SQRT2)))
+    return LotOffset(mean, sd, min(1.0, shift))
+
+
+def lot_fields(offset: LotOffset) -> dict:
+    return {"lot_offset": offset.mean, "lot_offset_sd": offset.sd, "probability_lot_shift": offset.probability_shift}
+
+
+def _load(session: Session, stream_id: str) -> dict[tuple, LotStats]:
+    states = session.exec(select(LotState).where(LotState.stream_id == stream_id).order_by(LotState.id)).all()
+    return {(state.control_material_lot, state.reagent_lot): LotStats(state.id, state.n, state.mean, state.m2) for state in states}
+
+
+def stream_lots(session: Session, stream_id: str) -> dict[tuple, LotStats]:
+    return lot_state_cache.get_or_load(stream_id, lambda: _load(session, stream_id))
+
+
+def _insert_lot(session: Session, stream_id: str, key: tuple, delta: LotStats) -> Optional[int]:
+    # The new lot's row id, or None when a concurrent ingest inserted the same lot first.
+    state = LotState(
+        stream_id=stream_id,
+        control_material_lot=key[0],
+        reagent_lot=key[1],
+        n=delta.n,
+        mean=delta.mean,
+        m2=delta.m2,
+    )
+    try:
+        with session.begin_nested():
+            session.add(state)
+    except IntegrityError:
+        return None
+    return state.id
+
+
+def _lot_row(session: Session, stream_id: str, key: tuple) -> Optional[int]:
+    return session.exec(
+        select(LotState.id).where(
+            LotState.stream_id == stream_id,
+            LotState.control_material_lot == key[0],
+            LotState.reagent_lot == key[1],
+        )
+    ).first()
+
+
+def _add_to_row(session: Session, stream_id: str, key: tuple, state_id: Optional[int], delta: LotStats) -> int:
+    # Adds the points in delta to the lot's row, inserting the row for a new lot; returns its id.
+    if state_id is None:
+        state_id = _insert_lot(session, stream_id, key, delta)
+        if state_id is not None:
+            return state_id
+        # Another ingest inserted the lot first: merge into its row like any existing lot.
+        state_id = _lot_row(session, stream_id, key)
+    # Chan's merge of the row's statistics with these points, evaluated by the database.
+    shift = delta.mean - LotState.mean
+    total = LotState.n + delta.n
+    session.exec(
+        update(LotState)
+        .where(LotState.id == state_id)
+        .values(
+            n=total,
+            mean=LotState.mean + shift * float(delta.n) / total,
+            m2=LotState.m2 + delta.m2 + shift * shift * LotState.n * float(delta.n) / total,
+            updated_at=utcnow(),
+        )
+    )
+    return state_id
+
+
+def _remove_from_row(session: Session, state_id: int, delta: LotStats) -> None:
+    # Chan's merge run backwards; a lot left without points is dropped, as a rebuild would.
+    session.exec(delete(LotState).where(LotState.id == state_id, LotState.n <= delta.n))
+    remaining = LotState.n - delta.n
+    mean = (LotState.n * LotState.mean - delta.n * delta.mean) / remaining
+    shift = delta.mean - mean
+    session.exec(
+        update(LotState)
+        .where(LotState.id == state_id, LotState.n > delta.n)
+        .values(
+            n=remaining,
+            mean=mean,
+            m2=LotState.m2 - delta.m2 - shift * shift * float(delta.n) * remaining / LotState.n,
+            updated_at=utcnow(),
+        )
+    )
+
+
+def update_lots(
+    session: Session,
+    stream_id: str,
+    records: Sequence[QCRecord],
+    configs: Sequence[StreamConfig],
+) -> list[Optional[LotOffset]]:
+    # Adds each record to its lot and scores it; None where the config does not run the lot model. The lot
+    # statistics are order-free sums, so late points need no replay. The transaction works on its own copy
+    # of the lots, checked back into lot_state_cache when it commits, and each LotState row is advanced by
+    # this transaction's points alone, so concurrent ingests of the stream both land, new lots included.
+    offsets: list[Optional[LotOffset]] = [None] * len(records)
+    rows = [i for i, config in enumerate(configs) if config.lot_model]
+    if not rows:
+        return offsets
+    lots = check_out(session, lot_state_cache, stream_id)
+    if lots is None:
+        lots = _load(session, stream_id)
+    added: dict[tuple, LotStats] = {}
+    for i in rows:
+        record, config = records[i], configs[i]
+        key = lot_key(record)
+        deviation = record.result_value - config.target_value
+        lots.setdefault(key, LotStats()).add(deviation)
+        added.setdefault(key, LotStats()).add(deviation)
+        offsets[i] = lot_offset(lots[key], pooled_prior(lots.values(), config.sigma), bias_threshold(config))
+    for key, delta in added.items():
+        lots[key].state_id = _add_to_row(session, stream_id, key, lots[key].state_id, delta)
+    stage(session, lot_state_cache, stream_id, lots)
+    return offsets
+
+
+def resolve_lots(session: Session, stream_id: str, records: Sequence[QCRecord], included: bool) -> None:
+    # Adds reinstated records to their lots, or removes excluded ones, in place of a rebuild of the stream.
+    history = stream_config_history(session, stream_id)
+    if not any(config.lot_model for config in history):
+        return
+    deltas: dict[tuple, LotStats] = {}
+    for record in records:
+        config = history.active_at(record.timestamp)
+        if config is not None and config.lot_model:
+            deltas.setdefault(lot_key(record), LotStats()).add(record.result_value - config.target_value)
+    if not deltas:
+        return
+    for key, delta in deltas.items():
+        state_id = _lot_row(session, stream_id, key)
+        if included:
+            _add_to_row(session, stream_id, key, state_id, delta)
+        elif state_id is not None:
+            _remove_from_row(session, state_id, delta)
+    # Dropped from the cache once the change commits, so no request reloads the old rows in between.
+    stage(session, lot_state_cache, stream_id, None)
@@ -2,30 +2,49 @@ from __future__ import annotations
 
 import csv
 import json
+import math
 import os
-from datetime import datetime, timezone
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
 from io import StringIO
 from typing import Optional
 from uuid import uuid4
 
-from fastapi import Depends, FastAPI, File, Header, HTTPException, UploadFile, status
+import numpy as np
+from fastapi import BackgroundTasks, Depends, FastAPI, File, Header, HTTPException, Query, UploadFile, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.docs import get_redoc_html, get_swagger_ui_html
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from sqlalchemy import update
 from sqlmodel import Session, select
 
-from app import bayesian, frequentist
+from app import backtest, bayesian, changepoint, drift, frequentist, hierarchy, lots, outbox, replay
+from app.cache import (
+    VersionHistory,
+    api_key_cache,
+    baseline_state_cache,
+    lot_state_cache,
+    prior_config_cache,
+    stream_config_cache,
+    window_cache,
+)
 from app.db import get_engine, get_session, init_db
 from app.db_models import (
     AlertRecord,
     Analyte,
+    ApiKey,
     AuditEntry,
+    BacktestRun,
     Capa,
     CapaLink,
+    IngestionReceipt,
     Instrument,
     Investigation,
     InvestigationAlertLink,
     Method,
+    PosteriorHistory,
     PriorConfig,
     QCEvent,
     QCRecord,
@@ -35,14 +54,27 @@ from app.models import (
     AnalyteIn,
     AnalyteOut,
     AnalyteUpdate,
+    ApiKeyOut,
     AlertOut,
     AlertStatus,
     AlertUpdate,
     AuditEntryOut,
+    BacktestIn,
+    BacktestOut,
+    BacktestStreamOut,
+    BatchIngestionItem,
+    BaselineMode,
+    BatchIngestionResult,
     CapaIn,
     CapaOut,
     CapaStatus,
+    ConfigSimulationIn,
+    ConfigSimulationOut,
+    DriftModel,
     DuplicateStatus,
+    HierarchyFitOut,
+    HierarchyRefitOut,
+    IngestionReceiptOut,
     IngestionResult,
     InstrumentIn,
     InstrumentOut,
@@ -50,6 +82,7 @@ from app.models import (
     InvestigationIn,
     InvestigationOut,
     InvestigationStatus,
+    LotOffsetOut,
     MethodIn,
     MethodOut,
     MethodUpdate,
@@ -60,13 +93,26 @@ from app.models import (
     QCEventOut,
     QCRecordIn,
     QCRecordOut,
+    QCRecordBulkResolutionIn,
+    QCRecordBulkResolutionItem,
+    QCRecordBulkResolutionResult,
     QCRecordResolutionIn,
     QCRecordResolutionOut,
+    ReplayIn,
+    ReplayOut,
+    SimulationSummary,
     StreamConfigIn,
     StreamConfigOut,
+    StreamLotsOut,
 )
 from app.rbac import UserContext, require_permission
+from app.risk import bias_threshold
+from app.rules import compile_rules
 from app.storage import (
+    AppliedBaseline,
+    add_to_baselines,
+    baseline_stats_batch,
+    build_stream_config,
     create_alert,
     create_capa,
     create_event,
@@ -74,17 +120,33 @@ from app.storage import (
     create_prior_config,
     create_stream_config,
     detect_duplicate,
+    detect_duplicates_batch,
     get_active_stream_config,
     get_idempotent_response,
+    included_run_before,
     list_stream_configs,
+    naive_timestamp,
+    prior_config_history,
     record_audit,
+    recent_value_windows,
+    refresh_baselines,
+    resolve_baseline,
+    resolve_rolling_baselines,
     seed_defaults,
     store_receipt,
+    stream_config_history,
+    stream_history_arrays,
+    stream_lot_offsets,
     update_alert,
     update_capa,
     update_investigation,
 )
 
+CSV_STREAM_BATCH_SIZE = 200
+QUEUE_BATCH_SIZE = 100
+
+_worker_pool: Optional[outbox.IngestionWorkerPool] = None
+
 app = FastAPI(title="Bayesian QC Prototype", version="0.2.0", docs_url=None, redoc_url=None)
 
 cors_origins = [
@@ -114,9 +176,23 @@ app.add_middleware(
 
 @app.on_event("startup")
 def startup() -> None:
+    global _worker_pool
     init_db()
     with Session(get_engine()) as session:
         seed_defaults(session)
+        outbox.requeue_stale(session)
+    workers = int(os.getenv("BAYESIANQC_QUEUE_WORKERS", "2"))
+    if workers > 0:
+        _worker_pool = outbox.IngestionWorkerPool(drain_ingestion_queue, workers)
+        _worker_pool.start()
+
+
+@app.on_event("shutdown")
+def shutdown() -> None:
+    global _worker_pool
+    if _worker_pool is not None:
+        _worker_pool.stop()
+        _worker_pool = None
 
 
 def _help_button(content: str) -> str:
@@ -291,6 +367,44 @@ def alert_severity(signals: list, risk_score: int, config: StreamConfig) -> str:
     return "info"
 
 
+POSTERIOR_SERIES_FIELDS = (
+    "mu_n",
+    "kappa_n",
+    "alpha_n",
+    "beta_n",
+    "probability_outside_limits",
+    "probability_bias_exceeded",
+    "risk_score",
+    "probability_outlier",
+)
+
+
+def _posterior_series(session: Session, stream_id: str, records: list[QCRecord]) -> dict[str, list]:
+    # Arrays aligned with `records`; None where a record was scored without a prior.
+    series: dict[str, list] = {field: [] for field in (*POSTERIOR_SERIES_FIELDS, "credible_lower", "credible_upper")}
+    if not records:
+        return series
+    rows = session.exec(
+        select(PosteriorHistory).where(
+            PosteriorHistory.stream_id == stream_id,
+            PosteriorHistory.timestamp >= records[0].timestamp,
+            PosteriorHistory.timestamp <= records[-1].timestamp,
+        )
+    ).all()
+    by_record = {row.qc_record_id: row for row in rows}
+    for record in records:
+        row = by_record.get(record.id)
+        for field in POSTERIOR_SERIES_FIELDS:
+            series[field].append(getattr(row, field) if row else None)
+        lower = upper = None
+        if row and row.alpha_n > 1 and row.kappa_n > 0:
+            stderr = math.sqrt(row.beta_n / (row.alpha_n - 1)) / math.sqrt(row.kappa_n)
+            lower, upper = row.mu_n - 1.96 * stderr, row.mu_n + 1.96 * stderr
+        series["credible_lower"].append(lower)
+        series["credible_upper"].append(upper)
+    return series
+
+
 def _lot_segments(records: list[QCRecord]) -> list[dict]:
     if not records:
         return []
@@ -357,6 +471,16 @@ def _alert_out(alert: AlertRecord) -> AlertOut:
     )
 
 
+def _api_key_out(api_key: ApiKey) -> ApiKeyOut:
+    return ApiKeyOut(
+        id=api_key.id,
+        role=api_key.role,
+        description=api_key.description,
+        created_at=api_key.created_at,
+        active=api_key.active,
+    )
+
+
 def _stream_out(config: StreamConfig) -> StreamConfigOut:
     return StreamConfigOut(**config.model_dump())
 
@@ -377,6 +501,17 @@ def _prior_out(config) -> PriorConfigOut:
     return PriorConfigOut(**config.model_dump())
 
 
+def _backtest_out(session: Session, run: BacktestRun, include_streams: bool = False) -> BacktestOut:
+    results = backtest.run_results(session, run.id)
+    return BacktestOut(
+        **run.model_dump(exclude={"stream_ids"}),
+        stream_count=len(run.stream_ids),
+        completed_streams=sum(result.status == "completed" for result in results),
+        failed_streams=sum(result.status == "failed" for result in results),
+        streams=[BacktestStreamOut(**result.model_dump()) for result in results] if include_streams else None,
+    )
+
+
 def _event_out(event: QCEvent) -> QCEventOut:
     return QCEventOut(
         id=event.id,
@@ -477,24 +612,51 @@ def validate_capa_fields(payload: CapaIn) -> None:
         raise HTTPException(status_code=422, detail="verification_plan is required for CAPA approval")
 
 
-def process_ingestion(
-    payload: QCRecordIn,
-    session: Session,
-    user: UserContext,
-    idempotency_key: Optional[str],
-) -> IngestionResult:
-    record_time = payload.timestamp
-    config = get_active_stream_config(session, payload.stream_id, record_time)
-    if not config:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Stream not configured")
+def _validate_stream_config(payload: StreamConfigIn) -> None:
+    if payload.baseline_mode == BaselineMode.ROLLING_WINDOW and not (payload.baseline_window_hours or 0) > 0:
+        raise HTTPException(status_code=422, detail="baseline_window_hours is required for a rolling_window baseline")
+    if payload.baseline_mode == BaselineMode.LAST_N_RUNS and not (payload.baseline_runs or 0) >= 2:
+        raise HTTPException(status_code=422, detail="baseline_runs of at least 2 is required for a last_n_runs baseline")
+    if payload.bias_threshold is not None and not payload.bias_threshold > 0:
+        raise HTTPException(status_code=422, detail="bias_threshold must be positive")
+    if payload.drift_model is not None:
+        if payload.drift_level_noise_sd < 0 or not payload.drift_delta_sd > 0:
+            raise HTTPException(status_code=422, detail="drift noise must be non-negative and drift_delta_sd positive")
+        key = "drift_rate_noise_sd" if payload.drift_model == DriftModel.LOCAL_TREND else "drift_level_noise_sd"
+        if not getattr(payload, key) > 0:
+            raise HTTPException(status_code=422, detail=f"{key} must be positive for a {payload.drift_model.value} model")
+    if payload.robust_contamination is not None:
+        if not 0 < payload.robust_contamination < 1 or not payload.robust_outlier_scale > 1:
+            raise HTTPException(
+                status_code=422, detail="robust_contamination must be in (0, 1) and robust_outlier_scale above 1"
+            )
+    params = changepoint.changepoint_params(payload)
+    if not 0 < params["hazard"] < 1 or int(params["window"]) < 1 or int(params["max_run_lengths"]) < 1:
+        raise HTTPException(
+            status_code=422, detail="changepoint needs 0 < hazard < 1 and a positive window and max_run_lengths"
+        )
+    try:
+        compile_rules(payload)
+    except ValueError as exc:
+        raise HTTPException(status_code=422, detail=str(exc)) from exc
+
 
+def _stamp_baseline(record: QCRecord, baseline: AppliedBaseline) -> None:
+    record.baseline_mode = baseline.mode
+    record.baseline_method = baseline.method
+    record.baseline_mean = baseline.mean
+    record.baseline_sd = baseline.sd
+    record.baseline_n = baseline.n
+
+
+def _prepare_record(payload: QCRecordIn, config: StreamConfig, idempotency_key: Optional[str]) -> QCRecord:
     if payload.qc_level != config.qc_level:
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="QC level does not match stream configuration")
 
     normalized_value, normalized_units = normalize_units(payload.result_value, payload.units, config)
     validate_bounds(normalized_value, config)
 
-    record = QCRecord(
+    return QCRecord(
         stream_id=payload.stream_id,
         timestamp=payload.timestamp,
         result_value=normalized_value,
@@ -516,29 +678,20 @@ def process_ingestion(
         idempotency_key=idempotency_key,
     )
 
-    duplicate_status = detect_duplicate(session, record)
-    record.duplicate_status = duplicate_status
-    session.add(record)
-    session.commit()
-    session.refresh(record)
 
-    signals = frequentist.evaluate_rules(
-        session,
-        record.result_value,
-        record.timestamp,
-        record.stream_id,
-        config,
-    )
-    risk = bayesian.infer_risk(
-        session,
-        record.result_value,
-        record.timestamp,
-        record.stream_id,
-        config,
-    )
+def _complete_ingestion(
+    session: Session,
+    payload: QCRecordIn,
+    record: QCRecord,
+    config: StreamConfig,
+    signals: list,
+    risk,
+    user: UserContext,
+    idempotency_key: Optional[str],
+) -> IngestionResult:
     disposition = determine_disposition(signals, risk.risk_score, config)
 
-    record_payload = payload.model_copy(update={"result_value": normalized_value, "units": normalized_units})
+    record_payload = payload.model_copy(update={"result_value": record.result_value, "units": record.units})
     qc_out = QCRecordOut(record=record_payload, signals=signals, bayesian_risk=risk, disposition=disposition)
 
     audit_entry = record_audit(
@@ -550,6 +703,7 @@ def process_ingestion(
         before=None,
         after=qc_out.model_dump(mode="json"),
         reason=payload.comments,
+        commit=False,
     )
 
     alert_out = None
@@ -565,24 +719,241 @@ def process_ingestion(
                 signals=[s.model_dump(mode="json") for s in signals],
                 bayesian_risk=risk.model_dump(mode="json"),
             ),
+            commit=False,
         )
         alert_out = _alert_out(alert_record)
 
     result = IngestionResult(
         status="accepted",
-        duplicate=duplicate_status,
+        duplicate=record.duplicate_status,
         qc=qc_out,
         alert_created=alert_out,
         audit_entry=_audit_out(audit_entry),
         idempotency_key=idempotency_key,
     )
-    store_receipt(session, idempotency_key, result.model_dump(mode="json"), record.id)
+    store_receipt(session, idempotency_key, result.model_dump(mode="json"), record.id, commit=False)
+    return result
+
+
+def process_ingestion(
+    payload: QCRecordIn,
+    session: Session,
+    user: UserContext,
+    idempotency_key: Optional[str],
+) -> IngestionResult:
+    record_time = payload.timestamp
+    config = get_active_stream_config(session, payload.stream_id, record_time)
+    if not config:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Stream not configured")
+
+    record = _prepare_record(payload, config, idempotency_key)
+    record.duplicate_status = detect_duplicate(session, record)
+
+    # The record, posterior update, audit entry, alert and receipt form one unit of work:
+    # a single flush assigns the record id and a single commit persists everything.
+    try:
+        session.add(record)
+        session.flush()
+        add_to_baselines(session, record.stream_id, [record.timestamp], [record.result_value])
+        baseline = resolve_baseline(session, config, record)
+        _stamp_baseline(record, baseline)
+        frequentist.update_control_charts(session, record.stream_id, [record])
+
+        signals = frequentist.evaluate_rules(
+            session,
+            record.result_value,
+            record.timestamp,
+            record.stream_id,
+            config,
+            baseline=(baseline.mean, baseline.sd),
+        )
+        signals += frequentist.chart_signals(record, config)
+        # The posterior sees the result less its lot's offset, so a lot change does not move it.
+        (offset,) = lots.update_lots(session, record.stream_id, [record], [config])
+        if offset is not None:
+            record.lot_offset = offset.mean
+        risk = bayesian.infer_risk(
+            session,
+            record.result_value - (record.lot_offset or 0.0),
+            record.timestamp,
+            record.stream_id,
+            config,
+            record_id=record.id,
+        )
+        probability = changepoint.update_changepoint(
+            session, record.stream_id, record.result_value, record.timestamp, config, record_id=record.id
+        )
+        if probability is not None:
+            risk = risk.model_copy(update={"probability_changepoint": probability})
+            signals += changepoint.changepoint_signals(probability, config)
+        if offset is not None:
+            risk = risk.model_copy(update=lots.lot_fields(offset))
+        result = _complete_ingestion(session, payload, record, config, signals, risk, user, idempotency_key)
+        session.commit()
+    except Exception:
+        session.rollback()
+        baseline_state_cache.invalidate(record.stream_id)
+        lot_state_cache.invalidate(record.stream_id)
+        raise
+    frequentist.remember_record(session, record)
     return result
 
 
+def process_ingestion_batch(
+    payloads: list[QCRecordIn],
+    session: Session,
+    user: UserContext,
+    commit: bool = True,
+) -> list[BatchIngestionItem]:
+    items: dict[int, BatchIngestionItem] = {}
+    by_stream: dict[str, list[int]] = {}
+    for index, payload in enumerate(payloads):
+        by_stream.setdefault(payload.stream_id, []).append(index)
+
+    # Each stream's rows are evaluated in timestamp order exactly as sequential ingestion would,
+    # with one config/prior resolution, one window query and one posterior write per stream.
+    try:
+        for stream_id, indices in by_stream.items():
+            indices.sort(key=lambda i: naive_timestamp(payloads[i].timestamp))
+            history = stream_config_history(session, stream_id)
+            rows = []
+            for index in indices:
+                payload = payloads[index]
+                config = history.active_at(payload.timestamp)
+                try:
+                    if not config:
+                        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Stream not configured")
+                    record = _prepare_record(payload, config, None)
+                except HTTPException as exc:
+                    items[index] = BatchIngestionItem(index=index, status="error", error=str(exc.detail))
+                    continue
+                rows.append((index, payload, config, record))
+            if not rows:
+                continue
+
+            records = [row[3] for row in rows]
+            configs = [row[2] for row in rows]
+            values = np.array([record.result_value for record in records], dtype=float)
+            timestamps = [record.timestamp for record in records]
+            for record, duplicate_status in zip(records, detect_duplicates_batch(session, records)):
+                record.duplicate_status = duplicate_status
+            baselines = baseline_stats_batch(session, configs, values, timestamps)
+            history_values = recent_value_windows(
+                session, stream_id, timestamps, values, frequentist.rules_lookback(configs)
+            )
+
+            session.add_all(records)
+            session.flush()
+            add_to_baselines(session, stream_id, timestamps, values)
+            for i, baseline in resolve_rolling_baselines(session, configs, records).items():
+                baselines[i] = baseline
+            for record, baseline in zip(records, baselines):
+                _stamp_baseline(record, baseline)
+            frequentist.update_control_charts(session, stream_id, records)
+            targets = np.array([baseline.mean for baseline in baselines], dtype=float)
+            sigmas = np.array([baseline.sd for baseline in baselines], dtype=float)
+
+            signals = frequentist.evaluate_rules_batch(values, targets, sigmas, history_values, configs)
+            for record_signals, config, record in zip(signals, configs, records):
+                record_signals += frequentist.chart_signals(record, config)
+            offsets = lots.update_lots(session, stream_id, records, configs)
+            for record, offset in zip(records, offsets):
+                if offset is not None:
+                    record.lot_offset = offset.mean
+            adjusted = values - np.array([record.lot_offset or 0.0 for record in records], dtype=float)
+            risks = bayesian.infer_risk_batch(
+                session, adjusted, timestamps, stream_id, configs, record_ids=[record.id for record in records]
+            )
+            probabilities = changepoint.update_changepoints_batch(
+                session, stream_id, values, timestamps, configs, record_ids=[record.id for record in records]
+            )
+            for i, probability in enumerate(probabilities):
+                if probability is not None:
+                    risks[i] = risks[i].model_copy(update={"probability_changepoint": probability})
+                    signals[i] += changepoint.changepoint_signals(probability, configs[i])
+            for i, offset in enumerate(offsets):
+                if offset is not None:
+                    risks[i] = risks[i].model_copy(update=lots.lot_fields(offset))
+            for (index, payload, config, record), record_signals, risk in zip(rows, signals, risks):
+                result = _complete_ingestion(session, payload, record, config, record_signals, risk, user, None)
+                items[index] = BatchIngestionItem(index=index, status="accepted", result=result, record_id=record.id)
+        if commit:
+            session.commit()
+    except Exception:
+        session.rollback()
+        for stream_id in by_stream:
+            baseline_state_cache.invalidate(stream_id)
+            lot_state_cache.invalidate(stream_id)
+        raise
+    if commit:
+        for stream_id in by_stream:
+            window_cache.invalidate(stream_id)
+    return [items[index] for index in range(len(payloads))]
+
+
+def drain_ingestion_queue(limit: int = QUEUE_BATCH_SIZE) -> int:
+    with Session(get_engine(), expire_on_commit=False) as session:
+        items = outbox.claim_batch(session, limit)
+        if not items:
+            return 0
+        try:
+            # Consecutive items enqueued by the same role are ingested as one batch; the records,
+            # receipts and outbox updates of the whole claim commit together.
+            start = 0
+            while start < len(items):
+                end = start
+                while end < len(items) and items[end].actor_role == items[start].actor_role:
+                    end += 1
+                group = items[start:end]
+                payloads = [QCRecordIn.model_validate(item.payload) for item in group]
+                results = process_ingestion_batch(payloads, session, UserContext(role=group[0].actor_role), commit=False)
+                for item, batch_item in zip(group, results):
+                    outbox.complete_item(session, item, batch_item.result, batch_item.error, batch_item.record_id)
+                start = end
+            session.commit()
+            window_cache.invalidate(items[0].stream_id)
+        except Exception as exc:  # noqa: BLE001 - the claim is retried as a whole
+            session.rollback()
+            baseline_state_cache.invalidate(items[0].stream_id)
+            lot_state_cache.invalidate(items[0].stream_id)
+            outbox.retry_items(session, items, str(exc))
+        finally:
+            outbox.release_stream(items[0].stream_id)
+        return len(items)
+
+
+def _receipt_out(receipt: IngestionReceipt) -> IngestionReceiptOut:
+    return IngestionReceiptOut(
+        id=receipt.id,
+        status=receipt.status,
+        idempotency_key=receipt.idempotency_key,
+        created_at=receipt.created_at,
+        completed_at=receipt.completed_at,
+        qc_record_id=receipt.qc_record_id,
+        response=receipt.response or None,
+        error=receipt.error,
+    )
+
+
+def _pending_receipt_response(receipt: IngestionReceipt) -> JSONResponse:
+    return JSONResponse(
+        status_code=status.HTTP_202_ACCEPTED,
+        content=_receipt_out(receipt).model_dump(mode="json"),
+    )
+
+
+def _failed_receipt_response(receipt: IngestionReceipt) -> JSONResponse:
+    # A failed receipt has no result to replay; the key is spent, so a retry needs a new one.
+    return JSONResponse(
+        status_code=status.HTTP_409_CONFLICT,
+        content=_receipt_out(receipt).model_dump(mode="json"),
+    )
+
+
 @app.post("/qc/records", response_model=IngestionResult)
 async def ingest_qc_record(
     payload: QCRecordIn,
+    async_mode: bool = Query(default=False, alias="async"),
     idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
     user: UserContext = Depends(require_permission(Permission.INGEST_QC)),
     session: Session = Depends(get_session),
@@ -590,18 +961,109 @@ async def ingest_qc_record(
     if idempotency_key:
         receipt = get_idempotent_response(session, idempotency_key)
         if receipt:
+            if receipt.status == "pending":
+                return _pending_receipt_response(receipt)
+            if receipt.status == "failed":
+                return _failed_receipt_response(receipt)
             return receipt.response
+    if async_mode:
+        receipt = outbox.enqueue_record(session, payload, user.role, idempotency_key)
+        return _pending_receipt_response(receipt)
     return process_ingestion(payload, session, user, idempotency_key)
 
 
+@app.get("/qc/receipts/{receipt_id}", response_model=IngestionReceiptOut)
+async def get_receipt(
+    receipt_id: int,
+    user: UserContext = Depends(require_permission(Permission.INGEST_QC)),
+    session: Session = Depends(get_session),
+):
+    receipt = session.exec(select(IngestionReceipt).where(IngestionReceipt.id == receipt_id)).first()
+    if not receipt:
+        raise HTTPException(status_code=404, detail="Receipt not found")
+    return _receipt_out(receipt)
+
+
+@app.post("/qc/records/batch", response_model=BatchIngestionResult)
+async def ingest_qc_records_batch(
+    payload: list[QCRecordIn],
+    user: UserContext = Depends(require_permission(Permission.INGEST_QC)),
+    session: Session = Depends(get_session),
+):
+    items = process_ingestion_batch(payload, session, user)
+    accepted = sum(1 for item in items if item.status == "accepted")
+    return BatchIngestionResult(accepted=accepted, errors=len(items) - accepted, results=items)
+
+
+def _csv_row_line(row: int, item: BatchIngestionItem) -> dict:
+    if item.status != "accepted":
+        return {"type": "row", "row": row, "status": "error", "error": item.error}
+    result = item.result
+    return {
+        "type": "row",
+        "row": row,
+        "status": "accepted",
+        "duplicate": result.duplicate.value,
+        "disposition": result.qc.disposition,
+        "risk_score": result.qc.bayesian_risk.risk_score,
+        "signals": [signal.rule for signal in result.qc.signals],
+        "alert_id": result.alert_created.id if result.alert_created else None,
+    }
+
+
+def _stream_csv_ingestion(path: str, user: UserContext, batch_size: int):
+    # Rows are read lazily from the spooled upload and ingested in bounded batches,
+    # so memory stays flat regardless of file size.
+    counts = {"rows": 0, "accepted": 0, "errors": 0}
+
+    def _flush(session: Session, pending: list[tuple[int, QCRecordIn]]):
+        try:
+            items = process_ingestion_batch([payload for _, payload in pending], session, user)
+        except Exception as exc:  # noqa: BLE001 - report the failed batch row by row
+            items = [BatchIngestionItem(index=i, status="error", error=str(exc)) for i in range(len(pending))]
+        for (row, _), item in zip(pending, items):
+            counts["accepted" if item.status == "accepted" else "errors"] += 1
+            yield json.dumps(_csv_row_line(row, item)) + "\n"
+
+    try:
+        with open(path, encoding="utf-8", newline="") as handle, Session(get_engine(), expire_on_commit=False) as session:
+            pending: list[tuple[int, QCRecordIn]] = []
+            for idx, row in enumerate(csv.DictReader(handle), start=1):
+                counts["rows"] += 1
+                try:
+                    pending.append((idx, parse_csv_row(row)))
+                except Exception as exc:  # noqa: BLE001 - report row-level errors
+                    counts["errors"] += 1
+                    yield json.dumps({"type": "row", "row": idx, "status": "error", "error": str(exc)}) + "\n"
+                    continue
+                if len(pending) >= batch_size:
+                    yield from _flush(session, pending)
+                    pending = []
+            if pending:
+                yield from _flush(session, pending)
+    finally:
+        os.unlink(path)
+    yield json.dumps({"type": "summary", **counts}) + "\n"
+
+
 @app.post("/qc/records/csv")
 async def ingest_qc_records_csv(
     file: UploadFile = File(...),
+    stream: bool = False,
+    batch_size: int = Query(default=CSV_STREAM_BATCH_SIZE, ge=1, le=1000),
     user: UserContext = Depends(require_permission(Permission.INGEST_QC)),
     session: Session = Depends(get_session),
 ):
     if not file.filename or not file.filename.lower().endswith(".csv"):
         raise HTTPException(status_code=400, detail="CSV file required")
+    if stream:
+        # The upload is closed once this handler returns, so copy it to a file the stream owns.
+        with tempfile.NamedTemporaryFile(prefix="bayesianqc-", suffix=".csv", delete=False) as spool:
+            shutil.copyfileobj(file.file, spool)
+        return StreamingResponse(
+            _stream_csv_ingestion(spool.name, user, batch_size),
+            media_type="application/x-ndjson",
+        )
     content = (await file.read()).decode("utf-8")
     reader = csv.DictReader(StringIO(content))
     results = []
@@ -615,6 +1077,99 @@ async def ingest_qc_records_csv(
     return {"accepted": len(results), "errors": errors, "results": results}
 
 
+@app.patch("/qc/records/resolution", response_model=QCRecordBulkResolutionResult)
+async def resolve_qc_records_bulk(
+    payload: QCRecordBulkResolutionIn,
+    user: UserContext = Depends(require_permission(Permission.APPROVE)),
+    session: Session = Depends(get_session),
+):
+    if payload.record_ids is None and payload.stream_id is None:
+        raise HTTPException(status_code=422, detail="record_ids or stream_id is required")
+    query = select(QCRecord)
+    if payload.record_ids is not None:
+        query = query.where(QCRecord.id.in_(payload.record_ids))
+    if payload.stream_id is not None:
+        query = query.where(QCRecord.stream_id == payload.stream_id)
+    if payload.start is not None:
+        query = query.where(QCRecord.timestamp >= naive_timestamp(payload.start))
+    if payload.end is not None:
+        query = query.where(QCRecord.timestamp <= naive_timestamp(payload.end))
+    records = session.exec(query.order_by(QCRecord.timestamp.asc(), QCRecord.id.asc())).all()
+
+    changed = [record for record in records if record.include_in_stats != payload.include_in_stats]
+    befores = {record.id: record.model_dump(mode="json") for record in changed}
+    if payload.include_in_stats:
+        values = {"include_in_stats": True, "resolved_at": None, "resolved_by": None, "resolved_reason": None}
+    else:
+        values = {
+            "include_in_stats": False,
+            "resolved_at": datetime.now(timezone.utc),
+            "resolved_by": user.role.value,
+            "resolved_reason": payload.resolved_reason,
+        }
+
+    # One UPDATE, one audit entry per changed record and one replay per stream, all in one transaction.
+    earliest: dict[str, QCRecord] = {}
+    try:
+        if changed:
+            session.exec(update(QCRecord).where(QCRecord.id.in_(list(befores))).values(**values))
+        for record in changed:
+            record_audit(
+                session=session,
+                actor=user.role.value,
+                action="resolve_qc_record",
+                entity_type="qc_record",
+                entity_id=str(record.id),
+                before=befores[record.id],
+                after=record.model_dump(mode="json"),
+                reason=payload.resolved_reason,
+                commit=False,
+            )
+            earliest.setdefault(record.stream_id, record)
+        for stream_id, record in earliest.items():
+            refresh_baselines(session, stream_id, [other for other in changed if other.stream_id == stream_id])
+            bayesian.replay_posterior_state(session, stream_id, record.timestamp, record.id, commit=False)
+            drift.replay_drift_state(session, stream_id, record.timestamp, record.id)
+            changepoint.replay_changepoint_state(session, stream_id, record.timestamp, record.id)
+            stream_changed = [other for other in changed if other.stream_id == stream_id]
+            lots.resolve_lots(session, stream_id, stream_changed, payload.include_in_stats)
+            frequentist.replay_control_charts(session, stream_id, record.timestamp, record.id, commit=False)
+        session.commit()
+    except Exception:
+        session.rollback()
+        # The replays may have cached state the rollback discarded.
+        for stream_id in {record.stream_id for record in changed}:
+            window_cache.invalidate(stream_id)
+            baseline_state_cache.invalidate(stream_id)
+            lot_state_cache.invalidate(stream_id)
+        raise
+    for stream_id in earliest:
+        window_cache.invalidate(stream_id)
+        baseline_state_cache.invalidate(stream_id)
+
+    found = {record.id: record for record in records}
+    ordered_ids = payload.record_ids if payload.record_ids is not None else list(found)
+    results = []
+    for record_id in dict.fromkeys(ordered_ids):
+        record = found.get(record_id)
+        if record is None:
+            results.append(QCRecordBulkResolutionItem(record_id=record_id, status="not_found"))
+        else:
+            results.append(
+                QCRecordBulkResolutionItem(
+                    record_id=record_id,
+                    status="updated" if record_id in befores else "unchanged",
+                    record=_qc_record_resolution_out(record),
+                )
+            )
+    return QCRecordBulkResolutionResult(
+        updated=len(befores),
+        unchanged=sum(1 for item in results if item.status == "unchanged"),
+        not_found=sum(1 for item in results if item.status == "not_found"),
+        results=results,
+    )
+
+
 @app.patch("/qc/records/{record_id}/resolution", response_model=QCRecordResolutionOut)
 async def resolve_qc_record(
     record_id: int,
@@ -639,6 +1194,8 @@ async def resolve_qc_record(
     session.add(record)
     session.commit()
     session.refresh(record)
+    window_cache.invalidate(record.stream_id)
+    baseline_state_cache.invalidate(record.stream_id)
     record_audit(
         session=session,
         actor=user.role.value,
@@ -649,10 +1206,26 @@ async def resolve_qc_record(
         after=record.model_dump(mode="json"),
         reason=payload.resolved_reason,
     )
-    bayesian.rebuild_posterior_state(session, record.stream_id)
+    if before["include_in_stats"] != record.include_in_stats:
+        refresh_baselines(session, record.stream_id, [record])
+        lots.resolve_lots(session, record.stream_id, [record], record.include_in_stats)
+    bayesian.replay_posterior_state(session, record.stream_id, record.timestamp, record.id)
+    drift.replay_drift_state(session, record.stream_id, record.timestamp, record.id)
+    changepoint.replay_changepoint_state(session, record.stream_id, record.timestamp, record.id)
+    session.commit()
+    frequentist.replay_control_charts(session, record.stream_id, record.timestamp, record.id)
     return _qc_record_resolution_out(record)
 
 
+@app.get("/api-keys", response_model=list[ApiKeyOut])
+async def list_api_keys(
+    user: UserContext = Depends(require_permission(Permission.EDIT_CONFIG)),
+    session: Session = Depends(get_session),
+):
+    api_keys = session.exec(select(ApiKey).order_by(ApiKey.created_at.asc())).all()
+    return [_api_key_out(api_key) for api_key in api_keys]
+
+
 @app.get("/instruments", response_model=list[InstrumentOut])
 async def list_instruments(
     active: Optional[bool] = None,
@@ -898,6 +1471,7 @@ async def create_stream(
     user: UserContext = Depends(require_permission(Permission.EDIT_CONFIG)),
     session: Session = Depends(get_session),
 ):
+    _validate_stream_config(payload)
     config = create_stream_config(session, payload, user.role.value)
     record_audit(
         session,
@@ -920,6 +1494,7 @@ async def create_stream_version(
     session: Session = Depends(get_session),
 ):
     payload = payload.model_copy(update={"stream_id": stream_id})
+    _validate_stream_config(payload)
     config = create_stream_config(session, payload, user.role.value)
     record_audit(
         session,
@@ -934,6 +1509,102 @@ async def create_stream_version(
     return _stream_out(config)
 
 
+def _simulation_summary(
+    result: replay.ReplayResult, dispositions: np.ndarray, rows: np.ndarray, include_series: bool
+) -> SimulationSummary:
+    dispositions = dispositions[rows]
+    counts = {name: int(np.count_nonzero(dispositions == name)) for name in ("accept", "monitor", "hold-for-review", "reject")}
+    series = None
+    if include_series:
+        series = {**replay.replay_series(result, rows), "disposition": dispositions.tolist()}
+    return SimulationSummary(
+        signal_counts=replay.signal_counts(result, rows),
+        dispositions=counts,
+        alerts=len(rows) - counts["accept"],
+        action_alerts=counts["hold-for-review"] + counts["reject"],
+        max_risk_score=int(result.risk_score[rows].max()) if len(rows) else 0,
+        series=series,
+    )
+
+
+def _simulation_start(session: Session, stream_id: str, start: datetime, configs: list) -> Optional[datetime]:
+    # Earliest record time the rows from `start` look back to under these configs; None for the whole stream.
+    runs, hours, fixed_start = replay.warmup(configs)
+    earliest = included_run_before(session, stream_id, start, runs)
+    if earliest is None:
+        return None
+    since = min(naive_timestamp(earliest), start - timedelta(hours=hours))
+    return since if fixed_start is None else min(since, fixed_start)
+
+
+@app.post("/streams/{stream_id}/configs/simulate", response_model=ConfigSimulationOut)
+async def simulate_stream_config(
+    stream_id: str,
+    payload: ConfigSimulationIn,
+    user: UserContext = Depends(require_permission(Permission.EDIT_CONFIG)),
+    session: Session = Depends(get_session),
+):
+    # What-if for a config version before it is published: the stream is replayed in memory as if the
+    # candidate had taken effect at the start of the window, with the candidate prior (if any) in place of
+    # the prior history. Nothing is written and no cache is touched.
+    proposed_in = payload.config.model_copy(update={"stream_id": stream_id})
+    _validate_stream_config(proposed_in)
+    history = stream_config_history(session, stream_id)
+    configs = history.versions
+    if not configs:
+        raise HTTPException(status_code=404, detail="Stream not configured")
+    started = time.perf_counter()
+    end = naive_timestamp(datetime.now(timezone.utc))
+    start = end - timedelta(days=payload.days)
+    proposed = build_stream_config(
+        proposed_in.model_copy(update={"effective_from": start}), configs[-1].version + 1, user.role.value
+    )
+    proposed_configs = [config for config in configs if naive_timestamp(config.effective_from) < start] + [proposed]
+    prior_history = prior_config_history(session, stream_id)
+    priors = prior_history.versions
+    proposed_priors = priors
+    if payload.prior is not None:
+        proposed_priors = [PriorConfig(stream_id=stream_id, **payload.prior.model_dump(exclude={"stream_id", "effective_from"}))]
+
+    # Only the window is reported, so both sides replay it from a warm-up before it, seeded with the
+    # sequential state as of the warm-up. Versions before `start` are the same on both sides, and so is
+    # that state, except the posterior under a candidate prior.
+    window_configs = [history.active_at(start), proposed] + [
+        config for config in configs if naive_timestamp(config.effective_from) >= start
+    ]
+    since = _simulation_start(session, stream_id, start, window_configs)
+    current_seed = candidate_seed = None
+    if since is not None:
+        current_seed = replay.ReplaySeed(
+            bayesian.posterior_before(session, stream_id, since, prior_history),
+            drift.state_before(session, stream_id, since),
+            changepoint.state_before(session, stream_id, since),
+        )
+        candidate_seed = current_seed
+        if payload.prior is not None:
+            posterior = bayesian.posterior_before(session, stream_id, since, VersionHistory(proposed_priors))
+            candidate_seed = current_seed._replace(posterior=posterior)
+    times, values, included = stream_history_arrays(session, stream_id, since)
+    offsets = stream_lot_offsets(session, stream_id, since)
+    current = replay.replay_stream(values, times, configs, priors, included, offsets, current_seed)
+    candidate = replay.replay_stream(
+        values, times, proposed_configs, proposed_priors, included, offsets, candidate_seed
+    )
+    rows = np.flatnonzero(times >= np.datetime64(start, "us"))
+    current_dispositions = replay.replay_dispositions(current, configs)
+    candidate_dispositions = replay.replay_dispositions(candidate, proposed_configs)
+    return ConfigSimulationOut(
+        stream_id=stream_id,
+        start=start,
+        end=end,
+        points=len(rows),
+        current=_simulation_summary(current, current_dispositions, rows, payload.include_series),
+        candidate=_simulation_summary(candidate, candidate_dispositions, rows, payload.include_series),
+        changed_dispositions=int(np.count_nonzero(current_dispositions[rows] != candidate_dispositions[rows])),
+        elapsed_ms=(time.perf_counter() - started) * 1000,
+    )
+
+
 @app.post("/streams/{stream_id}/priors", response_model=PriorConfigOut)
 async def create_prior(
     stream_id: str,
@@ -968,6 +1639,176 @@ async def list_priors(
     return [_prior_out(prior) for prior in priors]
 
 
+@app.get("/streams/{stream_id}/lots", response_model=StreamLotsOut)
+async def list_stream_lots(
+    stream_id: str,
+    user: UserContext = Depends(require_permission(Permission.INGEST_QC)),
+    session: Session = Depends(get_session),
+):
+    config = get_active_stream_config(session, stream_id, datetime.now(timezone.utc))
+    if not config:
+        raise HTTPException(status_code=404, detail="Stream not configured")
+    stream_lots = lots.stream_lots(session, stream_id)
+    prior = lots.pooled_prior(stream_lots.values(), config.sigma)
+    threshold = bias_threshold(config)
+    return StreamLotsOut(
+        stream_id=stream_id,
+        pooled_offset=prior.offset,
+        between_lot_sd=math.sqrt(prior.between_var),
+        within_lot_sd=math.sqrt(prior.within_var),
+        lots=[
+            LotOffsetOut(
+                control_material_lot=control_material_lot,
+                reagent_lot=reagent_lot,
+                n=lot.n,
+                mean=lot.mean,
+                **lots.lot_fields(lots.lot_offset(lot, prior, threshold)),
+            )
+            for (control_material_lot, reagent_lot), lot in stream_lots.items()
+        ],
+    )
+
+
+@app.post("/hierarchy/refit", response_model=HierarchyRefitOut)
+async def refit_hierarchy(
+    user: UserContext = Depends(require_permission(Permission.EDIT_CONFIG)),
+    session: Session = Depends(get_session),
+):
+    refit = hierarchy.refit_hierarchy(session, user.role.value)
+    return HierarchyRefitOut(
+        fitted_at=refit.fitted_at,
+        groups=[HierarchyFitOut.model_validate(fit.model_dump()) for fit in refit.fits],
+        pooled_streams=refit.pooled_streams,
+    )
+
+
+@app.get("/hierarchy", response_model=list[HierarchyFitOut])
+async def get_hierarchy(
+    user: UserContext = Depends(require_permission(Permission.INGEST_QC)),
+    session: Session = Depends(get_session),
+):
+    return [HierarchyFitOut.model_validate(fit.model_dump()) for fit in hierarchy.latest_fits(session)]
+
+
+@app.post("/streams/{stream_id}/replay", response_model=ReplayOut)
+async def replay_stream_history(
+    stream_id: str,
+    payload: ReplayIn,
+    user: UserContext = Depends(require_permission(Permission.EDIT_CONFIG)),
+    session: Session = Depends(get_session),
+):
+    # Read-only: the whole stream is replayed so baselines and the posterior see all earlier points,
+    # and start/end only select which rows are reported.
+    configs = stream_config_history(session, stream_id).versions
+    if not configs:
+        raise HTTPException(status_code=404, detail="Stream not configured")
+    started = time.perf_counter()
+    times, values, included = stream_history_arrays(session, stream_id)
+    offsets = stream_lot_offsets(session, stream_id)
+    result = replay.replay_stream(
+        values, times, configs, prior_config_history(session, stream_id).versions, included, offsets
+    )
+    selected = np.ones(len(values), dtype=bool)
+    if payload.start is not None:
+        selected &= times >= np.datetime64(naive_timestamp(payload.start), "us")
+    if payload.end is not None:
+        selected &= times <= np.datetime64(naive_timestamp(payload.end), "us")
+    rows = np.flatnonzero(selected)
+    return ReplayOut(
+        stream_id=stream_id,
+        points=len(rows),
+        signal_counts=replay.signal_counts(result, rows),
+        max_risk_score=int(result.risk_score[rows].max()) if len(rows) else 0,
+        elapsed_ms=(time.perf_counter() - started) * 1000,
+        series=replay.replay_series(result, rows) if payload.include_series else None,
+    )
+
+
+def _execute_backtest(run_id: int) -> None:
+    with Session(get_engine()) as session:
+        backtest.run_backtest(session, run_id)
+
+
+@app.post("/backtests", response_model=BacktestOut)
+async def create_backtest(
+    payload: BacktestIn,
+    background_tasks: BackgroundTasks,
+    user: UserContext = Depends(require_permission(Permission.EDIT_CONFIG)),
+    session: Session = Depends(get_session),
+):
+    configured = backtest.configured_streams(session)
+    stream_ids = list(dict.fromkeys(payload.stream_ids)) if payload.stream_ids is not None else configured
+    unknown = sorted(set(stream_ids) - set(configured))
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Streams not configured: {', '.join(unknown)}")
+    if not stream_ids:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="No streams to backtest")
+    candidate = payload.candidate.model_dump(mode="json")
+    try:
+        for stream_id in stream_ids:
+            for config in backtest.candidate_configs(stream_config_history(session, stream_id).versions, candidate):
+                compile_rules(config)
+    except ValueError as exc:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(exc)) from exc
+    scenario = payload.scenario.model_dump(mode="json") if payload.scenario is not None else None
+    run = backtest.create_run(session, payload.name, candidate, scenario, stream_ids, user.role.value)
+    record_audit(
+        session,
+        actor=user.role.value,
+        action="create_backtest",
+        entity_type="backtest_run",
+        entity_id=str(run.id),
+        before=None,
+        after=run.model_dump(mode="json"),
+        reason=None,
+    )
+    background_tasks.add_task(_execute_backtest, run.id)
+    return _backtest_out(session, run)
+
+
+@app.get("/backtests", response_model=list[BacktestOut])
+async def list_backtests(
+    name: Optional[str] = None,
+    user: UserContext = Depends(require_permission(Permission.INGEST_QC)),
+    session: Session = Depends(get_session),
+):
+    query = select(BacktestRun)
+    if name is not None:
+        query = query.where(BacktestRun.name == name)
+    runs = session.exec(query.order_by(BacktestRun.id.desc())).all()
+    return [_backtest_out(session, run) for run in runs]
+
+
+@app.get("/backtests/{run_id}", response_model=BacktestOut)
+async def get_backtest(
+    run_id: int,
+    include_streams: bool = True,
+    user: UserContext = Depends(require_permission(Permission.INGEST_QC)),
+    session: Session = Depends(get_session),
+):
+    run = session.get(BacktestRun, run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="Backtest not found")
+    return _backtest_out(session, run, include_streams)
+
+
+@app.post("/backtests/{run_id}/resume", response_model=BacktestOut)
+async def resume_backtest(
+    run_id: int,
+    background_tasks: BackgroundTasks,
+    user: UserContext = Depends(require_permission(Permission.EDIT_CONFIG)),
+    session: Session = Depends(get_session),
+):
+    run = session.get(BacktestRun, run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="Backtest not found")
+    if not backtest.reopen_run(session, run_id):
+        raise HTTPException(status_code=409, detail=f"Only a failed backtest can be resumed; this one is {run.status}")
+    session.refresh(run)
+    background_tasks.add_task(_execute_backtest, run.id)
+    return _backtest_out(session, run)
+
+
 @app.post("/qc/events", response_model=QCEventOut)
 async def ingest_event(
     payload: QCEventIn,
@@ -1281,6 +2122,26 @@ async def report_summary(
     }
 
 
+@app.get("/metrics")
+async def metrics(
+    user: UserContext = Depends(require_permission(Permission.INGEST_QC)),
+    session: Session = Depends(get_session),
+):
+    queue = outbox.queue_stats(session)
+    queue["workers"] = _worker_pool.workers if _worker_pool else 0
+    return {
+        "ingestion_queue": queue,
+        "window_cache": window_cache.stats(),
+        "baseline_cache": baseline_state_cache.stats(),
+        "lot_cache": lot_state_cache.stats(),
+        "config_cache": {
+            "stream_configs": stream_config_cache.stats(),
+            "priors": prior_config_cache.stats(),
+        },
+        "auth_cache": api_key_cache.stats(),
+    }
+
+
 @app.get("/streams/{stream_id}/chart")
 async def stream_chart(
     stream_id: str,
@@ -1317,4 +2178,5 @@ async def stream_chart(
         "events": [e.model_dump(mode="json") for e in events[::-1]],
         "alerts": [a.model_dump(mode="json") for a in alerts[::-1]],
         "lot_segments": lot_segments,
+        "posterior": _posterior_series(session, stream_id, record_series),
     }
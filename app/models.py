@@ -2,7 +2,7 @@ from __future__ import annotations
 
 from datetime import datetime
 from enum import Enum
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 from pydantic import BaseModel, Field, field_validator
 
@@ -53,6 +53,28 @@ class CapaStatus(str, Enum):
     REOPENED = "reopened"
 
 
+class BaselineMode(str, Enum):
+    FIXED = "fixed"
+    ROLLING_WINDOW = "rolling_window"
+    LAST_N_RUNS = "last_n_runs"
+
+
+class BaselineMethod(str, Enum):
+    CLASSICAL = "classical"
+    MEDIAN_MAD = "median_mad"
+    TRIMMED_MEAN = "trimmed_mean"
+
+
+class DriftModel(str, Enum):
+    LOCAL_LEVEL = "local_level"
+    LOCAL_TREND = "local_trend"
+
+
+class ScenarioKind(str, Enum):
+    SHIFT = "shift"
+    DRIFT = "drift"
+
+
 class EntrySource(str, Enum):
     AUTOMATED = "automated"
     MANUAL = "manual"
@@ -97,6 +119,17 @@ class BayesianRisk(BaseModel):
     posterior_sigma: Optional[float] = None
     predictive_sigma: Optional[float] = None
     credible_interval: Optional[Tuple[float, float]] = None
+    probability_bias_exceeded: Optional[float] = None
+    drift_level: Optional[float] = None
+    drift_level_sd: Optional[float] = None
+    drift_rate: Optional[float] = None
+    drift_rate_sd: Optional[float] = None
+    probability_drift: Optional[float] = None
+    probability_changepoint: Optional[float] = None
+    lot_offset: Optional[float] = None
+    lot_offset_sd: Optional[float] = None
+    probability_lot_shift: Optional[float] = None
+    probability_outlier: Optional[float] = None
 
 
 class QCRecordOut(BaseModel):
@@ -122,6 +155,28 @@ class QCRecordResolutionOut(BaseModel):
     resolved_reason: Optional[str] = None
 
 
+class QCRecordBulkResolutionIn(BaseModel):
+    include_in_stats: bool
+    resolved_reason: Optional[str] = None
+    record_ids: Optional[List[int]] = None
+    stream_id: Optional[str] = None
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+
+
+class QCRecordBulkResolutionItem(BaseModel):
+    record_id: int
+    status: str
+    record: Optional[QCRecordResolutionOut] = None
+
+
+class QCRecordBulkResolutionResult(BaseModel):
+    updated: int
+    unchanged: int
+    not_found: int
+    results: List[QCRecordBulkResolutionItem]
+
+
 class AuditEntryOut(BaseModel):
     timestamp: datetime
     actor: str
@@ -163,6 +218,31 @@ class IngestionResult(BaseModel):
     idempotency_key: Optional[str] = None
 
 
+class IngestionReceiptOut(BaseModel):
+    id: int
+    status: str
+    idempotency_key: str
+    created_at: datetime
+    completed_at: Optional[datetime] = None
+    qc_record_id: Optional[int] = None
+    response: Optional[IngestionResult] = None
+    error: Optional[str] = None
+
+
+class BatchIngestionItem(BaseModel):
+    index: int
+    status: str
+    result: Optional[IngestionResult] = None
+    error: Optional[str] = None
+    record_id: Optional[int] = None
+
+
+class BatchIngestionResult(BaseModel):
+    accepted: int
+    errors: int
+    results: List[BatchIngestionItem]
+
+
 class StreamConfigIn(BaseModel):
     stream_id: str
     analyte: str
@@ -183,8 +263,22 @@ class StreamConfigIn(BaseModel):
     unit_conversions: Optional[dict] = None
     baseline_start: Optional[datetime] = None
     baseline_end: Optional[datetime] = None
+    baseline_mode: BaselineMode = BaselineMode.FIXED
+    baseline_window_hours: Optional[float] = None
+    baseline_runs: Optional[int] = None
+    baseline_method: BaselineMethod = BaselineMethod.CLASSICAL
+    baseline_trim: float = 0.1
     risk_threshold_warn: int = 50
     risk_threshold_hold: int = 80
+    bias_threshold: Optional[float] = None
+    drift_model: Optional[DriftModel] = None
+    drift_level_noise_sd: float = 0.02
+    drift_rate_noise_sd: float = 0.0002
+    drift_delta_sd: float = 0.005
+    prior_pooling: bool = False
+    lot_model: bool = False
+    robust_contamination: Optional[float] = None
+    robust_outlier_scale: float = 10.0
     rule_set: Optional[dict] = None
     effective_from: Optional[datetime] = None
 
@@ -196,6 +290,122 @@ class StreamConfigOut(StreamConfigIn):
     effective_from: datetime
 
 
+class ReplayIn(BaseModel):
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    include_series: bool = False
+
+
+class ReplayOut(BaseModel):
+    stream_id: str
+    points: int
+    signal_counts: Dict[str, int]
+    max_risk_score: int
+    elapsed_ms: float
+    series: Optional[dict] = None
+
+
+class ConfigSimulationIn(BaseModel):
+    config: StreamConfigIn
+    prior: Optional[PriorConfigIn] = None
+    days: float = Field(default=90, gt=0)
+    include_series: bool = False
+
+
+class SimulationSummary(BaseModel):
+    signal_counts: Dict[str, int]
+    dispositions: Dict[str, int]
+    alerts: int
+    action_alerts: int
+    max_risk_score: int
+    series: Optional[dict] = None
+
+
+class ConfigSimulationOut(BaseModel):
+    stream_id: str
+    start: datetime
+    end: datetime
+    points: int
+    current: SimulationSummary
+    candidate: SimulationSummary
+    changed_dispositions: int
+    elapsed_ms: float
+
+
+class BacktestPrior(BaseModel):
+    mu0: float
+    kappa0: float
+    alpha0: float
+    beta0: float
+
+
+class BacktestCandidate(BaseModel):
+    # Unset fields keep each stream's own config and prior versions.
+    rule_set: Optional[dict] = None
+    warning_limit_sd: Optional[float] = None
+    action_limit_sd: Optional[float] = None
+    risk_threshold_warn: Optional[int] = None
+    risk_threshold_hold: Optional[int] = None
+    prior: Optional[BacktestPrior] = None
+
+
+class BacktestScenario(BaseModel):
+    kind: ScenarioKind = ScenarioKind.SHIFT
+    magnitude_sd: float = 2.0
+    points: int = Field(default=200, ge=2)
+    onset: int = Field(default=100, ge=1)
+    seed: int = 0
+
+    @field_validator("onset")
+    @classmethod
+    def onset_before_end(cls, value: int, info) -> int:
+        points = info.data.get("points")
+        if points is not None and value >= points:
+            raise ValueError("onset must be before the last point")
+        return value
+
+
+class BacktestIn(BaseModel):
+    name: str
+    candidate: BacktestCandidate = BacktestCandidate()
+    stream_ids: Optional[List[str]] = None
+    scenario: Optional[BacktestScenario] = None
+
+
+class BacktestStreamOut(BaseModel):
+    stream_id: str
+    status: str
+    metrics: dict
+    error: Optional[str] = None
+    elapsed_ms: float
+
+
+class BacktestOut(BaseModel):
+    id: int
+    name: str
+    version: int
+    status: str
+    candidate: dict
+    scenario: Optional[dict] = None
+    stream_count: int
+    completed_streams: int
+    failed_streams: int
+    summary: Optional[dict] = None
+    artifact_digest: Optional[str] = None
+    created_at: datetime
+    created_by: str
+    completed_at: Optional[datetime] = None
+    streams: Optional[List[BacktestStreamOut]] = None
+
+
+class ApiKeyOut(BaseModel):
+    id: int
+    role: Role
+    description: Optional[str] = None
+    created_at: datetime
+    active: bool
+
+
 class InstrumentIn(BaseModel):
     name: str
     manufacturer: Optional[str] = None
@@ -274,6 +484,46 @@ class PriorConfigOut(PriorConfigIn):
     effective_from: datetime
 
 
+class HierarchyFitOut(BaseModel):
+    analyte: str
+    method: str
+    qc_level: str
+    streams: int
+    points: int
+    offset: float
+    between_sd: float
+    within_sd: float
+    kappa0: float
+    alpha0: float
+    fitted_at: datetime
+    created_by: str
+
+
+class HierarchyRefitOut(BaseModel):
+    fitted_at: datetime
+    groups: List[HierarchyFitOut]
+    pooled_streams: List[str]
+
+
+class LotOffsetOut(BaseModel):
+    control_material_lot: str
+    reagent_lot: Optional[str] = None
+    n: int
+    mean: float
+    lot_offset: float
+    lot_offset_sd: float
+    probability_lot_shift: float
+
+
+class StreamLotsOut(BaseModel):
+    stream_id: str
+    # The pooled prior a new lot starts from.
+    pooled_offset: float
+    between_lot_sd: float
+    within_lot_sd: float
+    lots: List[LotOffsetOut]
+
+
 class QCEventIn(BaseModel):
     event_type: EventType
     timestamp: datetime
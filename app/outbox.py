@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import threading
+from datetime import datetime, timezone
+from typing import Callable, Optional
+from uuid import uuid4
+
+from sqlalchemy import func, update
+from sqlmodel import Session, select
+
+from app.db_models import IngestionOutbox, IngestionReceipt
+from app.models import IngestionResult, QCRecordIn, Role
+
+MAX_ATTEMPTS = 3
+
+# Streams currently being drained by a worker in this process; a stream is only ever
+# processed by one worker at a time so its posterior updates stay in order.
+_active_streams: set[str] = set()
+_claim_lock = threading.Lock()
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def enqueue_record(
+    session: Session,
+    payload: QCRecordIn,
+    actor_role: Role,
+    idempotency_key: Optional[str],
+) -> IngestionReceipt:
+    receipt = IngestionReceipt(
+        idempotency_key=idempotency_key or f"async-{uuid4()}",
+        response={},
+        status="pending",
+    )
+    session.add(receipt)
+    session.flush()
+    session.add(
+        IngestionOutbox(
+            receipt_id=receipt.id,
+            stream_id=payload.stream_id,
+            payload=payload.model_dump(mode="json"),
+            actor_role=actor_role,
+            idempotency_key=idempotency_key,
+        )
+    )
+    session.commit()
+    return receipt
+
+
+def claim_batch(session: Session, limit: int) -> list[IngestionOutbox]:
+    with _claim_lock:
+        query = select(IngestionOutbox.stream_id).where(IngestionOutbox.status == "pending")
+        if _active_streams:
+            query = query.where(IngestionOutbox.stream_id.not_in(list(_active_streams)))
+        stream_id = session.exec(query.order_by(IngestionOutbox.id.asc()).limit(1)).first()
+        if stream_id is None:
+            return []
+        token = str(uuid4())
+        pending_ids = (
+            select(IngestionOutbox.id)
+            .where(IngestionOutbox.stream_id == stream_id, IngestionOutbox.status == "pending")
+            .order_by(IngestionOutbox.id.asc())
+            .limit(limit)
+        )
+        session.exec(
+            update(IngestionOutbox)
+            .where(IngestionOutbox.id.in_(pending_ids))
+            .values(status="processing", claim_token=token, started_at=utcnow())
+        )
+        session.commit()
+        _active_streams.add(stream_id)
+    return session.exec(
+        select(IngestionOutbox).where(IngestionOutbox.claim_token == token).order_by(IngestionOutbox.id.asc())
+    ).all()
+
+
+def release_stream(stream_id: str) -> None:
+    with _claim_lock:
+        _active_streams.discard(stream_id)
+
+
+def complete_item(
+    session: Session,
+    item: IngestionOutbox,
+    result: Optional[IngestionResult],
+    error: Optional[str],
+    record_id: Optional[int] = None,
+) -> None:
+    now = utcnow()
+    receipt = session.exec(select(IngestionReceipt).where(IngestionReceipt.id == item.receipt_id)).first()
+    if receipt:
+        receipt.status = "completed" if result is not None else "failed"
+        receipt.response = result.model_dump(mode="json") if result is not None else {}
+        receipt.qc_record_id = record_id
+        receipt.error = error
+        receipt.completed_at = now
+        session.add(receipt)
+    item.status = "done" if result is not None else "failed"
+    item.error = error
+    item.completed_at = now
+    session.add(item)
+
+
+def retry_items(session: Session, items: list[IngestionOutbox], error: str) -> None:
+    # The batch transaction failed as a whole; put its items back unless they are out of attempts.
+    for item in items:
+        item = session.merge(item)
+        item.attempts += 1
+        item.claim_token = None
+        if item.attempts >= MAX_ATTEMPTS:
+            complete_item(session, item, None, error)
+        else:
+            item.status = "pending"
+            item.error = error
+            session.add(item)
+    session.commit()
+
+
+def requeue_stale(session: Session) -> int:
+    # Items left in "processing" by a crashed worker are safe to retry: their transaction never committed.
+    result = session.exec(
+        update(IngestionOutbox)
+        .where(IngestionOutbox.status == "processing")
+        .values(status="pending", claim_token=None)
+    )
+    session.commit()
+    return result.rowcount
+
+
+def queue_stats(session: Session) -> dict:
+    counts = dict(
+        session.exec(select(IngestionOutbox.status, func.count()).group_by(IngestionOutbox.status)).all()
+    )
+    oldest = session.exec(select(func.min(IngestionOutbox.enqueued_at)).where(IngestionOutbox.status == "pending")).first()
+    lag_seconds = 0.0
+    if oldest is not None:
+        lag_seconds = max(0.0, (utcnow().replace(tzinfo=None) - oldest.replace(tzinfo=None)).total_seconds())
+    return {
+        "depth": counts.get("pending", 0),
+        "processing": counts.get("processing", 0),
+        "failed": counts.get("failed", 0),
+        "done": counts.get("done", 0),
+        "oldest_enqueued_at": oldest.isoformat() if oldest else None,
+        "lag_seconds": lag_seconds,
+    }
+
+
+class IngestionWorkerPool:
+    def __init__(self, drain: Callable[[], int], workers: int, poll_interval: float = 0.5):
+        self.drain = drain
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads: list[threading.Thread] = []
+
+    def start(self) -> None:
+        self._stop.clear()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"bayesianqc-ingest-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                processed = self.drain()
+            except Exception:  # noqa: BLE001 - keep the worker alive; items are retried
+                processed = 0
+            if not processed:
+                self._stop.wait(self.poll_interval)
@@ -6,7 +6,8 @@ from typing import Dict, List, Optional
 from fastapi import Depends, Header, HTTPException, status
 from sqlmodel import Session, select
 
-from app.db import get_session
+from app.cache import api_key_cache
+from app.db import get_engine
 from app.db_models import ApiKey
 from app.models import Permission, Role
 
@@ -30,17 +31,27 @@ class UserContext:
         return permission in ROLE_PERMISSIONS.get(self.role, [])
 
 
+def hash_api_key(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
 def get_current_user(
     api_key: Optional[str] = Header(default=None, alias="X-API-Key"),
-    session: Session = Depends(get_session),
 ) -> UserContext:
     if not api_key:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Missing API key")
-    key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
-    record = session.exec(select(ApiKey).where(ApiKey.key_hash == key_hash, ApiKey.active == True)).first()
-    if not record:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API key")
-    return UserContext(role=record.role, api_key_id=record.id)
+    key_hash = hash_api_key(api_key)
+    user = api_key_cache.get(key_hash)
+    if user is not None:
+        return user
+    # Only valid keys are cached; a session is opened just for the lookup on a miss.
+    with Session(get_engine()) as session:
+        record = session.exec(select(ApiKey).where(ApiKey.key_hash == key_hash, ApiKey.active == True)).first()
+        if not record:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API key")
+        user = UserContext(role=record.role, api_key_id=record.id)
+    api_key_cache.put(key_hash, user)
+    return user
 
 
 def require_permission(permission: Permission):
@@ -0,0 +1,444 @@
+from __future__ import annotations
+
+import math
+from datetime import datetime
+from typing import Any, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+from app import changepoint, drift, risk, robust
+from app.bayesian import _fold_posterior
+from app.cache import RollingBaseline
+from app.frequentist import _chart_params
+from app.models import BaselineMethod, BaselineMode, DriftModel
+from app.rules import compile_rules
+from app.storage import _new_sketch, naive_timestamp, robust_estimate
+
+# Rows per block when building rule history windows, which bounds memory at REPLAY_CHUNK x lookback.
+REPLAY_CHUNK = 65536
+# Weight left on the EWMA's start after a warm-up; below double precision of the smoothed z-scores.
+EWMA_FORGET = 1e-12
+
+
+class ReplaySeed(NamedTuple):
+    # Sequential state after the records before the replayed rows; None starts it afresh, as on a full replay.
+    posterior: Optional[tuple[float, float, float, float]] = None
+    drift: Optional[drift.FilterState] = None
+    changepoint: Optional[changepoint.RunLengths] = None
+
+
+class ReplayResult(NamedTuple):
+    timestamps: np.ndarray
+    values: np.ndarray
+    included: np.ndarray
+    config_index: np.ndarray
+    baseline_mean: np.ndarray
+    baseline_sd: np.ndarray
+    z: np.ndarray
+    flags: dict[str, np.ndarray]
+    cusum_upper: np.ndarray
+    cusum_lower: np.ndarray
+    ewma: np.ndarray
+    ewma_limit: np.ndarray
+    mu_n: np.ndarray
+    kappa_n: np.ndarray
+    alpha_n: np.ndarray
+    beta_n: np.ndarray
+    probability_outside_limits: np.ndarray
+    probability_bias_exceeded: np.ndarray
+    risk_score: np.ndarray
+    drift_level: np.ndarray
+    drift_rate: np.ndarray
+    probability_drift: np.ndarray
+    probability_changepoint: np.ndarray
+    probability_outlier: np.ndarray
+
+
+def _times(values: Sequence[Any]) -> np.ndarray:
+    if isinstance(values, np.ndarray) and np.issubdtype(values.dtype, np.datetime64):
+        return values.astype("datetime64[us]")
+    return np.array([naive_timestamp(value) for value in values], dtype="datetime64[us]")
+
+
+def _active(times: np.ndarray, versions: Sequence[Any]) -> np.ndarray:
+    # Index of the version effective at each time; before the first version takes effect, the first one.
+    effective = _times([version.effective_from for version in versions])
+    return np.clip(np.searchsorted(effective, times, side="right") - 1, 0, None)
+
+
+def _classical_baselines(
+    values: np.ndarray,
+    times: np.ndarray,
+    included: np.ndarray,
+    config,
+    rows: np.ndarray,
+    preceding: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # (count, mean, sd) per row from prefix sums shifted by the target. Fixed windows count every included
+    # window point up to and including the row, as the materialized stats do; rolling modes count the
+    # included points before the row.
+    shift = config.target_value
+    if config.baseline_mode == BaselineMode.FIXED:
+        start, end = _times([config.baseline_start, config.baseline_end])
+        in_window = included & (times >= start) & (times <= end)
+        shifted = np.where(in_window, values - shift, 0.0)
+        count = np.cumsum(in_window)[rows]
+        total = np.cumsum(shifted)[rows]
+        squares = np.cumsum(shifted**2)[rows]
+    else:
+        inc_shifted = values[included] - shift
+        sums = np.concatenate([[0.0], np.cumsum(inc_shifted)])
+        sum_squares = np.concatenate([[0.0], np.cumsum(inc_shifted**2)])
+        high = preceding[rows]
+        if config.baseline_mode == BaselineMode.ROLLING_WINDOW:
+            cutoff = times[rows] - np.timedelta64(int(round(config.baseline_window_hours * 3600e6)), "us")
+            low = np.minimum(np.searchsorted(times[included], cutoff, side="left"), high)
+        else:
+            low = np.maximum(high - config.baseline_runs, 0)
+        count = high - low
+        total = sums[high] - sums[low]
+        squares = sum_squares[high] - sum_squares[low]
+    safe = np.maximum(count, 2)
+    mean = total / safe
+    sd = np.sqrt(np.maximum(squares - safe * mean**2, 0.0) / (safe - 1))
+    return count, mean + shift, sd
+
+
+def _robust_baselines(
+    values: np.ndarray,
+    times: np.ndarray,
+    included: np.ndarray,
+    config,
+    rows: np.ndarray,
+    mean: np.ndarray,
+    sd: np.ndarray,
+) -> None:
+    # Robust estimators walk the sketch point by point, as ingestion does; much slower than the
+    # prefix-sum path but exact with respect to it.
+    targets = set(rows.tolist())
+    last = int(rows[-1])
+    if config.baseline_mode == BaselineMode.FIXED:
+        start, end = _times([config.baseline_start, config.baseline_end])
+        sketch = _new_sketch(config)
+        for i in range(last + 1):
+            if included[i] and start <= times[i] <= end:
+                sketch.add(float(values[i]))
+            if i in targets:
+                robust = robust_estimate(sketch, config)
+                if robust is not None:
+                    mean[i], sd[i] = robust
+        return
+    state = RollingBaseline(sketch=_new_sketch(config))
+    window = None
+    if config.baseline_mode == BaselineMode.ROLLING_WINDOW:
+        window = np.timedelta64(int(round(config.baseline_window_hours * 3600e6)), "us")
+    for i in range(last + 1):
+        at = times[i].astype(datetime)
+        if window is not None:
+            state.evict_before((times[i] - window).astype(datetime))
+        if i in targets and state.n >= 2:
+            robust = robust_estimate(state.sketch, config)
+            if robust is not None:
+                mean[i], sd[i] = robust
+        if included[i]:
+            state.add(at, float(values[i]))
+            if window is None:
+                state.trim_to(config.baseline_runs)
+
+
+def _cusum(steps: np.ndarray) -> np.ndarray:
+    # S_i = max(0, S_{i-1} + x_i) from S_0 = 0 is C_i - min(0, min_{k<=i} C_k) with C the running sum of x.
+    totals = np.cumsum(steps)
+    return totals - np.minimum(np.minimum.accumulate(totals), 0.0)
+
+
+def _ewma(z: np.ndarray, lam: float, start: float, block: int = 128) -> np.ndarray:
+    # e_i = lam * z_i + (1 - lam) * e_{i-1}, evaluated as one matrix product per block of rows. Only the
+    # last value of each block is carried forward sequentially.
+    decay = 1 - lam
+    if not z.size:
+        return z.copy()
+    padded = np.concatenate([z, np.zeros(-z.size % block)]).reshape(-1, block)
+    powers = decay ** np.arange(block)
+    lags = np.arange(block)[:, None] - np.arange(block)[None, :]
+    weights = np.where(lags >= 0, lam * decay ** np.maximum(lags, 0), 0.0)
+    within = padded @ weights.T
+    carried = np.empty(len(padded))
+    previous = start
+    tail = decay**block
+    for b, last in enumerate(within[:, -1].tolist()):
+        carried[b] = previous
+        previous = last + tail * previous
+    return (within + carried[:, None] * (decay * powers)[None, :]).ravel()[: z.size]
+
+
+def _charts(z: np.ndarray, included: np.ndarray, active: np.ndarray, configs: Sequence[Any]) -> tuple[np.ndarray, ...]:
+    # Same recurrences as the live charts over the included rows: CUSUM in closed form, EWMA blockwise
+    # per config version (the smoothing constant changes between versions), and the limit from the count.
+    params = np.array([_chart_params(config) for config in configs])
+    rows = np.flatnonzero(included & np.isfinite(z))
+    versions = active[rows]
+    k = params[versions, 0]
+    lam = params[versions, 2]
+    z_rows = z[rows]
+    upper = _cusum(z_rows - k)
+    lower = _cusum(-z_rows - k)
+    ewma = np.empty(rows.size)
+    previous = 0.0
+    boundaries = np.flatnonzero(np.diff(versions)) + 1
+    for segment in np.split(np.arange(rows.size), boundaries):
+        if segment.size:
+            ewma[segment] = _ewma(z_rows[segment], float(lam[segment[0]]), previous)
+            previous = float(ewma[segment[-1]])
+    n = np.arange(1, rows.size + 1)
+    limit = params[versions, 3] * np.sqrt(lam / (2 - lam) * (1 - (1 - lam) ** (2 * n)))
+    outputs = []
+    for column in (upper, lower, ewma, limit):
+        output = np.full(len(z), np.nan)
+        output[rows] = column
+        outputs.append(output)
+    return tuple(outputs)
+
+
+def warmup(configs: Sequence[Any]) -> tuple[int, float, Optional[datetime]]:
+    # What rows under these configs look back over: included runs (rule history, run-count baselines and
+    # enough runs for the EWMA to forget its start), hours (time-window baselines) and the earliest fixed
+    # baseline window start. Replaying from there with a ReplaySeed reproduces those rows; the CUSUM restarts
+    # from zero, which it matches once the live sum has touched zero within the warm-up.
+    runs, hours, fixed_start = 0, 0.0, None
+    for config in configs:
+        lam = _chart_params(config)[2]
+        forget = math.ceil(math.log(EWMA_FORGET) / math.log1p(-lam)) if lam < 1 else 1
+        runs = max(runs, compile_rules(config).lookback, forget)
+        if config.baseline_mode == BaselineMode.LAST_N_RUNS:
+            runs = max(runs, config.baseline_runs)
+        elif config.baseline_mode == BaselineMode.ROLLING_WINDOW:
+            hours = max(hours, config.baseline_window_hours)
+        elif config.baseline_start and config.baseline_end:
+            start = naive_timestamp(config.baseline_start)
+            fixed_start = start if fixed_start is None else min(fixed_start, start)
+    return runs, hours, fixed_start
+
+
+def replay_stream(
+    values: Sequence[float],
+    timestamps: Sequence[Any],
+    configs: Sequence[Any],
+    priors: Sequence[Any],
+    included: Optional[Sequence[bool]] = None,
+    lot_offsets: Optional[Sequence[float]] = None,
+    seed: Optional[ReplaySeed] = None,
+) -> ReplayResult:
+    # Pure-array replay of one stream: z-scores, every rule flag, CUSUM/EWMA, the posterior trajectory and
+    # risk, as time-ordered sequential ingestion under these config and prior versions would produce them.
+    # `configs` and `priors` are effective-dated versions sorted by (effective_from, version); anything
+    # with the StreamConfig/PriorConfig attributes works. `lot_offsets` are the stamped lot offsets, taken off
+    # the values the posterior and drift filter see. `seed` continues the posterior, drift filter and
+    # change-point detector from the records before the first row when only a recent slice is replayed.
+    # Nothing is read from or written to the database.
+    values = np.asarray(values, dtype=float)
+    times = _times(timestamps)
+    included = np.ones(len(values), dtype=bool) if included is None else np.asarray(included, dtype=bool)
+    adjusted = values if lot_offsets is None else values - np.asarray(lot_offsets, dtype=float)
+    if len(times) and np.any(times[1:] < times[:-1]):
+        raise ValueError("Timestamps must be sorted")
+    if not configs:
+        raise ValueError("At least one stream config version is required")
+    count = len(values)
+    active = _active(times, configs)
+    seed = seed or ReplaySeed()
+
+    # Included points strictly before each row by position (baselines) and by time (rule history).
+    preceding = np.cumsum(included) - included
+    inc_values = values[included]
+    earlier = np.searchsorted(times[included], times, side="left")
+
+    baseline_mean = np.empty(count)
+    baseline_sd = np.empty(count)
+    z = np.empty(count)
+    flags: dict[str, np.ndarray] = {}
+    for version, config in enumerate(configs):
+        rows = np.flatnonzero(active == version)
+        if not rows.size:
+            continue
+        baseline_mean[rows] = config.target_value
+        baseline_sd[rows] = config.sigma
+        windowed = config.baseline_mode != BaselineMode.FIXED or (config.baseline_start and config.baseline_end)
+        if windowed:
+            n, mean, sd = _classical_baselines(values, times, included, config, rows, preceding)
+            enough = n >= 2
+            baseline_mean[rows[enough]] = mean[enough]
+            baseline_sd[rows[enough]] = sd[enough]
+            if config.baseline_method != BaselineMethod.CLASSICAL:
+                _robust_baselines(values, times, included, config, rows, baseline_mean, baseline_sd)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z[rows] = (values[rows] - baseline_mean[rows]) / baseline_sd[rows]
+
+        compiled = compile_rules(config)
+        lookback = compiled.lookback
+        for start in range(0, rows.size, REPLAY_CHUNK):
+            chunk = rows[start : start + REPLAY_CHUNK]
+            index = earlier[chunk, None] - lookback + np.arange(lookback)
+            history = np.full(index.shape, np.nan)
+            if inc_values.size:
+                history = np.where(index >= 0, inc_values[np.clip(index, 0, inc_values.size - 1)], np.nan)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                history_z = (history - baseline_mean[chunk, None]) / baseline_sd[chunk, None]
+            for rule, fired, _ in compiled.fire(z[chunk], history_z):
+                flags.setdefault(rule.name, np.zeros(count, dtype=bool))[chunk] = fired
+
+    cusum_upper, cusum_lower, ewma, ewma_limit = _charts(z, included, active, configs)
+    for version, config in enumerate(configs):
+        rules = (config.rule_set or {}).get("rules", [])
+        rows = active == version
+        _, h, _, _ = _chart_params(config)
+        with np.errstate(invalid="ignore"):
+            if "CUSUM" in rules:
+                flags.setdefault("CUSUM", np.zeros(count, dtype=bool))[rows] = ((cusum_upper > h) | (cusum_lower > h))[rows]
+            if "EWMA" in rules:
+                flags.setdefault("EWMA", np.zeros(count, dtype=bool))[rows] = (np.abs(ewma) > ewma_limit)[rows]
+
+    # One fold from the prior active at the first included point, as the live posterior does. Each row
+    # sees the posterior after the last included point up to and including it; robust configs fold with
+    # their own step and give included rows an outlier probability.
+    posterior = [np.full(count, np.nan) for _ in range(4)]
+    probability_outlier = np.full(count, np.nan)
+    probability = np.zeros(count)
+    bias_probability = np.zeros(count)
+    if priors and inc_values.size:
+        start = seed.posterior
+        if start is None:
+            prior = priors[int(_active(times[included][:1], priors)[0])]
+            start = (prior.mu0, prior.kappa0, prior.alpha0, prior.beta0)
+        params = [robust.robust_params(config) for config in configs]
+        row_params = [params[i] for i in active[included].tolist()] if any(params) else None
+        folded = _fold_posterior(start, adjusted[included], row_params)
+        position = np.cumsum(included)
+        posterior = [np.concatenate([[initial], array])[position] for initial, array in zip(start, folded)]
+        probability_outlier[included] = folded[4]
+        targets = np.array([config.target_value for config in configs])[active]
+        spreads = np.array([config.action_limit_sd * config.sigma for config in configs])[active]
+        biases = np.array([risk.bias_threshold(config) for config in configs])[active]
+        probability, bias_probability = risk.exceedance_probabilities(*posterior, targets, spreads, biases)
+
+    # The drift filter steps on included rows whose active config has a drift model; other rows carry
+    # the last filtered state, and rows without a drift model are NaN.
+    modelled = np.array([config.drift_model is not None for config in configs])[active]
+    drift_level, drift_rate, probability_drift = (np.full(count, np.nan) for _ in range(3))
+    stepped = included & modelled
+    if stepped.any():
+        filtered = drift.kalman_filter(adjusted[stepped], configs, active[stepped], seed.drift)
+        probabilities = drift.drift_probabilities(filtered, configs, active[stepped])
+        position = np.cumsum(stepped)
+        trend = np.array([config.drift_model == DriftModel.LOCAL_TREND for config in configs])[active]
+        columns = ((drift_level, filtered.level), (drift_rate, filtered.rate), (probability_drift, probabilities))
+        for output, column in columns:
+            output[:] = np.concatenate([[np.nan], column])[position]
+            output[~modelled] = np.nan
+        drift_rate[~trend] = np.nan
+
+    # The change-point detector walks the included rows of versions that enable it, one step at a time.
+    detecting = included & np.array([changepoint.enabled(config) for config in configs])[active]
+    probability_changepoint = np.full(count, np.nan)
+    if priors and detecting.any():
+        rows = np.flatnonzero(detecting)
+        row_priors = [priors[i] for i in _active(times[rows], priors).tolist()]
+        row_configs = [configs[i] for i in active[rows].tolist()]
+        probability_changepoint[rows] = changepoint.changepoint_probabilities(
+            values[rows], row_configs, row_priors, seed.changepoint
+        )
+        thresholds = np.array([changepoint.changepoint_params(config)["threshold"] for config in configs])[active]
+        with np.errstate(invalid="ignore"):
+            flags["CHANGEPOINT"] = probability_changepoint >= thresholds
+
+    return ReplayResult(
+        timestamps=times,
+        values=values,
+        included=included,
+        config_index=active,
+        baseline_mean=baseline_mean,
+        baseline_sd=baseline_sd,
+        z=z,
+        flags=flags,
+        cusum_upper=cusum_upper,
+        cusum_lower=cusum_lower,
+        ewma=ewma,
+        ewma_limit=ewma_limit,
+        mu_n=posterior[0],
+        kappa_n=posterior[1],
+        alpha_n=posterior[2],
+        beta_n=posterior[3],
+        probability_outside_limits=probability,
+        probability_bias_exceeded=bias_probability,
+        risk_score=risk.risk_scores(probability),
+        drift_level=drift_level,
+        drift_rate=drift_rate,
+        probability_drift=probability_drift,
+        probability_changepoint=probability_changepoint,
+        probability_outlier=probability_outlier,
+    )
+
+
+def _json_floats(array: np.ndarray) -> list[Optional[float]]:
+    return [value if math.isfinite(value) else None for value in array.tolist()]
+
+
+def replay_series(result: ReplayResult, rows: Optional[np.ndarray] = None) -> dict:
+    # JSON-ready columns for the selected rows; NaN becomes null.
+    rows = np.arange(len(result.values)) if rows is None else rows
+    flag_names = list(result.flags)
+    fired = np.column_stack([result.flags[name][rows] for name in flag_names]) if flag_names else None
+    return {
+        "timestamp": [str(ts) for ts in result.timestamps[rows]],
+        "value": result.values[rows].tolist(),
+        "included": result.included[rows].tolist(),
+        "baseline_mean": _json_floats(result.baseline_mean[rows]),
+        "baseline_sd": _json_floats(result.baseline_sd[rows]),
+        "z": _json_floats(result.z[rows]),
+        "signals": (
+            [[name for name, hit in zip(flag_names, row) if hit] for row in fired.tolist()]
+            if fired is not None
+            else [[] for _ in rows]
+        ),
+        "cusum_upper": _json_floats(result.cusum_upper[rows]),
+        "cusum_lower": _json_floats(result.cusum_lower[rows]),
+        "ewma": _json_floats(result.ewma[rows]),
+        "posterior_mean": _json_floats(result.mu_n[rows]),
+        "probability_outside_limits": result.probability_outside_limits[rows].tolist(),
+        "probability_bias_exceeded": result.probability_bias_exceeded[rows].tolist(),
+        "risk_score": result.risk_score[rows].tolist(),
+        "drift_level": _json_floats(result.drift_level[rows]),
+        "drift_rate": _json_floats(result.drift_rate[rows]),
+        "probability_drift": _json_floats(result.probability_drift[rows]),
+        "probability_changepoint": _json_floats(result.probability_changepoint[rows]),
+        "probability_outlier": _json_floats(result.probability_outlier[rows]),
+    }
+
+
+def action_flags(result: ReplayResult, configs: Sequence[Any]) -> np.ndarray:
+    # Rows where an action-severity rule fired under the config version active at that row.
+    action = np.zeros(len(result.values), dtype=bool)
+    for version, config in enumerate(configs):
+        rows = result.config_index == version
+        for rule in compile_rules(config).rules:
+            if rule.severity == "action" and rule.name in result.flags:
+                action[rows] |= result.flags[rule.name][rows]
+    return action
+
+
+def replay_dispositions(result: ReplayResult, configs: Sequence[Any]) -> np.ndarray:
+    # The disposition live ingestion would assign to each row; anything but "accept" raises an alert.
+    fired = np.zeros(len(result.values), dtype=bool)
+    for flags in result.flags.values():
+        fired |= flags
+    warn = np.array([config.risk_threshold_warn for config in configs])[result.config_index]
+    hold = np.array([config.risk_threshold_hold for config in configs])[result.config_index]
+    return np.select(
+        [action_flags(result, configs), result.risk_score >= hold, fired | (result.risk_score >= warn)],
+        ["reject", "hold-for-review", "monitor"],
+        "accept",
+    )
+
+
+def signal_counts(result: ReplayResult, rows: Optional[np.ndarray] = None) -> dict[str, int]:
+    return {name: int(np.count_nonzero(fired if rows is None else fired[rows])) for name, fired in result.flags.items()}
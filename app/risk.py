@@ -0,0 +1,208 @@
+from __future__ import annotations
+
+import math
+from typing import Any, NamedTuple
+
+import numpy as np
+
+# Exceedance probabilities under the Normal-Inverse-Gamma posterior (mu_n, kappa_n, alpha_n, beta_n):
+#   next result  ~ Student-t, 2 alpha_n df, location mu_n, scale sqrt(beta_n (kappa_n + 1) / (alpha_n kappa_n))
+#   mean mu      ~ Student-t, 2 alpha_n df, location mu_n, scale sqrt(beta_n / (alpha_n kappa_n))
+# Each probability has a scalar form for single ingests and an array form for batches and replays. Both
+# follow the same arithmetic so they agree to rounding.
+
+# At and above this many degrees of freedom the t tail uses Hill's normalizing transform (ACM Algorithm 395),
+# which matches the incomplete beta to ~1e-13 there, while the continued fraction needs ever more terms.
+HILL_MIN_DF = 100.0
+BETAINC_EPS = 1e-14
+BETAINC_MAX_TERMS = 300
+_TINY = 1e-300
+_SQRT2 = math.sqrt(2.0)
+
+_lgamma_array = np.frompyfunc(math.lgamma, 1, 1)
+_erfc_array = np.frompyfunc(math.erfc, 1, 1)
+
+
+class Exceedance(NamedTuple):
+    outside_limits: np.ndarray
+    bias_exceeded: np.ndarray
+
+
+def bias_threshold(config: Any) -> float:
+    # P(|mu - target| > bias_threshold); one SD of the config when no threshold is set.
+    return config.bias_threshold if config.bias_threshold is not None else config.sigma
+
+
+def _betacf(a: float, b: float, x: float) -> float:
+    # Lentz's continued fraction for the incomplete beta, valid for x < (a + 1) / (a + b + 2).
+    qab, qap, qam = a + b, a + 1.0, a - 1.0
+    c = 1.0
+    d = 1.0 - qab * x / qap
+    d = 1.0 / (d if abs(d) >= _TINY else _TINY)
+    h = d
+    for m in range(1, BETAINC_MAX_TERMS + 1):
+        m2 = 2 * m
+        for numerator in (m * (b - m) * x / ((qam + m2) * (a + m2)), -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))):
+            d = 1.0 + numerator * d
+            d = 1.0 / (d if abs(d) >= _TINY else _TINY)
+            c = 1.0 + numerator / c
+            c = c if abs(c) >= _TINY else _TINY
+            delta = d * c
+            h *= delta
+        if abs(delta - 1.0) < BETAINC_EPS:
+            break
+    return h
+
+
+def _betacf_array(a: np.ndarray, b: np.ndarray, x: np.ndarray) -> np.ndarray:
+    qab, qap, qam = a + b, a + 1.0, a - 1.0
+    c = np.ones_like(x)
+    d = 1.0 - qab * x / qap
+    d = 1.0 / np.where(np.abs(d) >= _TINY, d, _TINY)
+    h = d.copy()
+    for m in range(1, BETAINC_MAX_TERMS + 1):
+        m2 = 2 * m
+        for numerator in (m * (b - m) * x / ((qam + m2) * (a + m2)), -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))):
+            d = 1.0 + numerator * d
+            d = 1.0 / np.where(np.abs(d) >= _TINY, d, _TINY)
+            c = 1.0 + numerator / c
+            c = np.where(np.abs(c) >= _TINY, c, _TINY)
+            delta = d * c
+            h *= delta
+        if np.all(np.abs(delta - 1.0) < BETAINC_EPS):
+            break
+    return h
+
+
+def betainc(a: float, b: float, x: float) -> float:
+    # Regularized incomplete beta I_x(a, b).
+    if x <= 0.0:
+        return 0.0
+    if x >= 1.0:
+        return 1.0
+    if x > (a + 1.0) / (a + b + 2.0):
+        return 1.0 - betainc(b, a, 1.0 - x)
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log1p(-x))
+    return front / a * _betacf(a, b, x)
+
+
+def betainc_array(a: np.ndarray, b: np.ndarray, x: np.ndarray) -> np.ndarray:
+    a, b, x = (np.asarray(array, dtype=float) for array in np.broadcast_arrays(a, b, x))
+    result = np.where(x >= 1.0, 1.0, 0.0)
+    inside = (x > 0.0) & (x < 1.0)
+    if not inside.any():
+        return result
+    a, b, x = a[inside], b[inside], x[inside]
+    swap = x > (a + 1.0) / (a + b + 2.0)
+    a, b, x = np.where(swap, b, a), np.where(swap, a, b), np.where(swap, 1.0 - x, x)
+    log_front = _lgamma_array(a + b).astype(float) - _lgamma_array(a).astype(float) - _lgamma_array(b).astype(float)
+    front = np.exp(log_front + a * np.log(x) + b * np.log1p(-x))
+    value = front / a * _betacf_array(a, b, x)
+    result[inside] = np.where(swap, 1.0 - value, value)
+    return result
+
+
+def _hill_tail(t: float, df: float) -> float:
+    a = df - 0.5
+    b = 48.0 * a * a
+    y = a * math.log1p(t * t / df)
+    y = (((((-0.4 * y - 3.3) * y - 24.0) * y - 85.5) / (0.8 * y * y + 100.0 + b) + y + 3.0) / b + 1.0) * math.sqrt(y)
+    return 0.5 * math.erfc(y / _SQRT2)
+
+
+def _hill_tail_array(t: np.ndarray, df: np.ndarray) -> np.ndarray:
+    a = df - 0.5
+    b = 48.0 * a * a
+    y = a * np.log1p(t * t / df)
+    y = (((((-0.4 * y - 3.3) * y - 24.0) * y - 85.5) / (0.8 * y * y + 100.0 + b) + y + 3.0) / b + 1.0) * np.sqrt(y)
+    # erfc underflows to zero beyond ~27 SD; skip the per-element call for those tails.
+    tail = np.zeros(y.shape)
+    near = y < 40.0
+    tail[near] = 0.5 * _erfc_array(y[near] / _SQRT2).astype(float)
+    return tail
+
+
+def student_t_cdf(t: float, df: float) -> float:
+    # The upper tail P(T > |t|) is computed directly, so small tails keep their precision.
+    if math.isinf(t):
+        return 1.0 if t > 0 else 0.0
+    if df >= HILL_MIN_DF:
+        tail = _hill_tail(t, df)
+    else:
+        tail = 0.5 * betainc(df / 2.0, 0.5, df / (df + t * t))
+    return 1.0 - tail if t > 0 else tail
+
+
+def student_t_cdf_array(t: np.ndarray, df: np.ndarray) -> np.ndarray:
+    t, df = (np.asarray(array, dtype=float) for array in np.broadcast_arrays(t, df))
+    tail = np.zeros(t.shape)
+    finite = np.isfinite(t)
+    hill = finite & (df >= HILL_MIN_DF)
+    series = finite & ~hill
+    if hill.any():
+        tail[hill] = _hill_tail_array(t[hill], df[hill])
+    if series.any():
+        tail[series] = 0.5 * betainc_array(df[series] / 2.0, 0.5, df[series] / (df[series] + t[series] ** 2))
+    return np.where(t > 0, 1.0 - tail, tail)
+
+
+def _outside(mu: float, scale: float, center: float, half_width: float, df: float) -> float:
+    return student_t_cdf((center - half_width - mu) / scale, df) + student_t_cdf((mu - center - half_width) / scale, df)
+
+
+def exceedance_probability(
+    mu_n: float,
+    kappa_n: float,
+    alpha_n: float,
+    beta_n: float,
+    target: float,
+    spread: float,
+    bias: float,
+) -> tuple[float, float]:
+    # (P(next result outside target +/- spread), P(|mu - target| > bias)) for one posterior state.
+    if not (alpha_n > 0 and kappa_n > 0 and beta_n > 0):
+        return 0.0, 0.0
+    df = 2.0 * alpha_n
+    predictive_scale = math.sqrt(beta_n * (kappa_n + 1) / (alpha_n * kappa_n))
+    mean_scale = math.sqrt(beta_n / (alpha_n * kappa_n))
+    outside = _outside(mu_n, predictive_scale, target, spread, df)
+    biased = _outside(mu_n, mean_scale, target, bias, df)
+    return min(1.0, max(0.0, outside)), min(1.0, max(0.0, biased))
+
+
+def exceedance_probabilities(
+    mu_n: np.ndarray,
+    kappa_n: np.ndarray,
+    alpha_n: np.ndarray,
+    beta_n: np.ndarray,
+    targets: np.ndarray,
+    spreads: np.ndarray,
+    biases: np.ndarray,
+) -> Exceedance:
+    # exceedance_probability over arrays of posterior states with per-row targets and thresholds.
+    mu_n, kappa_n, alpha_n, beta_n, targets, spreads, biases = (
+        np.asarray(array, dtype=float)
+        for array in np.broadcast_arrays(mu_n, kappa_n, alpha_n, beta_n, targets, spreads, biases)
+    )
+    outside = np.zeros(mu_n.shape)
+    biased = np.zeros(mu_n.shape)
+    with np.errstate(invalid="ignore"):
+        valid = (alpha_n > 0) & (kappa_n > 0) & (beta_n > 0)
+    if valid.any():
+        mu, kappa, alpha, beta = mu_n[valid], kappa_n[valid], alpha_n[valid], beta_n[valid]
+        target, df = targets[valid], 2.0 * alpha
+        predictive_scale = np.sqrt(beta * (kappa + 1) / (alpha * kappa))
+        mean_scale = np.sqrt(beta / (alpha * kappa))
+        for output, scale, half_width in ((outside, predictive_scale, spreads[valid]), (biased, mean_scale, biases[valid])):
+            output[valid] = student_t_cdf_array((target - half_width - mu) / scale, df) + student_t_cdf_array(
+                (mu - target - half_width) / scale, df
+            )
+    return Exceedance(np.clip(outside, 0.0, 1.0), np.clip(biased, 0.0, 1.0))
+
+
+def risk_score(probability_outside_limits: float) -> int:
+    return int(min(100, max(0, round(probability_outside_limits * 100))))
+
+
+def risk_scores(probability_outside_limits: np.ndarray) -> np.ndarray:
+    return np.clip(np.round(probability_outside_limits * 100), 0, 100).astype(int)
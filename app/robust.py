@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import math
+from typing import Any, Optional, Sequence
+
+import numpy as np
+
+# Contamination likelihood: a result is a good measurement with probability 1 - contamination and a gross
+# error otherwise. Good results follow the NIG posterior predictive, a Student-t with 2 alpha_n df; gross
+# errors follow the same t widened `outlier_scale` times. Each step is one assumed-density update:
+#   p_outlier = P(gross error | value, posterior)
+#   the conjugate update with the result counted as (1 - p_outlier) of an observation,
+# so a gross error barely moves mu_n or beta_n while ordinary results update almost exactly as the conjugate
+# model does. The cost per point is fixed. A step whose inputs or output are not finite falls back to the
+# conjugate update and reports no outlier probability.
+
+
+def robust_params(config: Any) -> Optional[tuple[float, float]]:
+    if config.robust_contamination is None:
+        return None
+    return config.robust_contamination, config.robust_outlier_scale
+
+
+def _weighted_update(
+    mu0: float, kappa0: float, alpha0: float, beta0: float, value: float, weight: float
+) -> tuple[float, float, float, float]:
+    kappa_n = kappa0 + weight
+    mu_n = mu0 + weight * (value - mu0) / kappa_n
+    alpha_n = alpha0 + 0.5 * weight
+    beta_n = beta0 + 0.5 * weight * kappa0 * (value - mu0) ** 2 / kappa_n
+    return mu_n, kappa_n, alpha_n, beta_n
+
+
+def outlier_probability(
+    mu0: float,
+    kappa0: float,
+    alpha0: float,
+    beta0: float,
+    value: float,
+    contamination: float,
+    outlier_scale: float,
+) -> float:
+    if not (alpha0 > 0 and kappa0 > 0 and beta0 > 0):
+        return math.nan
+    df = 2.0 * alpha0
+    z_sq = (value - mu0) ** 2 * alpha0 * kappa0 / (beta0 * (kappa0 + 1))
+    # The t normalizing constants cancel; only the widths and kernels differ.
+    log_ratio = -math.log(outlier_scale) - 0.5 * (df + 1) * (
+        math.log1p(z_sq / (df * outlier_scale**2)) - math.log1p(z_sq / df)
+    )
+    log_odds = math.log(contamination) - math.log1p(-contamination) + log_ratio
+    if not math.isfinite(log_odds):
+        return math.nan
+    if log_odds >= 0:
+        return 1.0 / (1.0 + math.exp(-log_odds))
+    odds = math.exp(log_odds)
+    return odds / (1.0 + odds)
+
+
+def robust_step(
+    mu0: float,
+    kappa0: float,
+    alpha0: float,
+    beta0: float,
+    value: float,
+    contamination: float,
+    outlier_scale: float,
+) -> tuple[float, float, float, float, float]:
+    probability = outlier_probability(mu0, kappa0, alpha0, beta0, value, contamination, outlier_scale)
+    if math.isfinite(probability):
+        posterior = _weighted_update(mu0, kappa0, alpha0, beta0, value, 1.0 - probability)
+        if all(math.isfinite(x) for x in posterior) and posterior[1] > 0 and posterior[3] > 0:
+            return (*posterior, probability)
+    return (*_weighted_update(mu0, kappa0, alpha0, beta0, value, 1.0), math.nan)
+
+
+def robust_fold(
+    start: Sequence[float], values: np.ndarray, params: Sequence[Optional[tuple[float, float]]]
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # robust_step over values in order; rows without params take the conjugate step. Sequential, since each
+    # weight depends on the posterior before it.
+    columns = np.empty((5, len(values)))
+    posterior = tuple(start)
+    for i, (value, row_params) in enumerate(zip(values.tolist(), params)):
+        if row_params is None:
+            step = (*_weighted_update(*posterior, value, 1.0), math.nan)
+        else:
+            step = robust_step(*posterior, value, *row_params)
+        columns[:, i] = step
+        posterior = step[:4]
+    return columns[0], columns[1], columns[2], columns[3], columns[4]
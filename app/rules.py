@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import json
+from functools import lru_cache
+from typing import List, Sequence, Union
+
+import numpy as np
+
+from app.db_models import DEFAULT_RULE_SET, StreamConfig
+from app.models import FrequentistSignal, StreamConfigIn
+
+# Rule language stored in StreamConfig.rule_set["rules"]. Entries are built-in names or dicts:
+#   {"name": "2of3-2s", "type": "count", "k": 2, "n": 3, "limit": "warn", "side": "same", "severity": "warn"}
+#     fires when at least k of the last n z-scores are beyond `limit` SD. With side "same" (the default)
+#     they must all be on one side; with "any", high and low hits count together.
+#   {"name": "R-4s", "type": "range", "n": 2, "limit": "warn"}
+#     fires when the last n hold one point beyond +limit and one beyond -limit.
+#   {"name": "R-4s-span", "type": "range", "n": 2, "span": 4}
+#     fires when max - min of the last n exceeds `span` SD.
+# `limit` is a number of SDs or "warn"/"action" for the config's limits. "Beyond 0" means strictly on
+# that side. Unless "current" is false, the newest point has to be one of the hits.
+BUILTIN_RULES = {
+    "1-3s": {
+        "type": "count",
+        "k": 1,
+        "n": 1,
+        "limit": "action",
+        "side": "any",
+        "severity": "action",
+        "evidence": "|z|={abs_z:.2f} exceeds action limit",
+    },
+    "2-2s": {
+        "type": "count",
+        "k": 2,
+        "n": 2,
+        "limit": "warn",
+        "severity": "warn",
+        "evidence": "Consecutive warning-level deviations in same direction ({direction})",
+    },
+    "R-4s": {
+        "type": "range",
+        "n": 2,
+        "limit": "warn",
+        "severity": "action",
+        "evidence": "Consecutive results exceed 4 SD range in opposite directions",
+    },
+    "4-1s": {
+        "type": "count",
+        "k": 4,
+        "n": 4,
+        "limit": 1.0,
+        "severity": "warn",
+        "evidence": "Four consecutive results exceed 1 SD on the same side",
+    },
+    "10x": {
+        "type": "count",
+        "k": 10,
+        "n": 10,
+        "limit": 0.0,
+        "severity": "warn",
+        "evidence": "Ten consecutive results on the same side of the mean",
+    },
+}
+SEVERITIES = ("warn", "action")
+
+
+class CompiledRule:
+    def __init__(self, name: str, spec: dict, warn_limit: float, action_limit: float):
+        kind = spec.get("type")
+        if kind not in ("count", "range"):
+            raise ValueError(f"Rule {name}: type must be 'count' or 'range'")
+        self.name = name
+        self.kind = kind
+        self.n = _positive_int(name, "n", spec.get("n"))
+        self.k = _positive_int(name, "k", spec.get("k", self.n)) if kind == "count" else 2
+        if self.k > self.n:
+            raise ValueError(f"Rule {name}: k cannot exceed n")
+        self.side = spec.get("side", "same")
+        if self.side not in ("same", "any"):
+            raise ValueError(f"Rule {name}: side must be 'same' or 'any'")
+        self.span = spec.get("span") if kind == "range" else None
+        if self.span is not None:
+            self.span = _non_negative(name, "span", self.span)
+            self.limit = 0.0
+        else:
+            self.limit = _limit(name, spec.get("limit"), warn_limit, action_limit)
+        self.current = bool(spec.get("current", True))
+        self.severity = spec.get("severity", "warn")
+        if self.severity not in SEVERITIES:
+            raise ValueError(f"Rule {name}: severity must be 'warn' or 'action'")
+        default_evidence = (
+            "{k} of last {n} results beyond {limit:g} SD ({direction})"
+            if kind == "count"
+            else "Last {n} results span opposite limits"
+        )
+        self.evidence = spec.get("evidence", default_evidence)
+        try:
+            self.signal(0.0, True)
+        except (KeyError, IndexError, ValueError, AttributeError) as exc:
+            raise ValueError(f"Rule {name}: invalid evidence template") from exc
+
+    def evaluate(self, window: np.ndarray, available: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # `window` is (rows, n) z-scores, oldest first and NaN where history is missing. Returns the rows
+        # that fire and whether they fired on the high side.
+        enough = available >= self.n - 1
+        with np.errstate(invalid="ignore"):
+            high = (window >= self.limit) & (window > 0)
+            low = (window <= -self.limit) & (window < 0)
+            if self.kind == "range" and self.span is not None:
+                fired = enough & (np.max(window, axis=1) - np.min(window, axis=1) >= self.span)
+                if self.current:
+                    # The newest point has to be an extreme of the window.
+                    newest = window[:, -1]
+                    fired &= (newest == np.max(window, axis=1)) | (newest == np.min(window, axis=1))
+                return fired, window[:, -1] > 0
+            if self.kind == "range":
+                fired = enough & high.any(axis=1) & low.any(axis=1)
+                if self.current:
+                    fired &= high[:, -1] | low[:, -1]
+                return fired, high[:, -1]
+            if self.side == "any":
+                hits = high | low
+                fired = enough & (hits.sum(axis=1) >= self.k)
+                if self.current:
+                    fired &= hits[:, -1]
+                return fired, window[:, -1] > 0
+            fired_high = high.sum(axis=1) >= self.k
+            fired_low = low.sum(axis=1) >= self.k
+            if self.current:
+                fired_high &= high[:, -1]
+                fired_low &= low[:, -1]
+            return enough & (fired_high | fired_low), fired_high
+
+    def signal(self, z: float, is_high: bool) -> FrequentistSignal:
+        evidence = self.evidence.format(
+            z=z,
+            abs_z=abs(z),
+            direction="high" if is_high else "low",
+            k=self.k,
+            n=self.n,
+            limit=self.limit,
+        )
+        return FrequentistSignal(rule=self.name, severity=self.severity, evidence=evidence)
+
+
+class CompiledRuleSet:
+    def __init__(self, rules: Sequence[CompiledRule]):
+        self.rules = list(rules)
+        # Preceding points needed by the longest enabled rule.
+        self.lookback = max((rule.n - 1 for rule in self.rules), default=0)
+
+    def fire(self, z: np.ndarray, history: np.ndarray) -> List[tuple[CompiledRule, np.ndarray, np.ndarray]]:
+        # z is (rows,), history is (rows, >= lookback) preceding z-scores, oldest first, NaN-padded left.
+        # Returns each rule with the rows it fires on and whether it fired high.
+        history = history[:, history.shape[1] - self.lookback :] if self.lookback else history[:, :0]
+        available = np.sum(~np.isnan(history), axis=1)
+        window = np.column_stack([history, z])
+        return [(rule, *rule.evaluate(window[:, window.shape[1] - rule.n :], available)) for rule in self.rules]
+
+    def evaluate(self, z: np.ndarray, history: np.ndarray) -> List[List[FrequentistSignal]]:
+        results: List[List[FrequentistSignal]] = [[] for _ in range(len(z))]
+        for rule, fired, is_high in self.fire(z, history):
+            for i in np.flatnonzero(fired):
+                results[i].append(rule.signal(float(z[i]), bool(is_high[i])))
+        return results
+
+
+def _positive_int(name: str, field: str, value) -> int:
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        raise ValueError(f"Rule {name}: {field} must be a positive integer")
+    return value
+
+
+def _non_negative(name: str, field: str, value) -> float:
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+        raise ValueError(f"Rule {name}: {field} must be a non-negative number")
+    return float(value)
+
+
+def _limit(name: str, value: Union[str, float, None], warn_limit: float, action_limit: float) -> float:
+    if value == "warn":
+        return warn_limit
+    if value == "action":
+        return action_limit
+    return _non_negative(name, "limit", value)
+
+
+@lru_cache(maxsize=1024)
+def _compile(rules_json: str, warn_limit: float, action_limit: float) -> CompiledRuleSet:
+    entries = json.loads(rules_json)
+    names = {entry for entry in entries if isinstance(entry, str)}
+    # Built-ins keep their fixed evaluation order; custom rules follow in the order given.
+    compiled = [
+        CompiledRule(name, spec, warn_limit, action_limit) for name, spec in BUILTIN_RULES.items() if name in names
+    ]
+    for entry in entries:
+        if isinstance(entry, dict):
+            name = entry.get("name")
+            if not isinstance(name, str) or not name:
+                raise ValueError("Custom rules need a name")
+            if name in BUILTIN_RULES:
+                raise ValueError(f"Rule {name}: name is reserved for a built-in rule")
+            compiled.append(CompiledRule(name, entry, warn_limit, action_limit))
+        elif not isinstance(entry, str):
+            raise ValueError("Rules must be names or rule definitions")
+    return CompiledRuleSet(compiled)
+
+
+def compile_rules(config: Union[StreamConfig, StreamConfigIn]) -> CompiledRuleSet:
+    # Compiled once per distinct (rules, limits); every config version sharing them reuses the evaluator.
+    # Raises ValueError for an invalid rule definition.
+    rules = (config.rule_set or DEFAULT_RULE_SET).get("rules", [])
+    return _compile(json.dumps(rules, sort_keys=True), float(config.warning_limit_sd), float(config.action_limit_sd))
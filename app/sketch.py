@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import math
+from typing import Optional
+
+MAD_SCALE = 1.4826
+
+
+class QuantileSketch:
+    # DDSketch-style log-bucketed sketch of the deviations (value - center) / scale. Quantiles carry a
+    # relative error of `relative_accuracy` on the deviation, points can be removed as well as added,
+    # and sketches built with the same parameters merge by adding bucket counts. Deviations are bounded
+    # below by `min_deviation` (smaller ones share the zero bucket), so the bucket count stays bounded.
+
+    def __init__(
+        self,
+        center: float,
+        scale: float,
+        relative_accuracy: float = 0.005,
+        min_deviation: float = 1e-6,
+    ):
+        self.center = center
+        self.scale = scale if scale > 0 else 1.0
+        self.relative_accuracy = relative_accuracy
+        self.min_deviation = min_deviation
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive: dict[int, int] = {}
+        self.negative: dict[int, int] = {}
+        self.zero = 0
+        self.count = 0
+
+    def _locate(self, value: float) -> tuple[Optional[dict[int, int]], int]:
+        deviation = (value - self.center) / self.scale
+        if abs(deviation) < self.min_deviation:
+            return None, 0
+        store = self.positive if deviation > 0 else self.negative
+        return store, math.ceil(math.log(abs(deviation)) / self._log_gamma)
+
+    def _deviation(self, key: int) -> float:
+        return 2 * self.gamma**key / (self.gamma + 1)
+
+    def add(self, value: float, count: int = 1) -> None:
+        store, key = self._locate(value)
+        if store is None:
+            self.zero += count
+        else:
+            store[key] = store.get(key, 0) + count
+        self.count += count
+
+    def remove(self, value: float, count: int = 1) -> None:
+        store, key = self._locate(value)
+        if store is None:
+            if self.zero < count:
+                raise ValueError("Value is not in the sketch")
+            self.zero -= count
+        else:
+            remaining = store.get(key, 0) - count
+            if remaining < 0:
+                raise ValueError("Value is not in the sketch")
+            if remaining:
+                store[key] = remaining
+            else:
+                del store[key]
+        self.count -= count
+
+    def merge(self, other: QuantileSketch) -> None:
+        if (other.center, other.scale, other.relative_accuracy, other.min_deviation) != (
+            self.center,
+            self.scale,
+            self.relative_accuracy,
+            self.min_deviation,
+        ):
+            raise ValueError("Sketches with different parameters cannot be merged")
+        for key, count in other.positive.items():
+            self.positive[key] = self.positive.get(key, 0) + count
+        for key, count in other.negative.items():
+            self.negative[key] = self.negative.get(key, 0) + count
+        self.zero += other.zero
+        self.count += other.count
+
+    def buckets(self) -> list[tuple[float, int]]:
+        # (representative value, count) in ascending value order.
+        buckets = [
+            (self.center - self.scale * self._deviation(key), count)
+            for key, count in sorted(self.negative.items(), reverse=True)
+        ]
+        if self.zero:
+            buckets.append((self.center, self.zero))
+        buckets.extend(
+            (self.center + self.scale * self._deviation(key), count) for key, count in sorted(self.positive.items())
+        )
+        return buckets
+
+    def quantile(self, q: float) -> Optional[float]:
+        return _weighted_quantile(self.buckets(), self.count, q)
+
+    def to_dict(self) -> dict:
+        return {
+            "center": self.center,
+            "scale": self.scale,
+            "relative_accuracy": self.relative_accuracy,
+            "min_deviation": self.min_deviation,
+            "positive": {str(key): count for key, count in self.positive.items()},
+            "negative": {str(key): count for key, count in self.negative.items()},
+            "zero": self.zero,
+            "count": self.count,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> QuantileSketch:
+        sketch = cls(data["center"], data["scale"], data["relative_accuracy"], data["min_deviation"])
+        sketch.positive = {int(key): count for key, count in data["positive"].items()}
+        sketch.negative = {int(key): count for key, count in data["negative"].items()}
+        sketch.zero = data["zero"]
+        sketch.count = data["count"]
+        return sketch
+
+
+def _weighted_quantile(buckets: list[tuple[float, int]], total: int, q: float) -> Optional[float]:
+    # Linear interpolation between the two closest ranks, like numpy's default quantile.
+    if not total:
+        return None
+    rank = q * (total - 1)
+    lower_rank = math.floor(rank)
+    lower = None
+    cumulative = 0
+    for value, count in buckets:
+        cumulative += count
+        if lower is None and cumulative > lower_rank:
+            lower = value
+        if cumulative > lower_rank + 1 or (cumulative > rank and rank == lower_rank):
+            return lower + (rank - lower_rank) * (value - lower)
+    return buckets[-1][0]
+
+
+def median_mad(sketch: QuantileSketch) -> Optional[tuple[float, float]]:
+    # Median and the normal-consistent MAD (1.4826 x median absolute deviation from the median).
+    median = sketch.quantile(0.5)
+    if median is None:
+        return None
+    distances = sorted((abs(value - median), count) for value, count in sketch.buckets())
+    mad = _weighted_quantile(distances, sketch.count, 0.5)
+    return median, MAD_SCALE * mad
+
+
+def trimmed_mean(sketch: QuantileSketch, trim: float) -> Optional[float]:
+    # Mean of the points between the `trim` and `1 - trim` ranks; edge buckets count partially.
+    if not sketch.count:
+        return None
+    lower = trim * sketch.count
+    upper = sketch.count - lower
+    cumulative = 0.0
+    weight = 0.0
+    total = 0.0
+    for value, count in sketch.buckets():
+        kept = max(0.0, min(cumulative + count, upper) - max(cumulative, lower))
+        weight += kept
+        total += kept * value
+        cumulative += count
+    return total / weight if weight else sketch.quantile(0.5)
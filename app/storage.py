@@ -1,35 +1,63 @@
 from __future__ import annotations
 
 import hashlib
-from datetime import datetime, timezone
-from typing import Optional, Tuple
-
-from sqlmodel import Session, select
-
+import math
+import os
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import and_, func, not_, or_
+from sqlmodel import Session, delete, select
+
+from app.cache import (
+    RollingBaseline,
+    VersionHistory,
+    WindowPoint,
+    api_key_cache,
+    baseline_state_cache,
+    check_out,
+    prior_config_cache,
+    stage,
+    stream_config_cache,
+    window_cache,
+)
 from app.db_models import (
     AlertRecord,
     ApiKey,
     Analyte,
     AuditEntry,
+    BaselineStats,
     Capa,
     CapaLink,
+    ChangePointCheckpoint,
     DEFAULT_RULE_SET,
+    DriftCheckpoint,
     IngestionReceipt,
     Instrument,
     Investigation,
     InvestigationAlertLink,
     Method,
+    PosteriorCheckpoint,
     PriorConfig,
     QCEvent,
     QCRecord,
     StreamConfig,
 )
 from app.models import (
+    BaselineMethod,
+    BaselineMode,
     DuplicateStatus,
     PriorConfigIn,
     Role,
     StreamConfigIn,
 )
+from app.sketch import QuantileSketch, median_mad, trimmed_mean
+
+# The posterior, drift filter and change-point detector are checkpointed every CHECKPOINT_INTERVAL of their
+# records, so an exclusion or a late point only replays the records after the nearest checkpoint instead of
+# the whole stream.
+CHECKPOINT_INTERVAL = int(os.getenv("BAYESIANQC_CHECKPOINT_INTERVAL", "500"))
 
 
 def utcnow() -> datetime:
@@ -118,19 +146,23 @@ def seed_defaults(session: Session) -> None:
     if api_key:
         if api_key.role != Role.ADMIN:
             api_key.role = Role.ADMIN
-            session.add(api_key)
-            session.commit()
+            update_api_key(session, api_key)
     else:
         session.add(ApiKey(key_hash=key_hash, role=Role.ADMIN, description="local dev key"))
         session.commit()
 
 
-def create_stream_config(session: Session, payload: StreamConfigIn, created_by: str) -> StreamConfig:
-    current_version = session.exec(
-        select(StreamConfig.version).where(StreamConfig.stream_id == payload.stream_id).order_by(StreamConfig.version.desc())
-    ).first()
-    next_version = (current_version or 0) + 1
-    config = StreamConfig(
+def update_api_key(session: Session, api_key: ApiKey) -> ApiKey:
+    session.add(api_key)
+    session.commit()
+    session.refresh(api_key)
+    # Role changes and deactivation must take effect on the very next request.
+    api_key_cache.invalidate(api_key.key_hash)
+    return api_key
+
+
+def build_stream_config(payload: StreamConfigIn, version: int, created_by: str) -> StreamConfig:
+    return StreamConfig(
         stream_id=payload.stream_id,
         analyte=payload.analyte,
         method=payload.method,
@@ -150,34 +182,120 @@ def create_stream_config(session: Session, payload: StreamConfigIn, created_by:
         unit_conversions=payload.unit_conversions,
         baseline_start=payload.baseline_start,
         baseline_end=payload.baseline_end,
+        baseline_mode=payload.baseline_mode,
+        baseline_window_hours=payload.baseline_window_hours,
+        baseline_runs=payload.baseline_runs,
+        baseline_method=payload.baseline_method,
+        baseline_trim=payload.baseline_trim,
         risk_threshold_warn=payload.risk_threshold_warn,
         risk_threshold_hold=payload.risk_threshold_hold,
+        bias_threshold=payload.bias_threshold,
+        drift_model=payload.drift_model,
+        drift_level_noise_sd=payload.drift_level_noise_sd,
+        drift_rate_noise_sd=payload.drift_rate_noise_sd,
+        drift_delta_sd=payload.drift_delta_sd,
+        prior_pooling=payload.prior_pooling,
+        lot_model=payload.lot_model,
+        robust_contamination=payload.robust_contamination,
+        robust_outlier_scale=payload.robust_outlier_scale,
         rule_set=payload.rule_set or DEFAULT_RULE_SET.copy(),
         effective_from=payload.effective_from or utcnow(),
-        version=next_version,
+        version=version,
         created_by=created_by,
     )
+
+
+def create_stream_config(session: Session, payload: StreamConfigIn, created_by: str) -> StreamConfig:
+    current_version = session.exec(
+        select(StreamConfig.version).where(StreamConfig.stream_id == payload.stream_id).order_by(StreamConfig.version.desc())
+    ).first()
+    config = build_stream_config(payload, (current_version or 0) + 1, created_by)
     session.add(config)
+    session.flush()
+    # Drift and change-point checkpoints from the new version on were computed under the old one.
+    for model in (DriftCheckpoint, ChangePointCheckpoint):
+        session.exec(
+            delete(model).where(
+                model.stream_id == config.stream_id,
+                model.checkpoint_at >= naive_timestamp(config.effective_from),
+            )
+        )
+    refresh_baseline_stats(session, config)
     session.commit()
     session.refresh(config)
+    stream_config_cache.invalidate(config.stream_id)
+    window_cache.invalidate(config.stream_id)
+    baseline_state_cache.invalidate(config.stream_id)
     return config
 
 
-def get_active_stream_config(session: Session, stream_id: str, at_time: datetime) -> Optional[StreamConfig]:
-    config = session.exec(
-        select(StreamConfig)
-        .where(StreamConfig.stream_id == stream_id, StreamConfig.effective_from <= at_time)
-        .order_by(StreamConfig.effective_from.desc(), StreamConfig.version.desc())
-    ).first()
-    if config:
-        return config
+def checkpoint_before(model, timestamp: datetime, record_id: Optional[int]):
+    # Checkpoints order by (checkpoint_at, qc_record_id), the same order records are replayed in.
+    at = naive_timestamp(timestamp)
+    before = model.checkpoint_at < at
+    if record_id is not None:
+        before = or_(before, and_(model.checkpoint_at == at, model.qc_record_id < record_id))
+    return before
+
+
+def nearest_checkpoint(session: Session, model, stream_id: str, since: datetime, record_id: Optional[int] = None):
+    # The latest checkpoint strictly before (since, record_id).
     return session.exec(
-        select(StreamConfig)
-        .where(StreamConfig.stream_id == stream_id)
-        .order_by(StreamConfig.effective_from.asc(), StreamConfig.version.asc())
+        select(model)
+        .where(model.stream_id == stream_id, checkpoint_before(model, since, record_id))
+        .order_by(model.checkpoint_at.desc(), model.qc_record_id.desc())
+        .limit(1)
     ).first()
 
 
+def restart_checkpoint(session: Session, model, stream_id: str, since: datetime, record_id: Optional[int] = None):
+    # The nearest checkpoint before (since, record_id); the later ones are deleted, as the replay from it
+    # rewrites them.
+    checkpoint = nearest_checkpoint(session, model, stream_id, since, record_id)
+    session.exec(delete(model).where(model.stream_id == stream_id, not_(checkpoint_before(model, since, record_id))))
+    return checkpoint
+
+
+def records_after(query, checkpoint):
+    # Narrows a QCRecord query to the records replayed after the checkpoint.
+    if checkpoint is None:
+        return query
+    return query.where(
+        or_(
+            QCRecord.timestamp > checkpoint.checkpoint_at,
+            and_(QCRecord.timestamp == checkpoint.checkpoint_at, QCRecord.id > checkpoint.qc_record_id),
+        )
+    )
+
+
+def get_active_stream_config(session: Session, stream_id: str, at_time: datetime) -> Optional[StreamConfig]:
+    return stream_config_history(session, stream_id).active_at(at_time)
+
+
+def naive_timestamp(value: datetime) -> datetime:
+    # SQLite stores datetimes without tzinfo, so in-memory comparisons against loaded rows drop it too.
+    return value.replace(tzinfo=None)
+
+
+def _detached_versions(model, versions: Sequence) -> list:
+    # Cached versions outlive the session that loaded them, so keep plain copies rather than ORM rows.
+    return [model.model_validate(version.model_dump()) for version in versions]
+
+
+def stream_config_history(session: Session, stream_id: str) -> VersionHistory:
+    return stream_config_cache.get_or_load(
+        stream_id,
+        lambda: _detached_versions(
+            StreamConfig,
+            session.exec(
+                select(StreamConfig)
+                .where(StreamConfig.stream_id == stream_id)
+                .order_by(StreamConfig.effective_from.asc(), StreamConfig.version.asc())
+            ).all(),
+        ),
+    )
+
+
 def list_stream_configs(session: Session, stream_id: str) -> list[StreamConfig]:
     return session.exec(
         select(StreamConfig).where(StreamConfig.stream_id == stream_id).order_by(StreamConfig.version.desc())
@@ -200,44 +318,378 @@ def create_prior_config(session: Session, stream_id: str, payload: PriorConfigIn
         created_by=created_by,
     )
     session.add(config)
+    # Checkpoints were folded from the previous prior; the next replay starts from the first record.
+    session.exec(delete(PosteriorCheckpoint).where(PosteriorCheckpoint.stream_id == stream_id))
+    session.exec(delete(ChangePointCheckpoint).where(ChangePointCheckpoint.stream_id == stream_id))
     session.commit()
     session.refresh(config)
+    prior_config_cache.invalidate(stream_id)
     return config
 
 
+def prior_config_history(session: Session, stream_id: str) -> VersionHistory:
+    return prior_config_cache.get_or_load(
+        stream_id,
+        lambda: _detached_versions(
+            PriorConfig,
+            session.exec(
+                select(PriorConfig)
+                .where(PriorConfig.stream_id == stream_id)
+                .order_by(PriorConfig.effective_from.asc(), PriorConfig.version.asc())
+            ).all(),
+        ),
+    )
+
+
 def get_active_prior(session: Session, stream_id: str, at_time: datetime) -> Optional[PriorConfig]:
-    prior = session.exec(
-        select(PriorConfig)
-        .where(PriorConfig.stream_id == stream_id, PriorConfig.effective_from <= at_time)
-        .order_by(PriorConfig.effective_from.desc(), PriorConfig.version.desc())
-    ).first()
-    if prior:
-        return prior
+    return prior_config_history(session, stream_id).active_at(at_time)
+
+
+def _new_sketch(config: StreamConfig) -> QuantileSketch:
+    return QuantileSketch(center=config.target_value, scale=config.sigma)
+
+
+def _recompute_baseline(session: Session, stats: BaselineStats, shift: float) -> BaselineStats:
+    deviation = QCRecord.result_value - shift
+    count, total, total_sq = session.exec(
+        select(func.count(QCRecord.id), func.sum(deviation), func.sum(deviation * deviation)).where(
+            QCRecord.stream_id == stats.stream_id,
+            QCRecord.include_in_stats == True,
+            QCRecord.timestamp >= stats.baseline_start,
+            QCRecord.timestamp <= stats.baseline_end,
+        )
+    ).one()
+    stats.n = count
+    stats.mean = shift + total / count if count else 0.0
+    stats.m2 = max(total_sq - total**2 / count, 0.0) if count else 0.0
+    stats.updated_at = utcnow()
+    session.add(stats)
+    return stats
+
+
+def refresh_baseline_stats(session: Session, config: StreamConfig) -> Optional[BaselineStats]:
+    if config.baseline_mode != BaselineMode.FIXED or not (config.baseline_start and config.baseline_end):
+        return None
+    stats = session.exec(select(BaselineStats).where(BaselineStats.stream_config_id == config.id)).first()
+    if stats is None:
+        stats = BaselineStats(
+            stream_config_id=config.id,
+            stream_id=config.stream_id,
+            baseline_start=naive_timestamp(config.baseline_start),
+            baseline_end=naive_timestamp(config.baseline_end),
+        )
+    stats = _recompute_baseline(session, stats, config.target_value)
+    if config.baseline_method != BaselineMethod.CLASSICAL:
+        sketch = _new_sketch(config)
+        for value in session.exec(
+            select(QCRecord.result_value).where(
+                QCRecord.stream_id == stats.stream_id,
+                QCRecord.include_in_stats == True,
+                QCRecord.timestamp >= stats.baseline_start,
+                QCRecord.timestamp <= stats.baseline_end,
+            )
+        ).all():
+            sketch.add(value)
+        stats.sketch = sketch.to_dict()
+    return stats
+
+
+def _overlapping_baselines(session: Session, stream_id: str, timestamps: Sequence[datetime]) -> list[BaselineStats]:
+    times = [naive_timestamp(ts) for ts in timestamps]
     return session.exec(
-        select(PriorConfig)
-        .where(PriorConfig.stream_id == stream_id)
-        .order_by(PriorConfig.effective_from.asc(), PriorConfig.version.asc())
-    ).first()
+        select(BaselineStats).where(
+            BaselineStats.stream_id == stream_id,
+            BaselineStats.baseline_start <= max(times),
+            BaselineStats.baseline_end >= min(times),
+        )
+    ).all()
 
 
-def baseline_stats(session: Session, config: StreamConfig, at_time: datetime) -> Optional[Tuple[float, float]]:
+def add_to_baselines(session: Session, stream_id: str, timestamps: Sequence[datetime], values: Sequence[float]) -> None:
+    # Welford-add newly included points (in any timestamp order) to every baseline window holding them.
+    if not len(timestamps):
+        return
+    times = [naive_timestamp(ts) for ts in timestamps]
+    for stats in _overlapping_baselines(session, stream_id, times):
+        start, end = naive_timestamp(stats.baseline_start), naive_timestamp(stats.baseline_end)
+        sketch = QuantileSketch.from_dict(stats.sketch) if stats.sketch else None
+        for ts, value in zip(times, values):
+            if start <= ts <= end:
+                stats.n += 1
+                delta = value - stats.mean
+                stats.mean += delta / stats.n
+                stats.m2 += delta * (value - stats.mean)
+                if sketch is not None:
+                    sketch.add(value)
+        if sketch is not None:
+            stats.sketch = sketch.to_dict()
+        stats.updated_at = utcnow()
+        session.add(stats)
+
+
+def refresh_baselines(session: Session, stream_id: str, records: Sequence[QCRecord]) -> None:
+    # `records` just had include_in_stats flipped: recompute each window holding one of them with a
+    # single aggregate, and add the reinstated / remove the excluded points from its sketch.
+    if not records:
+        return
+    for stats in _overlapping_baselines(session, stream_id, [record.timestamp for record in records]):
+        _recompute_baseline(session, stats, stats.mean)
+        if not stats.sketch:
+            continue
+        start, end = naive_timestamp(stats.baseline_start), naive_timestamp(stats.baseline_end)
+        sketch = QuantileSketch.from_dict(stats.sketch)
+        for record in records:
+            if start <= naive_timestamp(record.timestamp) <= end:
+                if record.include_in_stats:
+                    sketch.add(record.result_value)
+                else:
+                    sketch.remove(record.result_value)
+        stats.sketch = sketch.to_dict()
+
+
+class AppliedBaseline(NamedTuple):
+    mode: str
+    mean: float
+    sd: float
+    n: Optional[int]
+    method: str = BaselineMethod.CLASSICAL.value
+
+
+def _config_baseline(config: StreamConfig) -> AppliedBaseline:
+    return AppliedBaseline("config", config.target_value, config.sigma, None)
+
+
+def robust_estimate(sketch: QuantileSketch, config: StreamConfig) -> Optional[Tuple[float, float]]:
+    # (center, scale) from the sketch for the config's robust method; None when the scale degenerates.
+    if sketch.count < 2:
+        return None
+    median, scale = median_mad(sketch)
+    if scale <= 0:
+        return None
+    if config.baseline_method == BaselineMethod.TRIMMED_MEAN:
+        return trimmed_mean(sketch, config.baseline_trim), scale
+    return median, scale
+
+
+def _applied(mode: str, config: StreamConfig, n: int, mean: float, sd: float, sketch: Optional[QuantileSketch]):
+    if sketch is not None:
+        robust = robust_estimate(sketch, config)
+        if robust is not None:
+            return AppliedBaseline(mode, robust[0], robust[1], n, config.baseline_method.value)
+    return AppliedBaseline(mode, mean, sd, n)
+
+
+def fixed_baseline(session: Session, config: StreamConfig) -> AppliedBaseline:
     if config.baseline_start and config.baseline_end:
+        stats = session.exec(select(BaselineStats).where(BaselineStats.stream_config_id == config.id)).first()
+        if stats is None:
+            stats = refresh_baseline_stats(session, config)
+        # Only fixed-mode configs materialize window statistics; the others score against the config.
+        if stats is not None and stats.n >= 2:
+            sketch = QuantileSketch.from_dict(stats.sketch) if stats.sketch else None
+            sd = math.sqrt(stats.m2 / (stats.n - 1))
+            return _applied(BaselineMode.FIXED.value, config, stats.n, stats.mean, sd, sketch)
+    return _config_baseline(config)
+
+
+def baseline_stats(session: Session, config: StreamConfig, at_time: datetime) -> Optional[Tuple[float, float]]:
+    baseline = fixed_baseline(session, config)
+    return baseline.mean, baseline.sd
+
+
+def _preceding_points(
+    session: Session,
+    config: StreamConfig,
+    at: datetime,
+    record_id: Optional[int],
+) -> list[tuple[datetime, float]]:
+    before = QCRecord.timestamp < at
+    if record_id is not None:
+        before = or_(before, and_(QCRecord.timestamp == at, QCRecord.id < record_id))
+    query = select(QCRecord.timestamp, QCRecord.result_value).where(
+        QCRecord.stream_id == config.stream_id,
+        QCRecord.include_in_stats == True,
+        before,
+    )
+    if config.baseline_mode == BaselineMode.ROLLING_WINDOW:
+        cutoff = at - timedelta(hours=config.baseline_window_hours)
         rows = session.exec(
-            select(QCRecord)
-            .where(
-                QCRecord.stream_id == config.stream_id,
-                QCRecord.include_in_stats == True,
-                QCRecord.timestamp >= config.baseline_start,
-                QCRecord.timestamp <= config.baseline_end,
-            )
-            .order_by(QCRecord.timestamp)
+            query.where(QCRecord.timestamp >= cutoff).order_by(QCRecord.timestamp.asc(), QCRecord.id.asc())
         ).all()
-        if len(rows) >= 2:
-            values = [r.result_value for r in rows]
-            mean = sum(values) / len(values)
-            variance = sum((v - mean) ** 2 for v in values) / (len(values) - 1)
-            return mean, variance ** 0.5
-    return config.target_value, config.sigma
+    else:
+        rows = session.exec(
+            query.order_by(QCRecord.timestamp.desc(), QCRecord.id.desc()).limit(config.baseline_runs)
+        ).all()[::-1]
+    return [(naive_timestamp(ts), value) for ts, value in rows]
+
+
+def _has_later_points(session: Session, stream_id: str, at: datetime, record_id: Optional[int]) -> bool:
+    after = QCRecord.timestamp > at
+    if record_id is not None:
+        after = or_(after, and_(QCRecord.timestamp == at, QCRecord.id > record_id))
+    return (
+        session.exec(
+            select(QCRecord.id).where(QCRecord.stream_id == stream_id, QCRecord.include_in_stats == True, after).limit(1)
+        ).first()
+        is not None
+    )
+
+
+def _points_through(session: Session, stream_id: str, first: QCRecord, last: QCRecord) -> list[tuple]:
+    # Included points from `first` through `last` in (timestamp, id) order, with their ids.
+    at, until = naive_timestamp(first.timestamp), naive_timestamp(last.timestamp)
+    rows = session.exec(
+        select(QCRecord.timestamp, QCRecord.result_value, QCRecord.id)
+        .where(
+            QCRecord.stream_id == stream_id,
+            QCRecord.include_in_stats == True,
+            or_(QCRecord.timestamp > at, and_(QCRecord.timestamp == at, QCRecord.id >= first.id)),
+            or_(QCRecord.timestamp < until, and_(QCRecord.timestamp == until, QCRecord.id <= last.id)),
+        )
+        .order_by(QCRecord.timestamp.asc(), QCRecord.id.asc())
+    ).all()
+    return [(naive_timestamp(ts), value, record_id) for ts, value, record_id in rows]
+
+
+def rolling_baselines(session: Session, config: StreamConfig, records: Sequence[QCRecord]) -> list[AppliedBaseline]:
+    # Baselines of flushed records under one rolling config, in timestamp order. Each record sees the
+    # included points preceding it; one state is seeded before the first record and slides across the
+    # rest, picking up any stored points between them. The window is only read from the database when
+    # the stream's cached state is cold or behind the first record.
+    first, last = records[0], records[-1]
+    at = naive_timestamp(first.timestamp)
+    entry = check_out(session, baseline_state_cache, config.stream_id)
+    state = entry[1] if entry is not None and entry[0] == config.id else None
+    cold = state is None or (state.last_timestamp is not None and at < state.last_timestamp)
+    if cold:
+        sketch = _new_sketch(config) if config.baseline_method != BaselineMethod.CLASSICAL else None
+        state = RollingBaseline(_preceding_points(session, config, at, first.id), sketch=sketch)
+    if len(records) == 1:
+        points = [(at, first.result_value, first.id)]
+    else:
+        points = _points_through(session, config.stream_id, first, last)
+    positions = {record.id: i for i, record in enumerate(records)}
+    applied = [_config_baseline(config) for _ in records]
+    for timestamp, value, record_id in points:
+        if config.baseline_mode == BaselineMode.ROLLING_WINDOW:
+            state.evict_before(timestamp - timedelta(hours=config.baseline_window_hours))
+        if record_id in positions and state.n >= 2:
+            applied[positions[record_id]] = _applied(
+                config.baseline_mode.value, config, state.n, state.mean, state.sd, state.sketch
+            )
+        state.add(timestamp, value)
+        if config.baseline_mode == BaselineMode.LAST_N_RUNS:
+            state.trim_to(config.baseline_runs)
+    # The state is kept only if it ends at the stream's latest point.
+    if cold and _has_later_points(session, config.stream_id, naive_timestamp(last.timestamp), last.id):
+        stage(session, baseline_state_cache, config.stream_id, None)
+    else:
+        stage(session, baseline_state_cache, config.stream_id, (config.id, state))
+    return applied
+
+
+def resolve_baseline(session: Session, config: StreamConfig, record: QCRecord) -> AppliedBaseline:
+    # Call after the record is flushed; rolling modes advance their per-stream state past it.
+    if config.baseline_mode in (BaselineMode.ROLLING_WINDOW, BaselineMode.LAST_N_RUNS):
+        return rolling_baselines(session, config, [record])[0]
+    return fixed_baseline(session, config)
+
+
+def resolve_rolling_baselines(
+    session: Session, configs: Sequence[StreamConfig], records: Sequence[QCRecord]
+) -> dict[int, AppliedBaseline]:
+    # Rolling baselines of a stream's flushed batch rows in timestamp order, by row position. Each run of
+    # rows under one rolling config is resolved with a single sliding state.
+    applied: dict[int, AppliedBaseline] = {}
+    start = 0
+    for end in range(1, len(records) + 1):
+        if end < len(records) and configs[end].id == configs[start].id:
+            continue
+        if configs[start].baseline_mode in (BaselineMode.ROLLING_WINDOW, BaselineMode.LAST_N_RUNS):
+            applied.update(zip(range(start, end), rolling_baselines(session, configs[start], records[start:end])))
+        start = end
+    return applied
+
+
+def baseline_stats_batch(
+    session: Session,
+    configs: Sequence[StreamConfig],
+    values: np.ndarray,
+    timestamps: Sequence[datetime],
+) -> list[AppliedBaseline]:
+    # Fixed baselines as sequential ingestion would see them: the materialized window stats plus
+    # every batch row up to and including the current one. Must run before add_to_baselines;
+    # rows under a rolling mode get the config baseline here and go through resolve_baseline.
+    baselines = [_config_baseline(config) for config in configs]
+    times = [naive_timestamp(ts) for ts in timestamps]
+    windowed = {}
+    for config in configs:
+        if (
+            config.baseline_mode == BaselineMode.FIXED
+            and config.baseline_start
+            and config.baseline_end
+            and config.id not in windowed
+        ):
+            windowed[config.id] = config
+    for config_id, config in windowed.items():
+        start = naive_timestamp(config.baseline_start)
+        end = naive_timestamp(config.baseline_end)
+        stats = session.exec(select(BaselineStats).where(BaselineStats.stream_config_id == config_id)).first()
+        if stats is None:
+            stats = refresh_baseline_stats(session, config)
+        shift = config.target_value
+        in_window = np.array([start <= ts <= end for ts in times], dtype=bool)
+        shifted = np.where(in_window, values - shift, 0.0)
+        count = stats.n + np.cumsum(in_window)
+        total = stats.n * (stats.mean - shift) + np.cumsum(shifted)
+        squares = stats.m2 + stats.n * (stats.mean - shift) ** 2 + np.cumsum(shifted**2)
+        rows = np.array([config.id == cfg.id for cfg in configs], dtype=bool) & (count >= 2)
+        safe_count = np.maximum(count, 2)
+        mean = total / safe_count + shift
+        sd = np.sqrt(np.maximum(squares - safe_count * (mean - shift) ** 2, 0.0) / (safe_count - 1))
+        # Robust methods replay the batch through a copy of the persisted sketch, row by row.
+        sketch = QuantileSketch.from_dict(stats.sketch) if stats.sketch else None
+        for i in range(len(configs)):
+            if sketch is not None and in_window[i]:
+                sketch.add(float(values[i]))
+            if rows[i]:
+                baselines[i] = _applied(
+                    BaselineMode.FIXED.value, config, int(count[i]), float(mean[i]), float(sd[i]), sketch
+                )
+    return baselines
+
+
+def recent_value_windows(
+    session: Session,
+    stream_id: str,
+    timestamps: Sequence[datetime],
+    values: np.ndarray,
+    limit: int,
+) -> np.ndarray:
+    # For each (time-sorted) batch row, the `limit` included values strictly before it, oldest first,
+    # left-padded with NaN. Committed rows are merged with earlier batch rows as sequential ingestion would.
+    times = np.array([naive_timestamp(ts) for ts in timestamps], dtype="datetime64[us]")
+    before = get_recent_records(session, stream_id, timestamps[0], limit)
+    between = session.exec(
+        select(QCRecord.timestamp, QCRecord.result_value)
+        .where(
+            QCRecord.stream_id == stream_id,
+            QCRecord.include_in_stats == True,
+            QCRecord.timestamp >= timestamps[0],
+            QCRecord.timestamp < timestamps[-1],
+        )
+        .order_by(QCRecord.timestamp.asc())
+    ).all()
+    stored_times = [naive_timestamp(r.timestamp) for r in before] + [naive_timestamp(ts) for ts, _ in between]
+    stored_values = [r.result_value for r in before] + [value for _, value in between]
+    merged_times = np.concatenate([np.array(stored_times, dtype="datetime64[us]"), times])
+    merged_values = np.concatenate([np.array(stored_values, dtype=float), values])
+    order = np.argsort(merged_times, kind="stable")
+    merged_times = merged_times[order]
+    merged_values = merged_values[order]
+    ends = np.searchsorted(merged_times, times, side="left")
+    index = ends[:, None] - limit + np.arange(limit)
+    return np.where(index >= 0, merged_values[np.clip(index, 0, None)], np.nan)
 
 
 def detect_duplicate(session: Session, record: QCRecord) -> DuplicateStatus:
@@ -272,16 +724,103 @@ def get_recent_records(session: Session, stream_id: str, before: datetime, limit
     ).all()[::-1]
 
 
+# The value the posterior and drift filter see: the result less the offset of its lot, stamped at ingest.
+LOT_ADJUSTED_VALUE = QCRecord.result_value - func.coalesce(QCRecord.lot_offset, 0.0)
+
+
+def _history_query(query, stream_id: str, since: Optional[datetime]):
+    query = query.where(QCRecord.stream_id == stream_id).order_by(QCRecord.timestamp.asc(), QCRecord.id.asc())
+    return query if since is None else query.where(QCRecord.timestamp >= naive_timestamp(since))
+
+
+def stream_history_arrays(
+    session: Session, stream_id: str, since: Optional[datetime] = None
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # (timestamps, values, include flags) of every record in the stream from `since`, in (timestamp, id) order.
+    rows = session.exec(
+        _history_query(select(QCRecord.timestamp, QCRecord.result_value, QCRecord.include_in_stats), stream_id, since)
+    ).all()
+    times = np.array([naive_timestamp(row[0]) for row in rows], dtype="datetime64[us]")
+    values = np.array([row[1] for row in rows], dtype=float)
+    included = np.array([bool(row[2]) for row in rows], dtype=bool)
+    return times, values, included
+
+
+def stream_lot_offsets(session: Session, stream_id: str, since: Optional[datetime] = None) -> np.ndarray:
+    # The stamped lot offset of every record in stream_history_arrays order, 0 where the lot model was off.
+    offsets = session.exec(_history_query(select(func.coalesce(QCRecord.lot_offset, 0.0)), stream_id, since)).all()
+    return np.array(offsets, dtype=float)
+
+
+def included_run_before(session: Session, stream_id: str, before: datetime, runs: int) -> Optional[datetime]:
+    # Timestamp of the `runs`-th last included record before `before`; None when there are fewer.
+    return session.exec(
+        select(QCRecord.timestamp)
+        .where(
+            QCRecord.stream_id == stream_id,
+            QCRecord.include_in_stats == True,
+            QCRecord.timestamp < naive_timestamp(before),
+        )
+        .order_by(QCRecord.timestamp.desc(), QCRecord.id.desc())
+        .offset(max(runs, 1) - 1)
+        .limit(1)
+    ).first()
+
+
+def detect_duplicates_batch(session: Session, records: Sequence[QCRecord]) -> list[DuplicateStatus]:
+    if not records:
+        return []
+    stream_id = records[0].stream_id
+    stored = session.exec(
+        select(QCRecord.timestamp, QCRecord.result_value, QCRecord.run_id).where(
+            QCRecord.stream_id == stream_id,
+            QCRecord.timestamp.in_([record.timestamp for record in records]),
+        )
+    ).all()
+    exact = {(naive_timestamp(ts), value, run_id) for ts, value, run_id in stored}
+    seen = {key[0] for key in exact}
+    statuses = []
+    for record in records:
+        ts = naive_timestamp(record.timestamp)
+        key = (ts, record.result_value, record.run_id)
+        if key in exact:
+            statuses.append(DuplicateStatus.DUPLICATE)
+        elif ts in seen:
+            statuses.append(DuplicateStatus.POSSIBLE_DUPLICATE)
+        else:
+            statuses.append(DuplicateStatus.UNIQUE)
+        exact.add(key)
+        seen.add(ts)
+    return statuses
+
+
+def latest_window_points(session: Session, stream_id: str, limit: int) -> list[WindowPoint]:
+    rows = session.exec(
+        select(QCRecord.timestamp, QCRecord.result_value)
+        .where(QCRecord.stream_id == stream_id, QCRecord.include_in_stats == True)
+        .order_by(QCRecord.timestamp.desc())
+        .limit(limit)
+    ).all()
+    return [WindowPoint(naive_timestamp(ts), value, True) for ts, value in reversed(rows)]
+
+
 def get_idempotent_response(session: Session, key: str) -> Optional[IngestionReceipt]:
     return session.exec(select(IngestionReceipt).where(IngestionReceipt.idempotency_key == key)).first()
 
 
-def store_receipt(session: Session, key: Optional[str], response: dict, record_id: Optional[int]) -> None:
+def store_receipt(
+    session: Session,
+    key: Optional[str],
+    response: dict,
+    record_id: Optional[int],
+    commit: bool = True,
+) -> None:
     if not key:
         return
     receipt = IngestionReceipt(idempotency_key=key, response=response, qc_record_id=record_id)
     session.add(receipt)
-    session.commit()
+    if commit:
+        session.commit()
 
 
 def record_audit(
@@ -293,6 +832,7 @@ def record_audit(
     before: Optional[dict],
     after: Optional[dict],
     reason: Optional[str],
+    commit: bool = True,
 ) -> AuditEntry:
     entry = AuditEntry(
         actor=actor,
@@ -304,8 +844,9 @@ def record_audit(
         reason=reason,
     )
     session.add(entry)
-    session.commit()
-    session.refresh(entry)
+    if commit:
+        session.commit()
+        session.refresh(entry)
     return entry
 
 
@@ -316,10 +857,11 @@ def create_event(session: Session, event: QCEvent) -> QCEvent:
     return event
 
 
-def create_alert(session: Session, alert: AlertRecord) -> AlertRecord:
+def create_alert(session: Session, alert: AlertRecord, commit: bool = True) -> AlertRecord:
     session.add(alert)
-    session.commit()
-    session.refresh(alert)
+    if commit:
+        session.commit()
+        session.refresh(alert)
     return alert
 
 
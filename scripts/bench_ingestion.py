@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+
+def build_payload(index: int, start: datetime) -> dict:
+    return {
+        "stream_id": "hba1c-arch",
+        "result_value": 5.2 + 0.25 * ((index * 7919) % 13 - 6) / 6,
+        "timestamp": (start + timedelta(minutes=index)).isoformat(),
+        "analyte": "HbA1c",
+        "qc_level": "Level 1",
+        "instrument_id": "Architect",
+        "method_id": "HPLC",
+        "operator_id": "bench",
+        "reagent_lot": "RL-001",
+        "control_material_lot": "LOT-001",
+        "calibration_status": "ok",
+        "run_id": f"run-{index}",
+        "units": "%",
+        "flags": [],
+        "entry_source": "automated",
+        "comments": None,
+    }
+
+
+def use_per_step_commits(main_module, bayesian_module) -> None:
+    # Restores the pre-unit-of-work behaviour: the record insert, the posterior update, the audit entry,
+    # the alert and the receipt each commit on their own.
+    def committing(step):
+        def wrapper(session, *args, **kwargs):
+            if "commit" in kwargs:
+                kwargs["commit"] = True
+            result = step(session, *args, **kwargs)
+            session.commit()
+            return result
+
+        return wrapper
+
+    def commit_record_first(step):
+        def wrapper(session, *args, **kwargs):
+            session.commit()
+            return step(session, *args, **kwargs)
+
+        return wrapper
+
+    main_module.add_to_baselines = commit_record_first(main_module.add_to_baselines)
+    bayesian_module.infer_risk = committing(bayesian_module.infer_risk)
+    for name in ("record_audit", "create_alert", "store_receipt"):
+        setattr(main_module, name, committing(getattr(main_module, name)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure per-record latency of process_ingestion on SQLite.")
+    parser.add_argument("--records", type=int, default=500, help="Number of QC records to ingest (default: 500)")
+    parser.add_argument("--idempotency", action="store_true", help="Send an idempotency key with every record")
+    parser.add_argument(
+        "--per-step-commit",
+        action="store_true",
+        help="Commit after every ingestion step, as before the single-transaction path, for a before/after baseline",
+    )
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bayesianqc-bench-")
+    os.environ["BAYESIANQC_DB_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+
+    from sqlmodel import Session
+
+    import app.main as main_module
+    from app import bayesian
+    from app.db import get_engine, init_db
+    from app.models import QCRecordIn, Role
+    from app.rbac import UserContext
+    from app.storage import seed_defaults
+
+    init_db()
+    if args.per_step_commit:
+        use_per_step_commits(main_module, bayesian)
+    with Session(get_engine()) as session:
+        seed_defaults(session)
+
+    user = UserContext(role=Role.ADMIN)
+    start = datetime.now(timezone.utc)
+    timings = []
+    with Session(get_engine()) as session:
+        for index in range(args.records):
+            payload = QCRecordIn.model_validate(build_payload(index, start))
+            key = f"bench-{index}" if args.idempotency else None
+            began = time.perf_counter()
+            main_module.process_ingestion(payload, session, user, key)
+            timings.append((time.perf_counter() - began) * 1000)
+
+    timings.sort()
+    print(f"mode: {'per-step commits' if args.per_step_commit else 'single transaction'}")
+    print(f"records: {len(timings)}")
+    print(f"mean ms/record: {statistics.fmean(timings):.3f}")
+    print(f"p50 ms/record: {timings[len(timings) // 2]:.3f}")
+    print(f"p95 ms/record: {timings[int(len(timings) * 0.95) - 1]:.3f}")
+    print(f"total s: {sum(timings) / 1000:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+import argparse
+
+from sqlmodel import Session
+
+from app import hierarchy
+from app.db import get_engine, init_db
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Refit the cross-instrument hierarchy and refresh pooled priors.")
+    parser.add_argument("--actor", default="cli", help="Recorded as created_by on the fits, priors and audit entries")
+    args = parser.parse_args()
+
+    init_db()
+    with Session(get_engine()) as session:
+        refit = hierarchy.refit_hierarchy(session, args.actor)
+        for fit in refit.fits:
+            print(
+                f"{fit.analyte} / {fit.method} / {fit.qc_level}: streams={fit.streams} points={fit.points} "
+                f"offset={fit.offset:.4g} between_sd={fit.between_sd:.4g} within_sd={fit.within_sd:.4g} "
+                f"kappa0={fit.kappa0:.3g} alpha0={fit.alpha0:.3g}"
+            )
+    print(f"Pooled priors updated: {', '.join(refit.pooled_streams) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
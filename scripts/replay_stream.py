@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+import numpy as np
+from sqlmodel import Session
+
+from app.db import get_engine, init_db
+from app.replay import replay_stream, signal_counts
+from app.storage import prior_config_history, stream_config_history, stream_history_arrays, stream_lot_offsets
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Recompute rule flags and Bayesian risk for a stream's history.")
+    parser.add_argument("stream_id", help="Stream to replay")
+    parser.add_argument("--output", help="Write every replayed column to this .npz file")
+    args = parser.parse_args()
+
+    init_db()
+    with Session(get_engine()) as session:
+        configs = stream_config_history(session, args.stream_id).versions
+        if not configs:
+            raise SystemExit(f"Stream not configured: {args.stream_id}")
+        priors = prior_config_history(session, args.stream_id).versions
+        times, values, included = stream_history_arrays(session, args.stream_id)
+        offsets = stream_lot_offsets(session, args.stream_id)
+
+    started = time.perf_counter()
+    result = replay_stream(values, times, configs, priors, included, offsets)
+    elapsed = time.perf_counter() - started
+
+    print(f"Replayed {len(values)} points in {elapsed:.2f}s")
+    for name, count in signal_counts(result).items():
+        print(f"  {name}: {count}")
+    if len(values):
+        print(f"Max risk score: {int(result.risk_score.max())}")
+    if args.output:
+        columns = {name: value for name, value in result._asdict().items() if name != "flags"}
+        columns.update({f"flag_{name}": fired for name, fired in result.flags.items()})
+        np.savez_compressed(args.output, **columns)
+        print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+import argparse
+import json
+
+from sqlmodel import Session
+
+from app import backtest
+from app.db import get_engine, init_db
+from app.models import BacktestCandidate, BacktestScenario
+
+
+def _load(path):
+    with open(path, encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Backtest a candidate rule set, prior and thresholds across streams.")
+    parser.add_argument("--name", help="Artifact name; repeated runs under one name get increasing versions")
+    parser.add_argument("--candidate", help="JSON file with rule_set, limits, risk thresholds and/or prior")
+    parser.add_argument("--scenario", help="JSON file with a synthetic shift/drift scenario (default: history)")
+    parser.add_argument("--streams", nargs="*", help="Streams to include (default: every configured stream)")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--resume", type=int, help="Resume an interrupted run by ID instead of starting one")
+    args = parser.parse_args()
+
+    init_db()
+    with Session(get_engine()) as session:
+        if args.resume is not None:
+            run_id = args.resume
+        else:
+            if not args.name:
+                raise SystemExit("--name is required unless resuming")
+            candidate = BacktestCandidate(**(_load(args.candidate) if args.candidate else {}))
+            scenario = BacktestScenario(**_load(args.scenario)) if args.scenario else None
+            configured = backtest.configured_streams(session)
+            stream_ids = args.streams or configured
+            unknown = sorted(set(stream_ids) - set(configured))
+            if unknown:
+                raise SystemExit(f"Streams not configured: {', '.join(unknown)}")
+            run_id = backtest.create_run(
+                session,
+                args.name,
+                candidate.model_dump(mode="json"),
+                scenario.model_dump(mode="json") if scenario else None,
+                stream_ids,
+                "cli",
+            ).id
+        run = backtest.run_backtest(session, run_id, args.workers)
+
+    print(f"Backtest {run.id} ({run.name} v{run.version}): {run.status}")
+    summary = run.summary or {}
+    print(f"  streams: {summary.get('streams', 0)}, points: {summary.get('points', 0)}")
+    for policy, metrics in summary.get("policies", {}).items():
+        print(
+            f"  {policy}: sensitivity={metrics['sensitivity']} specificity={metrics['specificity']} "
+            f"delay={metrics['detection_delay']} alerts/1000={metrics['alerts_per_1000']}"
+        )
+    if run.artifact_digest:
+        print(f"  artifact sha256: {run.artifact_digest}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,10 @@
 import os
 import pathlib
 import sys
+from datetime import datetime, timedelta, timezone
 
 import pytest
+from fastapi.testclient import TestClient
 from sqlmodel import Session, delete
 
 ROOT = pathlib.Path(__file__).resolve().parents[1]
@@ -12,27 +14,98 @@ if str(ROOT) not in sys.path:
 TEST_DB_PATH = pathlib.Path("/tmp/bayesianqc_test.db")
 os.environ.setdefault("BAYESIANQC_DB_URL", f"sqlite:///{TEST_DB_PATH}")
 
+from app.cache import (
+    api_key_cache,
+    baseline_state_cache,
+    lot_state_cache,
+    prior_config_cache,
+    stream_config_cache,
+    window_cache,
+)
 from app.db import get_engine, init_db
 from app.db_models import (
     AlertRecord,
     ApiKey,
     Analyte,
     AuditEntry,
+    BacktestRun,
+    BacktestStreamResult,
+    BaselineStats,
     Capa,
     CapaLink,
+    ChangePointCheckpoint,
+    ChangePointState,
+    ControlChartState,
+    DriftCheckpoint,
+    DriftState,
+    HierarchyFit,
+    IngestionOutbox,
     IngestionReceipt,
     Instrument,
     Investigation,
     InvestigationAlertLink,
+    LotState,
     Method,
+    PosteriorCheckpoint,
+    PosteriorHistory,
     PosteriorState,
     PriorConfig,
     QCEvent,
     QCRecord,
     StreamConfig,
 )
+from app.main import app
 from app.storage import seed_defaults
 
+START = datetime(2025, 1, 6, 8, 0, tzinfo=timezone.utc)
+client = TestClient(app)
+AUTH_HEADERS = {"X-API-Key": "local-dev-key"}
+
+
+def create_stream(stream_id: str, prior: bool = True, **overrides) -> None:
+    # An HbA1c stream at 5.2 +/- 0.25 from the day before START, with a weak prior unless prior is False;
+    # overrides replace any config field.
+    config = {
+        "stream_id": stream_id,
+        "analyte": "HbA1c",
+        "method": "HPLC",
+        "instrument": "Architect",
+        "qc_level": "Level 1",
+        "control_material_lot": "LOT-001",
+        "units": "%",
+        "target_value": 5.2,
+        "sigma": 0.25,
+        "effective_from": (START - timedelta(days=1)).isoformat(),
+        **overrides,
+    }
+    assert client.post("/streams", json=config, headers=AUTH_HEADERS).status_code == 200
+    if prior:
+        payload = {"stream_id": stream_id, "mu0": 5.2, "kappa0": 1.0, "alpha0": 2.0, "beta0": 0.0625}
+        assert client.post(f"/streams/{stream_id}/priors", json=payload, headers=AUTH_HEADERS).status_code == 200
+
+
+def qc_payload(stream_id: str, index: int, value: float, **overrides) -> dict:
+    # One automated HbA1c result per hour from START; overrides replace any field.
+    return {
+        "stream_id": stream_id,
+        "result_value": value,
+        "timestamp": (START + timedelta(hours=index)).isoformat(),
+        "analyte": "HbA1c",
+        "qc_level": "Level 1",
+        "instrument_id": "Architect",
+        "method_id": "HPLC",
+        "operator_id": "tech1",
+        "reagent_lot": "RL-001",
+        "control_material_lot": "LOT-001",
+        "calibration_status": "ok",
+        "run_id": f"run-{index}",
+        "units": "%",
+        "flags": [],
+        "entry_source": "automated",
+        "comments": None,
+        **overrides,
+    }
+
 
 @pytest.fixture(autouse=True)
 def reset_db():
@@ -40,6 +113,9 @@ def reset_db():
     init_db()
     with Session(get_engine()) as session:
         for table in [
+            BacktestStreamResult,
+            BacktestRun,
+            IngestionOutbox,
             IngestionReceipt,
             AlertRecord,
             QCRecord,
@@ -49,6 +125,16 @@ def reset_db():
             CapaLink,
             Capa,
             AuditEntry,
+            BaselineStats,
+            ChangePointCheckpoint,
+            ChangePointState,
+            ControlChartState,
+            DriftCheckpoint,
+            DriftState,
+            HierarchyFit,
+            LotState,
+            PosteriorCheckpoint,
+            PosteriorHistory,
             PosteriorState,
             PriorConfig,
             StreamConfig,
@@ -60,6 +146,12 @@ def reset_db():
             session.exec(delete(table))
         session.commit()
         seed_defaults(session)
+    window_cache.clear()
+    stream_config_cache.clear()
+    prior_config_cache.clear()
+    api_key_cache.clear()
+    baseline_state_cache.clear()
+    lot_state_cache.clear()
     yield
     get_engine().dispose()
     if db_path.exists():
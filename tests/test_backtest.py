@@ -0,0 +1,121 @@
+import random
+
+import numpy as np
+import pytest
+from conftest import create_stream, qc_payload
+from fastapi.testclient import TestClient
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session
+
+from app import backtest
+from app.db import get_engine
+from app.db_models import BacktestStreamResult
+from app.main import app
+
+client = TestClient(app)
+AUTH_HEADERS = {"X-API-Key": "local-dev-key"}
+
+
+def test_synthetic_scenario_backtest_is_versioned_and_reproducible(monkeypatch):
+    monkeypatch.setenv("BAYESIANQC_BACKTEST_WORKERS", "1")
+    for stream_id in ("bt-a", "bt-b"):
+        create_stream(stream_id)
+    request = {
+        "name": "cusum-candidate",
+        "stream_ids": ["bt-a", "bt-b"],
+        "candidate": {"rule_set": {"rules": ["1-3s", "2-2s", "CUSUM"]}, "risk_threshold_warn": 60},
+        "scenario": {"kind": "shift", "magnitude_sd": 2.5, "points": 300, "onset": 150, "seed": 1},
+    }
+    first = client.post("/backtests", json=request, headers=AUTH_HEADERS)
+    assert first.status_code == 200
+    run = client.get(f"/backtests/{first.json()['id']}", headers=AUTH_HEADERS).json()
+    assert run["status"] == "completed"
+    assert (run["version"], run["completed_streams"], run["failed_streams"]) == (1, 2, 0)
+
+    summary = run["summary"]
+    assert (summary["streams"], summary["points"], summary["positives"]) == (2, 600, 300)
+    for policy in backtest.POLICIES:
+        pooled = summary["policies"][policy]
+        for field in backtest.COUNT_FIELDS:
+            assert pooled[field] == sum(stream["metrics"]["policies"][policy][field] for stream in run["streams"])
+        assert pooled["episodes"] == 2
+    rules = summary["policies"]["rules"]
+    assert rules["sensitivity"] > 0.9
+    assert rules["specificity"] > 0.8
+    assert rules["detected"] == 2 and rules["detection_delay"] < 5
+
+    again = client.post("/backtests", json=request, headers=AUTH_HEADERS).json()
+    again = client.get(f"/backtests/{again['id']}", headers=AUTH_HEADERS).json()
+    assert again["version"] == 2
+    assert again["artifact_digest"] == run["artifact_digest"]
+
+    drift = {**request, "scenario": {**request["scenario"], "kind": "drift"}}
+    drift = client.post("/backtests", json=drift, headers=AUTH_HEADERS).json()
+    drift = client.get(f"/backtests/{drift['id']}", headers=AUTH_HEADERS).json()
+    assert drift["version"] == 3
+    assert drift["status"] == "completed" and drift["artifact_digest"] != run["artifact_digest"]
+    # The ramp starts small, so detection lags the step change.
+    assert drift["summary"]["policies"]["rules"]["detection_delay"] > rules["detection_delay"]
+
+    bad_rule = {**request, "candidate": {"rule_set": {"rules": [{"name": "bad", "type": "median", "n": 3}]}}}
+    assert client.post("/backtests", json=bad_rule, headers=AUTH_HEADERS).status_code == 422
+    unknown = {**request, "stream_ids": ["bt-a", "missing"]}
+    assert client.post("/backtests", json=unknown, headers=AUTH_HEADERS).status_code == 404
+
+
+def test_historical_backtest_runs_in_a_process_pool_and_resumes():
+    create_stream("bt-hist")
+    rng = random.Random(11)
+    values = [round(5.2 + (0.9 if 25 <= i < 33 else 0.0) + rng.gauss(0, 0.25), 3) for i in range(60)]
+    response = client.post(
+        "/qc/records/batch", json=[qc_payload("bt-hist", i, v) for i, v in enumerate(values)], headers=AUTH_HEADERS
+    )
+    record_ids = [item["record_id"] for item in response.json()["results"]]
+    # Reviewers excluded the shifted runs; those are the points the policies should have alarmed on.
+    response = client.patch(
+        "/qc/records/resolution",
+        json={"include_in_stats": False, "record_ids": record_ids[25:33]},
+        headers=AUTH_HEADERS,
+    )
+    assert response.status_code == 200
+
+    with Session(get_engine()) as session:
+        run = backtest.create_run(session, "historical", {}, None, ["bt-hist", "hba1c-arch"], "test")
+        run = backtest.run_backtest(session, run.id, workers=2)
+        assert run.status == "completed"
+        results = {result.stream_id: result for result in backtest.run_results(session, run.id)}
+        assert results["bt-hist"].metrics["positives"] == 8
+        assert results["bt-hist"].metrics["policies"]["rules"]["episodes"] == 1
+        assert results["hba1c-arch"].metrics["points"] == 0
+        inline = backtest.backtest_stream("bt-hist", {}, None)
+        assert inline["metrics"] == results["bt-hist"].metrics
+
+        # Simulate an interruption after one stream: resuming recomputes only the missing stream.
+        digest = run.artifact_digest
+        kept = results["hba1c-arch"].id
+        session.delete(session.get(BacktestStreamResult, results["bt-hist"].id))
+        run.status, run.artifact_digest = "running", None
+        session.add(run)
+        session.commit()
+        # A running run is not claimed a second time, and a stream has one result per run.
+        assert client.post(f"/backtests/{run.id}/resume", headers=AUTH_HEADERS).status_code == 409
+        assert backtest.run_backtest(session, run.id, workers=1).status == "running"
+        session.add(BacktestStreamResult(run_id=run.id, stream_id="hba1c-arch", metrics={}))
+        with pytest.raises(IntegrityError):
+            session.commit()
+        session.rollback()
+
+        run.status = "failed"
+        session.add(run)
+        session.commit()
+        assert client.post(f"/backtests/{run.id}/resume", headers=AUTH_HEADERS).status_code == 200
+        session.refresh(run)
+        results = {result.stream_id: result for result in backtest.run_results(session, run.id)}
+        assert run.status == "completed" and run.artifact_digest == digest
+        assert results["hba1c-arch"].id == kept
+        assert client.post(f"/backtests/{run.id}/resume", headers=AUTH_HEADERS).status_code == 409
+
+    alarm = np.array([0, 0, 1, 0, 0, 0, 1, 1, 0, 0], dtype=bool)
+    truth = np.array([0, 1, 1, 1, 0, 1, 1, 0, 1, 1], dtype=bool)
+    counts = backtest.confusion_counts(alarm, truth)
+    assert counts == {"tp": 2, "fp": 1, "tn": 2, "fn": 5, "alerts": 3, "episodes": 3, "detected": 2, "delay_total": 2}
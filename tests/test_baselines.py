@@ -0,0 +1,262 @@
+import json
+import random
+import statistics
+from datetime import timedelta
+
+import numpy as np
+import pytest
+from conftest import START, create_stream, qc_payload
+from fastapi.testclient import TestClient
+from sqlmodel import Session, select
+
+from app import storage
+from app.cache import RollingBaseline, baseline_state_cache
+from app.db import get_engine
+from app.db_models import BaselineStats, QCRecord
+from app.main import app
+from app.sketch import QuantileSketch, median_mad, trimmed_mean
+
+client = TestClient(app)
+AUTH_HEADERS = {"X-API-Key": "local-dev-key"}
+VALUES = [5.2, 5.3, 5.1, 5.25, 5.4, 5.15, 5.35, 5.2, 5.05, 5.3, 5.45, 5.1, 5.2, 5.3, 5.25, 5.0, 5.35, 5.2]
+
+
+def _records(stream_id: str) -> list[QCRecord]:
+    with Session(get_engine()) as session:
+        return session.exec(
+            select(QCRecord).where(QCRecord.stream_id == stream_id).order_by(QCRecord.timestamp.asc(), QCRecord.id.asc())
+        ).all()
+
+
+def _assert_stamped_baselines(stream_id: str, preceding) -> None:
+    records = _records(stream_id)
+    for position, record in enumerate(records):
+        earlier = [other for other in records[:position] if other.include_in_stats and other.id < record.id]
+        window = [other.result_value for other in preceding(record, earlier)]
+        if len(window) >= 2:
+            assert record.baseline_n == len(window)
+            assert record.baseline_mean == pytest.approx(statistics.fmean(window), rel=1e-12)
+            assert record.baseline_sd == pytest.approx(statistics.stdev(window), rel=1e-9)
+        else:
+            assert (record.baseline_mode, record.baseline_mean, record.baseline_sd) == ("config", 5.2, 0.25)
+
+
+def test_rolling_baseline_add_and_evict_match_exact_statistics():
+    rng = random.Random(3)
+    baseline = RollingBaseline()
+    points = [(START + timedelta(minutes=i), rng.gauss(100.0, 2.0)) for i in range(400)]
+    for timestamp, value in points:
+        baseline.add(timestamp, value)
+        baseline.evict_before(timestamp - timedelta(minutes=37))
+        baseline.trim_to(30)
+        window = [v for t, v in points if timestamp - timedelta(minutes=37) <= t <= timestamp][-30:]
+        assert baseline.n == len(window)
+        assert baseline.mean == pytest.approx(statistics.fmean(window), rel=1e-12)
+        if len(window) >= 2:
+            assert baseline.sd == pytest.approx(statistics.stdev(window), rel=1e-8)
+
+
+def test_last_n_runs_baseline_is_stamped_per_record():
+    create_stream("runs-seq", baseline_mode="last_n_runs", baseline_runs=5)
+    create_stream("runs-batch", baseline_mode="last_n_runs", baseline_runs=5)
+    for index, value in enumerate(VALUES[:12]):
+        assert client.post(
+            "/qc/records", json=qc_payload("runs-seq", index, value), headers=AUTH_HEADERS
+        ).status_code == 200
+    batch = [qc_payload("runs-batch", index, value) for index, value in enumerate(VALUES[:12])]
+    assert client.post("/qc/records/batch", json=batch[::-1], headers=AUTH_HEADERS).status_code == 200
+
+    for left, right in zip(_records("runs-seq"), _records("runs-batch")):
+        assert (left.baseline_mode, left.baseline_n) == (right.baseline_mode, right.baseline_n)
+        assert left.baseline_mean == pytest.approx(right.baseline_mean, rel=1e-12)
+        assert left.baseline_sd == pytest.approx(right.baseline_sd, rel=1e-9)
+
+    excluded = _records("runs-seq")[9].id
+    response = client.patch(f"/qc/records/{excluded}/resolution", json={"include_in_stats": False}, headers=AUTH_HEADERS)
+    assert response.status_code == 200
+    late = qc_payload("runs-seq", 7, 5.28)
+    late["timestamp"] = (START + timedelta(hours=7, minutes=30)).isoformat()
+    late["run_id"] = "run-late"
+    assert client.post("/qc/records", json=late, headers=AUTH_HEADERS).status_code == 200
+    for index, value in enumerate(VALUES[12:], start=12):
+        assert client.post(
+            "/qc/records", json=qc_payload("runs-seq", index, value), headers=AUTH_HEADERS
+        ).status_code == 200
+
+    # Records ingested after the resolution no longer see the excluded point; the late record sees
+    # only what preceded it in time. Every stamp is checked against the include flags at ingest time.
+    first_after = max(record.id for record in _records("runs-batch"))
+    with Session(get_engine()) as session:
+        session.get(QCRecord, excluded).include_in_stats = True
+        session.commit()
+    _assert_stamped_baselines(
+        "runs-seq",
+        lambda record, earlier: [other for other in earlier if other.id != excluded or record.id < first_after][-5:],
+    )
+
+
+def test_rolling_window_baseline_evicts_by_time():
+    create_stream("window-seq", baseline_mode="rolling_window", baseline_window_hours=4)
+    for index, value in enumerate(VALUES):
+        assert client.post(
+            "/qc/records", json=qc_payload("window-seq", index, value), headers=AUTH_HEADERS
+        ).status_code == 200
+    _assert_stamped_baselines(
+        "window-seq",
+        lambda record, earlier: [
+            other for other in earlier if other.timestamp >= record.timestamp - timedelta(hours=4)
+        ],
+    )
+    metrics = client.get("/metrics", headers=AUTH_HEADERS).json()
+    assert metrics["baseline_cache"]["hits"] >= len(VALUES) - 1
+
+
+
+def test_batch_slides_one_rolling_state_from_a_cold_cache(monkeypatch):
+    create_stream("window-batch", baseline_mode="rolling_window", baseline_window_hours=4)
+    for index in (0, 1, 2, 4, 6):
+        assert client.post(
+            "/qc/records", json=qc_payload("window-batch", index, VALUES[index]), headers=AUTH_HEADERS
+        ).status_code == 200
+    baseline_state_cache.clear()
+    calls = []
+    preceding = storage._preceding_points
+    monkeypatch.setattr(storage, "_preceding_points", lambda *args: calls.append(args) or preceding(*args))
+
+    # The batch starts behind stored points and runs past them; one window read seeds the whole batch.
+    batch = [qc_payload("window-batch", index, VALUES[index]) for index in [3, 5, *range(7, len(VALUES))]]
+    assert client.post("/qc/records/batch", json=batch, headers=AUTH_HEADERS).json()["accepted"] == len(batch)
+    assert len(calls) == 1
+    _assert_stamped_baselines(
+        "window-batch",
+        lambda record, earlier: [
+            other for other in earlier if other.timestamp >= record.timestamp - timedelta(hours=4)
+        ],
+    )
+    # The batch ends at the stream's latest point, so its state is kept for the next ingest.
+    assert baseline_state_cache.stats()["streams"] == 1
+
+def test_rolling_modes_require_their_parameters():
+    config = {
+        "stream_id": "bad-window",
+        "analyte": "HbA1c",
+        "method": "HPLC",
+        "instrument": "Architect",
+        "qc_level": "Level 1",
+        "control_material_lot": "LOT-001",
+        "units": "%",
+        "target_value": 5.2,
+        "sigma": 0.25,
+        "baseline_mode": "rolling_window",
+    }
+    assert client.post("/streams", json=config, headers=AUTH_HEADERS).status_code == 422
+    config["baseline_mode"] = "last_n_runs"
+    config["baseline_runs"] = 1
+    assert client.post("/streams", json=config, headers=AUTH_HEADERS).status_code == 422
+
+
+def _exact_median_mad(values):
+    median = statistics.median(values)
+    return median, 1.4826 * statistics.median(abs(value - median) for value in values)
+
+
+def _exact_trimmed_mean(values, trim):
+    ordered = sorted(values)
+    cut = int(trim * len(ordered))
+    return statistics.fmean(ordered[cut : len(ordered) - cut])
+
+
+def test_quantile_sketch_tracks_exact_robust_estimates_through_removals_and_merges():
+    rng = random.Random(11)
+    values = [rng.gauss(5.2, 0.25) for _ in range(4000)] + [rng.uniform(8.0, 12.0) for _ in range(200)]
+    sketch = QuantileSketch(center=5.2, scale=0.25)
+    for value in values:
+        sketch.add(value)
+
+    def _check(sketch, values):
+        median, mad = median_mad(sketch)
+        exact_median, exact_mad = _exact_median_mad(values)
+        # Relative accuracy applies to the deviation from the center, so compare on the sigma scale.
+        assert abs(median - exact_median) <= 0.01 * 0.25
+        assert mad == pytest.approx(exact_mad, rel=0.02)
+        assert trimmed_mean(sketch, 0.1) == pytest.approx(_exact_trimmed_mean(values, 0.1), abs=0.005 * 0.25)
+        for q in (0.05, 0.25, 0.75, 0.95):
+            exact = float(np.quantile(values, q))
+            assert abs(sketch.quantile(q) - exact) <= 0.01 * abs(exact - 5.2) + 1e-9
+
+    _check(sketch, values)
+    for value in values[:1500]:
+        sketch.remove(value)
+    _check(sketch, values[1500:])
+
+    restored = QuantileSketch.from_dict(json.loads(json.dumps(sketch.to_dict())))
+    other = QuantileSketch(center=5.2, scale=0.25)
+    for value in values[:1500]:
+        other.add(value)
+    restored.merge(other)
+    _check(restored, values)
+    assert len(restored.positive) + len(restored.negative) < 2000
+    with pytest.raises(ValueError):
+        QuantileSketch(center=5.2, scale=0.25).remove(5.9)
+
+
+def test_median_mad_fixed_baseline_uses_persisted_sketch():
+    create_stream(
+        "robust-fixed",
+        baseline_method="median_mad",
+        baseline_start=START.isoformat(),
+        baseline_end=(START + timedelta(hours=30)).isoformat(),
+    )
+    values = VALUES[:10] + [9.5] + VALUES[10:]
+    for index, value in enumerate(values[:12]):
+        assert client.post(
+            "/qc/records", json=qc_payload("robust-fixed", index, value), headers=AUTH_HEADERS
+        ).status_code == 200
+    batch = [qc_payload("robust-fixed", index, value) for index, value in enumerate(values[12:], start=12)]
+    assert client.post("/qc/records/batch", json=batch, headers=AUTH_HEADERS).status_code == 200
+
+    def _check_last(records):
+        record = records[-1]
+        window = [other.result_value for other in records if other.include_in_stats]
+        median, mad = _exact_median_mad(window)
+        assert record.baseline_method == "median_mad"
+        assert abs(record.baseline_mean - median) <= 0.01 * 0.25
+        assert record.baseline_sd == pytest.approx(mad, rel=0.05)
+
+    records = _records("robust-fixed")
+    for position in range(2, len(records)):
+        _check_last(records[: position + 1])
+
+    outlier = next(record for record in records if record.result_value == 9.5)
+    response = client.patch(f"/qc/records/{outlier.id}/resolution", json={"include_in_stats": False}, headers=AUTH_HEADERS)
+    assert response.status_code == 200
+    with Session(get_engine()) as session:
+        stats = session.exec(select(BaselineStats).where(BaselineStats.stream_id == "robust-fixed")).one()
+        assert QuantileSketch.from_dict(stats.sketch).count == stats.n == len(values) - 1
+
+
+def test_trimmed_mean_last_n_runs_baseline():
+    create_stream("robust-runs", baseline_mode="last_n_runs", baseline_runs=8, baseline_method="trimmed_mean", baseline_trim=0.125)
+    values = VALUES[:6] + [9.0] + VALUES[6:]
+    for index, value in enumerate(values):
+        assert client.post(
+            "/qc/records", json=qc_payload("robust-runs", index, value), headers=AUTH_HEADERS
+        ).status_code == 200
+    records = _records("robust-runs")
+    for position, record in enumerate(records[8:], start=8):
+        window = [other.result_value for other in records[position - 8 : position]]
+        assert record.baseline_method == "trimmed_mean"
+        assert record.baseline_mean == pytest.approx(_exact_trimmed_mean(window, 0.125), abs=0.01 * 0.25)
+
+
+def test_fixed_window_on_a_rolling_config_falls_back_to_the_config():
+    create_stream(
+        "rolling-window-dates",
+        baseline_mode="last_n_runs",
+        baseline_runs=5,
+        baseline_start=START.isoformat(),
+        baseline_end=(START + timedelta(hours=8)).isoformat(),
+    )
+    with Session(get_engine()) as session:
+        config = storage.stream_config_history(session, "rolling-window-dates").versions[-1]
+        assert storage.baseline_stats(session, config, START) == (5.2, 0.25)
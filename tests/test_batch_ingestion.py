@@ -0,0 +1,142 @@
+import json
+import statistics
+from datetime import timedelta
+
+import pytest
+from conftest import START, create_stream, qc_payload
+from fastapi.testclient import TestClient
+from sqlmodel import Session, select
+
+from app.db import get_engine
+from app.db_models import BaselineStats, QCRecord
+from app.main import app
+
+client = TestClient(app)
+AUTH_HEADERS = {"X-API-Key": "local-dev-key"}
+FIXED_WINDOW = {"baseline_start": START.isoformat(), "baseline_end": (START + timedelta(hours=8)).isoformat()}
+VALUES = [5.2, 5.9, 5.75, 5.5, 5.45, 5.5, 5.3, 5.35, 5.4, 5.3, 5.45, 5.5, 4.4, 6.1, 5.1, 5.25, 5.6, 5.0, 5.8, 5.95]
+
+
+def test_batch_matches_sequential_ingestion():
+    create_stream("parity-seq", **FIXED_WINDOW)
+    create_stream("parity-batch", **FIXED_WINDOW)
+    for index, value in enumerate(VALUES[:3]):
+        for stream_id in ("parity-seq", "parity-batch"):
+            response = client.post("/qc/records", json=qc_payload(stream_id, index, value), headers=AUTH_HEADERS)
+            assert response.status_code == 200
+
+    sequential = []
+    for index, value in enumerate(VALUES[3:], start=3):
+        response = client.post("/qc/records", json=qc_payload("parity-seq", index, value), headers=AUTH_HEADERS)
+        assert response.status_code == 200
+        sequential.append(response.json())
+
+    batch_payload = [qc_payload("parity-batch", index, value) for index, value in enumerate(VALUES[3:], start=3)]
+    batch_payload.reverse()
+    response = client.post("/qc/records/batch", json=batch_payload, headers=AUTH_HEADERS)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["accepted"] == len(batch_payload)
+    batched = [item["result"] for item in body["results"]][::-1]
+
+    for expected, actual in zip(sequential, batched):
+        assert actual["qc"]["signals"] == expected["qc"]["signals"]
+        assert actual["qc"]["disposition"] == expected["qc"]["disposition"]
+        assert actual["duplicate"] == expected["duplicate"]
+        assert (actual["alert_created"] is None) == (expected["alert_created"] is None)
+        expected_risk = expected["qc"]["bayesian_risk"]
+        actual_risk = actual["qc"]["bayesian_risk"]
+        assert actual_risk["risk_score"] == expected_risk["risk_score"]
+        for field in (
+            "probability_outside_limits",
+            "probability_bias_exceeded",
+            "posterior_mean",
+            "posterior_sigma",
+            "predictive_sigma",
+        ):
+            assert actual_risk[field] == pytest.approx(expected_risk[field], rel=1e-9, abs=1e-12)
+    assert any(result["qc"]["signals"] for result in sequential)
+
+
+def test_batch_reports_row_level_errors():
+    good = qc_payload("hba1c-arch", 0, 5.2)
+    bad_units = qc_payload("hba1c-arch", 1, 5.3)
+    bad_units["units"] = "mmol/L"
+    unknown = qc_payload("unknown-stream", 2, 5.1)
+    response = client.post("/qc/records/batch", json=[good, bad_units, unknown], headers=AUTH_HEADERS)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["accepted"] == 1
+    assert body["errors"] == 2
+    assert [item["status"] for item in body["results"]] == ["accepted", "error", "error"]
+    assert body["results"][1]["error"] == "Units do not match stream configuration"
+    assert body["results"][2]["error"] == "Stream not configured"
+
+
+def test_streaming_csv_emits_ndjson_rows_and_summary():
+    header = (
+        "stream_id,result_value,timestamp,analyte,qc_level,instrument_id,method_id,operator_id,reagent_lot,"
+        "control_material_lot,calibration_status,run_id,units,flags,entry_source,comments"
+    )
+    row = "hba1c-arch,{value},{timestamp},HbA1c,Level 1,Architect,HPLC,tech1,RL-001,LOT-001,ok,run-{index},%,{flags},automated,csv"
+    lines = [header]
+    for index, value in enumerate([5.2, 5.3, 6.1, 5.1]):
+        timestamp = (START + timedelta(hours=index)).isoformat()
+        lines.append(row.format(value=value, timestamp=timestamp, index=index, flags="[]"))
+    lines.append(row.format(value=5.2, timestamp=START.isoformat(), index=9, flags="not-json"))
+    content = "\n".join(lines) + "\n"
+
+    response = client.post(
+        "/qc/records/csv?stream=true&batch_size=2",
+        files={"file": ("export.csv", content, "text/csv")},
+        headers=AUTH_HEADERS,
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    events = [json.loads(line) for line in response.text.splitlines()]
+    rows = [event for event in events if event["type"] == "row"]
+    assert sorted(event["row"] for event in rows) == [1, 2, 3, 4, 5]
+    assert next(event for event in rows if event["row"] == 3)["signals"] == ["1-3s"]
+    assert next(event for event in rows if event["row"] == 5)["status"] == "error"
+    assert events[-1] == {"type": "summary", "rows": 5, "accepted": 4, "errors": 1}
+
+
+def _assert_baseline_matches(stream_id: str) -> None:
+    with Session(get_engine()) as session:
+        stats = session.exec(select(BaselineStats).where(BaselineStats.stream_id == stream_id)).one()
+        values = session.exec(
+            select(QCRecord.result_value).where(
+                QCRecord.stream_id == stream_id,
+                QCRecord.include_in_stats == True,
+                QCRecord.timestamp >= stats.baseline_start,
+                QCRecord.timestamp <= stats.baseline_end,
+            )
+        ).all()
+    assert stats.n == len(values)
+    assert stats.mean == pytest.approx(statistics.fmean(values), rel=1e-12)
+    assert stats.m2 / (stats.n - 1) == pytest.approx(statistics.variance(values), rel=1e-9)
+
+
+def test_materialized_baseline_follows_inserts_and_exclusions():
+    create_stream("baseline-mat", **FIXED_WINDOW)
+    for index in (0, 1, 2, 5, 6, 9, 10, 11):
+        response = client.post(
+            "/qc/records", json=qc_payload("baseline-mat", index, VALUES[index]), headers=AUTH_HEADERS
+        )
+        assert response.status_code == 200
+    _assert_baseline_matches("baseline-mat")
+
+    late = [qc_payload("baseline-mat", index, VALUES[index]) for index in (3, 4, 7)]
+    assert client.post("/qc/records/batch", json=late, headers=AUTH_HEADERS).status_code == 200
+    _assert_baseline_matches("baseline-mat")
+
+    with Session(get_engine()) as session:
+        record_id = session.exec(
+            select(QCRecord.id).where(QCRecord.stream_id == "baseline-mat", QCRecord.run_id == "run-4")
+        ).one()
+    for include in (False, True, False):
+        response = client.patch(
+            f"/qc/records/{record_id}/resolution", json={"include_in_stats": include}, headers=AUTH_HEADERS
+        )
+        assert response.status_code == 200
+        _assert_baseline_matches("baseline-mat")
@@ -0,0 +1,279 @@
+import random
+from datetime import timedelta
+
+import numpy as np
+import pytest
+from conftest import START, qc_payload
+from fastapi.testclient import TestClient
+from sqlmodel import Session, select
+
+from app import bayesian
+from app.db import get_engine
+from app.db_models import AuditEntry, PosteriorCheckpoint, PosteriorState, QCRecord
+from app.main import app
+from app.storage import get_active_prior
+
+client = TestClient(app)
+AUTH_HEADERS = {"X-API-Key": "local-dev-key"}
+
+
+def _sequential(prior, values):
+    mu_n, kappa_n, alpha_n, beta_n = prior
+    for value in values:
+        mu_n, kappa_n, alpha_n, beta_n = bayesian._update_posterior(mu_n, kappa_n, alpha_n, beta_n, value)
+    return mu_n, kappa_n, alpha_n, beta_n
+
+
+def test_posterior_from_stats_matches_sequential_update():
+    rng = random.Random(7)
+    values = [rng.gauss(5.2, 0.15) for _ in range(500)]
+    prior = (5.1, 2.0, 3.0, 0.05)
+    mean = sum(values) / len(values)
+    sum_sq_dev = sum((value - mean) ** 2 for value in values)
+    closed = bayesian._posterior_from_stats(*prior, len(values), mean, sum_sq_dev)
+    assert closed == pytest.approx(_sequential(prior, values), rel=1e-9)
+    assert bayesian._posterior_from_stats(*prior, 0, 0.0, 0.0) == prior
+
+
+def test_rebuild_matches_sequential_replay_after_exclusion():
+    values = [5.2 + 0.05 * ((index * 37) % 9 - 4) for index in range(30)]
+    for index, value in enumerate(values):
+        response = client.post("/qc/records", json=qc_payload("hba1c-arch", index, value), headers=AUTH_HEADERS)
+        assert response.status_code == 200
+
+    with Session(get_engine()) as session:
+        record_id = session.exec(select(QCRecord.id).order_by(QCRecord.timestamp.asc()).offset(4)).first()
+    response = client.patch(
+        f"/qc/records/{record_id}/resolution",
+        json={"include_in_stats": False, "resolved_reason": "pipetting error"},
+        headers=AUTH_HEADERS,
+    )
+    assert response.status_code == 200
+
+    with Session(get_engine()) as session:
+        records = session.exec(
+            select(QCRecord)
+            .where(QCRecord.stream_id == "hba1c-arch", QCRecord.include_in_stats == True)
+            .order_by(QCRecord.timestamp.asc())
+        ).all()
+        prior = get_active_prior(session, "hba1c-arch", records[0].timestamp)
+        expected = _sequential(
+            (prior.mu0, prior.kappa0, prior.alpha0, prior.beta0), [record.result_value for record in records]
+        )
+        state = session.exec(select(PosteriorState).where(PosteriorState.stream_id == "hba1c-arch")).one()
+        assert state.n_obs == len(values) - 1
+        assert (state.mu_n, state.kappa_n, state.alpha_n, state.beta_n) == pytest.approx(expected, rel=1e-9)
+
+
+
+def test_aggregate_rebuild_matches_sequential_fold():
+    values = [5.2 + 0.04 * ((index * 13) % 11 - 5) for index in range(40)]
+    response = client.post(
+        "/qc/records/batch",
+        json=[qc_payload("hba1c-arch", index, value) for index, value in enumerate(values)],
+        headers=AUTH_HEADERS,
+    )
+    assert response.json()["accepted"] == len(values)
+    with Session(get_engine()) as session:
+        ids = session.exec(select(QCRecord.id).order_by(QCRecord.timestamp.asc())).all()
+    excluded = [ids[0], ids[17], ids[39]]
+    response = client.patch(
+        "/qc/records/resolution", json={"include_in_stats": False, "record_ids": excluded}, headers=AUTH_HEADERS
+    )
+    assert response.status_code == 200
+
+    with Session(get_engine()) as session:
+        records = session.exec(
+            select(QCRecord)
+            .where(QCRecord.stream_id == "hba1c-arch", QCRecord.include_in_stats == True)
+            .order_by(QCRecord.timestamp.asc(), QCRecord.id.asc())
+        ).all()
+        prior = get_active_prior(session, "hba1c-arch", records[0].timestamp)
+        folded = bayesian._update_posterior_array(
+            prior.mu0, prior.kappa0, prior.alpha0, prior.beta0, np.array([record.result_value for record in records])
+        )
+        state = bayesian.rebuild_posterior_state(session, "hba1c-arch")
+        assert state.n_obs == len(values) - len(excluded)
+        assert state.updated_at == records[-1].timestamp
+        assert (state.mu_n, state.kappa_n, state.alpha_n, state.beta_n) == pytest.approx(
+            [column[-1] for column in folded], rel=1e-9
+        )
+
+def _included_fold(session, until=None):
+    records = session.exec(
+        select(QCRecord)
+        .where(QCRecord.stream_id == "hba1c-arch", QCRecord.include_in_stats == True)
+        .order_by(QCRecord.timestamp.asc(), QCRecord.id.asc())
+    ).all()
+    if until is not None:
+        records = records[: [record.id for record in records].index(until) + 1]
+    prior = get_active_prior(session, "hba1c-arch", records[0].timestamp)
+    return _sequential((prior.mu0, prior.kappa0, prior.alpha0, prior.beta0), [record.result_value for record in records])
+
+
+def test_checkpoints_bound_replay_for_exclusions(monkeypatch):
+    monkeypatch.setattr(bayesian, "CHECKPOINT_INTERVAL", 5)
+    for index in range(23):
+        value = 5.2 + 0.04 * ((index * 11) % 7 - 3)
+        assert client.post(
+            "/qc/records", json=qc_payload("hba1c-arch", index, value), headers=AUTH_HEADERS
+        ).status_code == 200
+
+    with Session(get_engine()) as session:
+        checkpoints = session.exec(select(PosteriorCheckpoint).order_by(PosteriorCheckpoint.n_obs.asc())).all()
+        assert [checkpoint.n_obs for checkpoint in checkpoints] == [5, 10, 15, 20]
+        record_id = session.exec(select(QCRecord.id).order_by(QCRecord.timestamp.asc()).offset(12)).first()
+
+    response = client.patch(
+        f"/qc/records/{record_id}/resolution",
+        json={"include_in_stats": False, "resolved_reason": "clot"},
+        headers=AUTH_HEADERS,
+    )
+    assert response.status_code == 200
+
+    with Session(get_engine()) as session:
+        checkpoints = session.exec(select(PosteriorCheckpoint).order_by(PosteriorCheckpoint.n_obs.asc())).all()
+        assert [checkpoint.n_obs for checkpoint in checkpoints] == [5, 10, 15, 20]
+        # Checkpoints before the excluded point are untouched; later ones are refolded without it.
+        assert checkpoints[1].qc_record_id < record_id < checkpoints[2].qc_record_id
+        for checkpoint in checkpoints:
+            expected = _included_fold(session, until=checkpoint.qc_record_id)
+            assert (checkpoint.mu_n, checkpoint.kappa_n, checkpoint.alpha_n, checkpoint.beta_n) == pytest.approx(
+                expected, rel=1e-9
+            )
+        state = session.exec(select(PosteriorState).where(PosteriorState.stream_id == "hba1c-arch")).one()
+        assert state.n_obs == 22
+        assert (state.mu_n, state.kappa_n, state.alpha_n, state.beta_n) == pytest.approx(
+            _included_fold(session), rel=1e-9
+        )
+
+
+def test_late_record_is_scored_at_its_own_timestamp(monkeypatch):
+    monkeypatch.setattr(bayesian, "CHECKPOINT_INTERVAL", 4)
+    for index in range(12):
+        value = 5.2 + 0.03 * ((index * 5) % 7 - 3)
+        assert client.post(
+            "/qc/records", json=qc_payload("hba1c-arch", index, value), headers=AUTH_HEADERS
+        ).status_code == 200
+
+    late = qc_payload("hba1c-arch", 6, 5.31)
+    late["timestamp"] = (START + timedelta(hours=6, minutes=30)).isoformat()
+    late["run_id"] = "run-late"
+    response = client.post("/qc/records", json=late, headers=AUTH_HEADERS)
+    assert response.status_code == 200
+    with Session(get_engine()) as session:
+        late_id = session.exec(select(QCRecord.id).where(QCRecord.run_id == "run-late")).one()
+        expected = _included_fold(session, until=late_id)
+    # Scored against the seven points before it, not against the whole stream.
+    assert response.json()["qc"]["bayesian_risk"]["posterior_mean"] == pytest.approx(expected[0], rel=1e-9)
+
+    late_batch = qc_payload("hba1c-arch", 2, 5.12)
+    late_batch["timestamp"] = (START + timedelta(hours=2, minutes=30)).isoformat()
+    late_batch["run_id"] = "run-late-batch"
+    batch = client.post("/qc/records/batch", json=[late_batch], headers=AUTH_HEADERS)
+    assert batch.status_code == 200
+    batch_item = batch.json()["results"][0]
+
+    with Session(get_engine()) as session:
+        expected = _included_fold(session, until=batch_item["record_id"])
+        assert batch_item["result"]["qc"]["bayesian_risk"]["posterior_mean"] == pytest.approx(expected[0], rel=1e-9)
+        state = session.exec(select(PosteriorState).where(PosteriorState.stream_id == "hba1c-arch")).one()
+        assert state.n_obs == 14
+        assert (state.mu_n, state.kappa_n, state.alpha_n, state.beta_n) == pytest.approx(
+            _included_fold(session), rel=1e-9
+        )
+        checkpoints = session.exec(select(PosteriorCheckpoint).order_by(PosteriorCheckpoint.n_obs.asc())).all()
+        assert [checkpoint.n_obs for checkpoint in checkpoints] == [4, 8, 12]
+        for checkpoint in checkpoints:
+            assert checkpoint.mu_n == pytest.approx(_included_fold(session, until=checkpoint.qc_record_id)[0], rel=1e-9)
+
+
+def test_bulk_resolution_updates_once_and_reports_per_record():
+    for index in range(10):
+        value = 5.2 + 0.02 * ((index * 3) % 5 - 2)
+        assert client.post(
+            "/qc/records", json=qc_payload("hba1c-arch", index, value), headers=AUTH_HEADERS
+        ).status_code == 200
+    with Session(get_engine()) as session:
+        ids = session.exec(select(QCRecord.id).order_by(QCRecord.timestamp.asc())).all()
+
+    response = client.patch(
+        "/qc/records/resolution",
+        json={"include_in_stats": False, "resolved_reason": "probe fault", "record_ids": [ids[3], ids[4], 999999]},
+        headers=AUTH_HEADERS,
+    )
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["updated"], body["unchanged"], body["not_found"]) == (2, 0, 1)
+    assert [item["status"] for item in body["results"]] == ["updated", "updated", "not_found"]
+    assert body["results"][0]["record"]["resolved_reason"] == "probe fault"
+
+    response = client.patch(
+        "/qc/records/resolution",
+        json={
+            "include_in_stats": False,
+            "resolved_reason": "probe fault",
+            "stream_id": "hba1c-arch",
+            "start": (START + timedelta(hours=4)).isoformat(),
+            "end": (START + timedelta(hours=6)).isoformat(),
+        },
+        headers=AUTH_HEADERS,
+    )
+    body = response.json()
+    assert [item["record_id"] for item in body["results"]] == ids[4:7]
+    assert (body["updated"], body["unchanged"]) == (2, 1)
+
+    with Session(get_engine()) as session:
+        state = session.exec(select(PosteriorState).where(PosteriorState.stream_id == "hba1c-arch")).one()
+        assert state.n_obs == 6
+        assert (state.mu_n, state.kappa_n, state.alpha_n, state.beta_n) == pytest.approx(
+            _included_fold(session), rel=1e-9
+        )
+        audits = session.exec(select(AuditEntry).where(AuditEntry.action == "resolve_qc_record")).all()
+        assert len(audits) == 4
+
+    response = client.patch("/qc/records/resolution", json={"include_in_stats": True}, headers=AUTH_HEADERS)
+    assert response.status_code == 422
+
+
+def test_posterior_history_is_written_at_ingest_and_charted():
+    responses = []
+    for index in range(6):
+        response = client.post(
+            "/qc/records", json=qc_payload("hba1c-arch", index, 5.2 + 0.05 * index), headers=AUTH_HEADERS
+        )
+        responses.append(response.json()["qc"]["bayesian_risk"])
+    late = qc_payload("hba1c-arch", 2, 5.4)
+    late["timestamp"] = (START + timedelta(hours=2, minutes=30)).isoformat()
+    late["run_id"] = "run-late"
+    batch = client.post(
+        "/qc/records/batch",
+        json=[qc_payload("hba1c-arch", index, 5.1) for index in range(6, 9)] + [late],
+        headers=AUTH_HEADERS,
+    ).json()
+    batch_risks = {item["record_id"]: item["result"]["qc"]["bayesian_risk"] for item in batch["results"]}
+
+    chart = client.get("/streams/hba1c-arch/chart", headers=AUTH_HEADERS).json()
+    record_ids = [record["id"] for record in chart["records"]]
+    posterior = chart["posterior"]
+    assert all(len(values) == len(record_ids) == 10 for values in posterior.values())
+    scored = dict(zip([record_ids[i] for i in (0, 1, 2, 4, 5, 6)], responses)) | batch_risks
+    for i, record_id in enumerate(record_ids):
+        expected = scored[record_id]
+        assert posterior["mu_n"][i] == pytest.approx(expected["posterior_mean"], rel=1e-12)
+        assert posterior["risk_score"][i] == expected["risk_score"]
+        assert posterior["probability_bias_exceeded"][i] == pytest.approx(expected["probability_bias_exceeded"])
+        assert [posterior["credible_lower"][i], posterior["credible_upper"][i]] == pytest.approx(
+            expected["credible_interval"], rel=1e-12
+        )
+
+    # History records what each point was scored with; a later exclusion does not rewrite it.
+    before = posterior["mu_n"]
+    response = client.patch(
+        f"/qc/records/{record_ids[1]}/resolution",
+        json={"include_in_stats": False, "resolved_reason": "clot"},
+        headers=AUTH_HEADERS,
+    )
+    assert response.status_code == 200
+    chart = client.get("/streams/hba1c-arch/chart", headers=AUTH_HEADERS).json()
+    assert chart["posterior"]["mu_n"] == before
@@ -0,0 +1,169 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from conftest import START, qc_payload
+from fastapi.testclient import TestClient
+
+from app import frequentist
+from app.cache import (
+    BaselineStateCache,
+    RollingBaseline,
+    RollingWindowCache,
+    WindowPoint,
+    baseline_state_cache,
+    lot_state_cache,
+    window_cache,
+)
+from app.main import app
+
+client = TestClient(app)
+AUTH_HEADERS = {"X-API-Key": "local-dev-key"}
+
+
+def test_ring_buffer_evicts_and_invalidates_late_points():
+    cache = RollingWindowCache(capacity=3)
+    base = datetime(2024, 1, 1)
+    assert not cache.append("s", WindowPoint(base, 1.0, True))
+    cache.load("s", [WindowPoint(base, 1.0, True)])
+    for hour in range(1, 4):
+        assert cache.append("s", WindowPoint(base + timedelta(hours=hour), float(hour + 1), True))
+    assert cache.evictions == 1
+    assert [p.value for p in cache.recent("s", base + timedelta(hours=5), 2)] == [3.0, 4.0]
+    assert cache.recent("s", base + timedelta(hours=5), 3) is not None
+    assert cache.recent("s", base + timedelta(hours=3), 2) is None
+
+    cache.append("s", WindowPoint(base + timedelta(minutes=30), 9.0, True))
+    assert cache.recent("s", base + timedelta(hours=5), 2) is None
+    assert cache.invalidations == 1
+
+
+
+def test_baseline_state_is_checked_back_in_only_from_its_own_generation():
+    cache = BaselineStateCache(max_streams=2)
+    base = datetime(2024, 1, 1)
+    entry, generation = cache.check_out("s")
+    assert entry is None
+    cache.check_in("s", generation, (1, RollingBaseline([(base, 1.0)])))
+    entry, generation = cache.check_out("s")
+    assert entry[1].n == 1 and cache.stats()["streams"] == 0
+
+    # A request that misses while the state is out reloads committed rows; whichever checks in second is stale.
+    _, other = cache.check_out("s")
+    cache.check_in("s", generation, entry)
+    cache.check_in("s", other, (1, RollingBaseline()))
+    assert cache.check_out("s")[0] is None
+    _, generation = cache.check_out("s")
+    cache.invalidate("s")
+    cache.check_in("s", generation, entry)
+    assert cache.stats()["streams"] == 0
+
+def test_rules_read_window_from_cache_and_resolution_invalidates():
+    responses = []
+    for index in range(10):
+        response = client.post("/qc/records", json=qc_payload("hba1c-arch", index, 5.3), headers=AUTH_HEADERS)
+        assert response.status_code == 200
+        responses.append(response.json())
+    assert [s["rule"] for s in responses[-1]["qc"]["signals"]] == ["10x"]
+    stats = window_cache.stats()
+    assert stats["hits"] >= 8
+    assert stats["streams"] == 1
+
+    record_id = int(responses[4]["audit_entry"]["entity_id"])
+    resolved = client.patch(
+        f"/qc/records/{record_id}/resolution",
+        json={"include_in_stats": False, "resolved_reason": "bubble"},
+        headers=AUTH_HEADERS,
+    )
+    assert resolved.status_code == 200
+    assert window_cache.stats()["streams"] == 0
+
+    response = client.post("/qc/records", json=qc_payload("hba1c-arch", 10, 5.3), headers=AUTH_HEADERS)
+    assert [s["rule"] for s in response.json()["qc"]["signals"]] == ["10x"]
+    response = client.post("/qc/records", json=qc_payload("hba1c-arch", 11, 5.3), headers=AUTH_HEADERS)
+    assert [s["rule"] for s in response.json()["qc"]["signals"]] == ["10x"]
+    assert window_cache.stats()["streams"] == 1
+
+
+def test_failed_bulk_resolution_invalidates_stream_caches(monkeypatch):
+    ids = []
+    for index in range(5):
+        response = client.post("/qc/records", json=qc_payload("hba1c-arch", index, 5.2), headers=AUTH_HEADERS)
+        ids.append(int(response.json()["audit_entry"]["entity_id"]))
+    assert window_cache.stats()["streams"] == 1
+
+    def _fail(*_args, **_kwargs):
+        raise RuntimeError("chart replay failed")
+
+    monkeypatch.setattr(frequentist, "replay_control_charts", _fail)
+    with pytest.raises(RuntimeError):
+        client.patch("/qc/records/resolution", json={"include_in_stats": False, "record_ids": ids[:2]}, headers=AUTH_HEADERS)
+    assert window_cache.stats()["streams"] == 0
+    assert baseline_state_cache.stats()["streams"] == 0
+    assert lot_state_cache.stats()["streams"] == 0
+
+
+def test_version_history_resolves_like_effective_dated_query():
+    from types import SimpleNamespace
+
+    from app.cache import VersionHistory, VersionHistoryCache
+
+    base = datetime(2024, 1, 1)
+    versions = [
+        SimpleNamespace(effective_from=base, version=1),
+        SimpleNamespace(effective_from=base + timedelta(days=10), version=2),
+        SimpleNamespace(effective_from=base + timedelta(days=10), version=3),
+    ]
+    history = VersionHistory(versions)
+    assert history.active_at(base - timedelta(days=1)).version == 1
+    assert history.active_at(base + timedelta(days=9)).version == 1
+    assert history.active_at((base + timedelta(days=10)).replace(tzinfo=timezone.utc)).version == 3
+    assert VersionHistory([]).active_at(base) is None
+
+    cache = VersionHistoryCache(max_streams=2)
+    for stream_id in ("a", "b", "a", "c"):
+        cache.get_or_load(stream_id, lambda: versions)
+    assert cache.stats()["evictions"] == 1
+    cache.get_or_load("a", lambda: [])
+    assert cache.stats()["hits"] == 2
+
+
+def test_new_config_version_invalidates_cached_history():
+    first = client.post("/qc/records", json=qc_payload("hba1c-arch", 0, 5.2), headers=AUTH_HEADERS)
+    assert first.json()["qc"]["signals"] == []
+
+    stream = client.get("/streams", headers=AUTH_HEADERS).json()[0]
+    stream.update({"target_value": 4.0, "effective_from": (START - timedelta(days=1)).isoformat()})
+    assert client.post("/streams/hba1c-arch/configs", json=stream, headers=AUTH_HEADERS).status_code == 200
+
+    second = client.post("/qc/records", json=qc_payload("hba1c-arch", 1, 5.2), headers=AUTH_HEADERS)
+    assert second.json()["qc"]["signals"][0]["rule"] == "1-3s"
+    config_stats = client.get("/metrics", headers=AUTH_HEADERS).json()["config_cache"]["stream_configs"]
+    assert config_stats["misses"] == 2
+
+
+def test_api_key_cache_hits_and_deactivation_is_immediate():
+    from sqlmodel import Session
+
+    from app.cache import api_key_cache
+    from app.db import get_engine
+    from app.db_models import ApiKey
+    from app.models import Role
+    from app.rbac import hash_api_key
+    from app.storage import update_api_key
+
+    with Session(get_engine()) as session:
+        analyst = ApiKey(key_hash=hash_api_key("analyst-key"), role=Role.QC_ANALYST, description="analyst")
+        session.add(analyst)
+        session.commit()
+        analyst_id = analyst.id
+
+    analyst_headers = {"X-API-Key": "analyst-key"}
+    assert client.get("/alerts", headers=analyst_headers).status_code == 200
+    assert client.get("/alerts", headers=analyst_headers).status_code == 200
+    assert api_key_cache.stats()["hits"] >= 1
+
+    with Session(get_engine()) as session:
+        analyst = session.get(ApiKey, analyst_id)
+        analyst.active = False
+        update_api_key(session, analyst)
+    assert client.get("/alerts", headers=analyst_headers).status_code == 401
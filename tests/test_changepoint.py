@@ -0,0 +1,158 @@
+from datetime import timedelta
+
+import numpy as np
+import pytest
+from conftest import START, create_stream, qc_payload
+from fastapi.testclient import TestClient
+from sqlmodel import Session, select
+
+from app import changepoint
+from app.db import get_engine
+from app.db_models import AlertRecord, ChangePointCheckpoint, ChangePointState, PriorConfig, QCRecord, StreamConfig
+from app.main import app
+from app.replay import replay_stream
+from app.storage import prior_config_history, stream_config_history, stream_history_arrays
+
+client = TestClient(app)
+AUTH_HEADERS = {"X-API-Key": "local-dev-key"}
+PRIOR = PriorConfig(stream_id="cp", mu0=5.2, kappa0=1.0, alpha0=2.0, beta0=0.0625)
+
+
+def _shifted(count: int, onset: int, seed: int, shift: float = 0.5) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return 5.2 + 0.25 * rng.standard_normal(count) + np.where(np.arange(count) >= onset, shift, 0.0)
+
+
+def test_pruned_run_lengths_stay_bounded_and_match_a_wide_distribution():
+    values = _shifted(400, 250, 4)
+    config = StreamConfig(
+        stream_id="cp",
+        analyte="HbA1c",
+        method="HPLC",
+        instrument="Architect",
+        qc_level="Level 1",
+        control_material_lot="LOT-001",
+        units="%",
+        target_value=5.2,
+        sigma=0.25,
+    )
+    params = changepoint.changepoint_params(config)
+    pruned, wide = changepoint.empty(), changepoint.empty()
+    for i, value in enumerate(values):
+        pruned, probability = changepoint.bocpd_step(pruned, float(value), PRIOR, {**params, "max_run_lengths": 50})
+        wide, reference = changepoint.bocpd_step(wide, float(value), PRIOR, {**params, "max_run_lengths": 10000})
+        assert len(pruned.length) <= 50
+        assert probability == pytest.approx(reference, abs=5e-3), i
+        if 20 <= i < 250:
+            assert probability < 0.2
+    # Pruning by probability alone already keeps the wide distribution far below one hypothesis per point.
+    assert len(wide.length) < 200
+    # A 2 SD step is picked up within a few runs of the onset.
+    probabilities = changepoint.changepoint_probabilities(values, [config] * 400, [PRIOR] * 400)
+    assert probabilities[250:255].max() > 0.9
+
+
+def test_changepoint_signals_go_through_the_alert_path_and_match_replay():
+    config = {
+        "stream_id": "cp",
+        "analyte": "HbA1c",
+        "method": "HPLC",
+        "instrument": "Architect",
+        "qc_level": "Level 1",
+        "control_material_lot": "LOT-001",
+        "units": "%",
+        "target_value": 5.2,
+        "sigma": 0.25,
+        "rule_set": {"rules": ["CHANGEPOINT"], "changepoint": {"threshold": 0.8}},
+        "effective_from": (START - timedelta(days=1)).isoformat(),
+    }
+    assert client.post("/streams", json=config, headers=AUTH_HEADERS).status_code == 200
+    invalid = {**config, "rule_set": {"rules": ["CHANGEPOINT"], "changepoint": {"hazard": 1.5}}}
+    assert client.post("/streams", json=invalid, headers=AUTH_HEADERS).status_code == 422
+    prior = {"stream_id": "cp", "mu0": 5.2, "kappa0": 1.0, "alpha0": 2.0, "beta0": 0.0625}
+    assert client.post("/streams/cp/priors", json=prior, headers=AUTH_HEADERS).status_code == 200
+
+    values = _shifted(120, 90, 8, shift=0.75)
+    single = [
+        client.post("/qc/records", json=qc_payload("cp", i, float(values[i])), headers=AUTH_HEADERS).json()["qc"]
+        for i in range(60)
+    ]
+    batch = client.post(
+        "/qc/records/batch", json=[qc_payload("cp", i, float(values[i])) for i in range(60, 120)], headers=AUTH_HEADERS
+    ).json()
+    scored = single + [item["result"]["qc"] for item in batch["results"]]
+    flagged = [i for i, qc in enumerate(scored) if any(signal["rule"] == "CHANGEPOINT" for signal in qc["signals"])]
+    assert [i for i in flagged if i >= 90][0] <= 95
+    with Session(get_engine()) as session:
+        alerts = session.exec(select(AlertRecord).where(AlertRecord.stream_id == "cp")).all()
+        assert len(alerts) >= len(flagged)
+        configs = stream_config_history(session, "cp").versions
+        priors = prior_config_history(session, "cp").versions
+        times, stored, included = stream_history_arrays(session, "cp")
+    result = replay_stream(stored, times, configs, priors, included)
+    live = [qc["bayesian_risk"]["probability_changepoint"] for qc in scored]
+    assert live == pytest.approx(result.probability_changepoint.tolist(), abs=1e-12)
+    assert np.flatnonzero(result.flags["CHANGEPOINT"]).tolist() == flagged
+
+    # Excluding the shifted points re-runs the detector over what is left.
+    records = client.get("/streams/cp/chart?limit=200", headers=AUTH_HEADERS).json()["records"]
+    response = client.patch(
+        "/qc/records/resolution",
+        json={"include_in_stats": False, "record_ids": [record["id"] for record in records[90:]]},
+        headers=AUTH_HEADERS,
+    )
+    assert response.status_code == 200
+    with Session(get_engine()) as session:
+        state = session.exec(select(ChangePointState).where(ChangePointState.stream_id == "cp")).one()
+        assert state.n_obs == 90
+        assert len(state.run_lengths["length"]) <= 100
+
+
+def test_checkpoints_bound_detector_replay_for_exclusions(monkeypatch):
+    monkeypatch.setattr(changepoint, "CHECKPOINT_INTERVAL", 5)
+    create_stream("cp", rule_set={"rules": ["CHANGEPOINT"]})
+    values = _shifted(23, 15, 3)
+    for index, value in enumerate(values):
+        assert client.post("/qc/records", json=qc_payload("cp", index, float(value)), headers=AUTH_HEADERS).status_code == 200
+
+    with Session(get_engine()) as session:
+        before = session.exec(select(ChangePointCheckpoint).order_by(ChangePointCheckpoint.n_obs.asc())).all()
+        assert [checkpoint.n_obs for checkpoint in before] == [5, 10, 15, 20]
+        record_id = session.exec(select(QCRecord.id).order_by(QCRecord.timestamp.asc()).offset(12)).first()
+
+    response = client.patch(
+        f"/qc/records/{record_id}/resolution",
+        json={"include_in_stats": False, "resolved_reason": "clot"},
+        headers=AUTH_HEADERS,
+    )
+    assert response.status_code == 200
+
+    with Session(get_engine()) as session:
+        checkpoints = session.exec(select(ChangePointCheckpoint).order_by(ChangePointCheckpoint.n_obs.asc())).all()
+        assert [checkpoint.n_obs for checkpoint in checkpoints] == [5, 10, 15, 20]
+        # Checkpoints before the excluded point are kept; later ones are re-run without it.
+        assert [checkpoint.id for checkpoint in checkpoints[:2]] == [checkpoint.id for checkpoint in before[:2]]
+        assert checkpoints[1].qc_record_id < record_id < checkpoints[2].qc_record_id
+        config = stream_config_history(session, "cp").versions[0]
+        prior = prior_config_history(session, "cp").versions[0]
+        state = session.exec(select(ChangePointState).where(ChangePointState.stream_id == "cp")).one()
+    by_n_obs = {checkpoint.n_obs: checkpoint for checkpoint in checkpoints}
+    run_lengths = changepoint.empty()
+    for value in np.delete(values, 12):
+        run_lengths, _ = changepoint.bocpd_step(run_lengths, float(value), prior, changepoint.changepoint_params(config))
+        if run_lengths.n_obs in by_n_obs:
+            stored = by_n_obs[run_lengths.n_obs].run_lengths
+            assert stored["length"] == run_lengths.length.tolist()
+            assert stored["log_prob"] == pytest.approx(run_lengths.log_prob.tolist(), abs=1e-12)
+    assert state.n_obs == 22
+    assert state.run_lengths["log_prob"] == pytest.approx(run_lengths.log_prob.tolist(), abs=1e-12)
+
+
+def test_streams_without_the_detector_skip_its_replay():
+    create_stream("plain")
+    for index in range(6):
+        assert client.post("/qc/records", json=qc_payload("plain", index, 5.2), headers=AUTH_HEADERS).status_code == 200
+    with Session(get_engine()) as session:
+        assert changepoint.replay_changepoint_state(session, "plain") == {}
+        assert session.exec(select(ChangePointCheckpoint)).all() == []
+        assert session.exec(select(ChangePointState)).all() == []
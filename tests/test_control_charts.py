@@ -0,0 +1,99 @@
+import math
+from datetime import timedelta
+
+import pytest
+from conftest import START, create_stream, qc_payload
+from fastapi.testclient import TestClient
+from sqlmodel import Session, select
+
+from app.db import get_engine
+from app.db_models import ControlChartState, QCRecord
+from app.main import app
+
+client = TestClient(app)
+AUTH_HEADERS = {"X-API-Key": "local-dev-key"}
+RULE_SET = {"rules": ["1-3s", "CUSUM", "EWMA"], "cusum": {"k": 0.5, "h": 4.0}, "ewma": {"lambda": 0.2, "L": 2.7}}
+# In control for 12 runs, then a sustained +1.2 SD shift that no Westgard rule enabled here catches.
+VALUES = [5.2, 5.25, 5.15, 5.2, 5.3, 5.1, 5.2, 5.25, 5.15, 5.2, 5.22, 5.18] + [5.5, 5.55, 5.45, 5.53, 5.51, 5.55, 5.49, 5.52]
+
+
+def _records(stream_id: str) -> list[QCRecord]:
+    with Session(get_engine()) as session:
+        return session.exec(
+            select(QCRecord).where(QCRecord.stream_id == stream_id).order_by(QCRecord.timestamp.asc(), QCRecord.id.asc())
+        ).all()
+
+
+def _assert_charts_match_full_recompute(stream_id: str) -> None:
+    upper = lower = ewma = 0.0
+    n = 0
+    for record in _records(stream_id):
+        if not record.include_in_stats:
+            assert record.chart_n is None
+            continue
+        z = (record.result_value - record.baseline_mean) / record.baseline_sd
+        n += 1
+        upper = max(0.0, upper + z - 0.5)
+        lower = max(0.0, lower - z - 0.5)
+        ewma = 0.2 * z + 0.8 * ewma
+        assert record.chart_n == n
+        assert (record.cusum_upper, record.cusum_lower, record.ewma) == pytest.approx((upper, lower, ewma), abs=1e-12)
+        assert record.ewma_limit == pytest.approx(2.7 * math.sqrt(0.2 / 1.8 * (1 - 0.8 ** (2 * n))), rel=1e-12)
+    with Session(get_engine()) as session:
+        state = session.exec(select(ControlChartState).where(ControlChartState.stream_id == stream_id)).one()
+        assert (state.n, state.cusum_upper, state.cusum_lower, state.ewma) == pytest.approx((n, upper, lower, ewma), abs=1e-12)
+
+
+def test_cusum_and_ewma_flag_a_sustained_shift():
+    create_stream("chart-seq", rule_set=RULE_SET)
+    create_stream("chart-batch", rule_set=RULE_SET)
+    rules_fired = []
+    for index, value in enumerate(VALUES):
+        response = client.post("/qc/records", json=qc_payload("chart-seq", index, value), headers=AUTH_HEADERS)
+        assert response.status_code == 200
+        rules_fired.append({signal["rule"] for signal in response.json()["qc"]["signals"]})
+    batch = [qc_payload("chart-batch", index, value) for index, value in enumerate(VALUES)]
+    response = client.post("/qc/records/batch", json=batch, headers=AUTH_HEADERS)
+    assert response.status_code == 200
+    batch_fired = [{signal["rule"] for signal in item["result"]["qc"]["signals"]} for item in response.json()["results"]]
+
+    assert rules_fired == batch_fired
+    assert not any(rules_fired[:12])
+    assert "CUSUM" in set().union(*rules_fired[12:]) and "EWMA" in set().union(*rules_fired[12:])
+    assert "1-3s" not in set().union(*rules_fired)
+    _assert_charts_match_full_recompute("chart-seq")
+    _assert_charts_match_full_recompute("chart-batch")
+
+    chart = client.get("/streams/chart-seq/chart", headers=AUTH_HEADERS).json()
+    assert chart["records"][-1]["cusum_upper"] == pytest.approx(_records("chart-seq")[-1].cusum_upper)
+
+
+def test_exclusion_and_late_points_refold_from_the_nearest_stored_state():
+    create_stream("chart-edit", rule_set=RULE_SET)
+    for index, value in enumerate(VALUES):
+        assert client.post(
+            "/qc/records", json=qc_payload("chart-edit", index, value), headers=AUTH_HEADERS
+        ).status_code == 200
+    records = _records("chart-edit")
+    untouched = [(record.id, record.cusum_upper, record.ewma) for record in records[:14]]
+
+    response = client.patch(
+        f"/qc/records/{records[14].id}/resolution", json={"include_in_stats": False}, headers=AUTH_HEADERS
+    )
+    assert response.status_code == 200
+    _assert_charts_match_full_recompute("chart-edit")
+    assert [(record.id, record.cusum_upper, record.ewma) for record in _records("chart-edit")[:14]] == untouched
+
+    late = qc_payload("chart-edit", 15, 5.6)
+    late["timestamp"] = (START + timedelta(hours=15, minutes=30)).isoformat()
+    late["run_id"] = "run-late"
+    assert client.post("/qc/records", json=late, headers=AUTH_HEADERS).status_code == 200
+    _assert_charts_match_full_recompute("chart-edit")
+
+    response = client.patch(
+        "/qc/records/resolution",
+        json={"include_in_stats": True, "stream_id": "chart-edit"},
+        headers=AUTH_HEADERS,
+    )
+    assert response.json()["updated"] == 1
+    _assert_charts_match_full_recompute("chart-edit")
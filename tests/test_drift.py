@@ -0,0 +1,162 @@
+from datetime import timedelta
+
+import numpy as np
+import pytest
+from conftest import START, create_stream, qc_payload
+from fastapi.testclient import TestClient
+from sqlmodel import Session, select
+
+from app import drift
+from app.db import get_engine
+from app.db_models import DriftCheckpoint, DriftState, QCRecord, StreamConfig
+from app.main import app
+from app.models import DriftModel
+from app.replay import replay_stream
+from app.storage import prior_config_history, stream_config_history, stream_history_arrays
+
+client = TestClient(app)
+AUTH_HEADERS = {"X-API-Key": "local-dev-key"}
+
+
+def _config(model: DriftModel, **overrides) -> StreamConfig:
+    fields = {
+        "stream_id": "drift",
+        "analyte": "HbA1c",
+        "method": "HPLC",
+        "instrument": "Architect",
+        "qc_level": "Level 1",
+        "control_material_lot": "LOT-001",
+        "units": "%",
+        "target_value": 5.2,
+        "sigma": 0.25,
+        "drift_model": model,
+    }
+    return StreamConfig(**{**fields, **overrides})
+
+
+@pytest.mark.parametrize("model", list(DriftModel))
+def test_batch_filter_matches_sequential_steps(model):
+    rng = np.random.default_rng(21)
+    values = 5.2 + 0.25 * rng.standard_normal(4000) + np.where(np.arange(4000) >= 3000, 0.01 * (np.arange(4000) - 3000), 0.0)
+    # A second version with its own noise settings takes over mid-stream, so the gain re-converges.
+    configs = [_config(model), _config(model, sigma=0.3, drift_level_noise_sd=0.05, drift_rate_noise_sd=0.001)]
+    version = (np.arange(4000) >= 1800).astype(int)
+
+    filtered = drift.kalman_filter(values, configs, version)
+    probabilities = drift.drift_probabilities(filtered, configs, version)
+    state = drift.initial_state(configs[0])
+    for i, value in enumerate(values):
+        state = drift.kalman_step(state, value, configs[version[i]])
+        assert [column[i] for column in filtered] == pytest.approx(list(state), rel=1e-10, abs=1e-12), i
+        assert probabilities[i] == pytest.approx(drift.drift_probability(state, configs[version[i]]), abs=1e-9)
+    if model == DriftModel.LOCAL_TREND:
+        assert probabilities[1000:1800].max() < 0.5 and probabilities[-1] > 0.99
+    else:
+        assert np.all(filtered.rate == 0.0)
+
+
+def test_drift_fields_follow_ingestion_exclusions_and_replay():
+    config = {
+        "stream_id": "drift",
+        "analyte": "HbA1c",
+        "method": "HPLC",
+        "instrument": "Architect",
+        "qc_level": "Level 1",
+        "control_material_lot": "LOT-001",
+        "units": "%",
+        "target_value": 5.2,
+        "sigma": 0.25,
+        "drift_model": "local_trend",
+        "effective_from": (START - timedelta(days=1)).isoformat(),
+    }
+    assert client.post("/streams", json=config, headers=AUTH_HEADERS).status_code == 200
+    invalid = {**config, "drift_rate_noise_sd": 0}
+    assert client.post("/streams", json=invalid, headers=AUTH_HEADERS).status_code == 422
+
+    rng = np.random.default_rng(5)
+    # In control, then a slow reagent drift of 0.02 SD per run.
+    values = 5.2 + 0.25 * (rng.standard_normal(300) + np.where(np.arange(300) >= 150, 0.02 * (np.arange(300) - 150), 0))
+    single = [
+        client.post(
+            "/qc/records", json=qc_payload("drift", i, float(values[i])), headers=AUTH_HEADERS
+        ).json()["qc"]["bayesian_risk"]
+        for i in range(100)
+    ]
+    batch = client.post(
+        "/qc/records/batch",
+        json=[qc_payload("drift", i, float(values[i])) for i in range(100, 300)],
+        headers=AUTH_HEADERS,
+    ).json()
+    scored = single + [item["result"]["qc"]["bayesian_risk"] for item in batch["results"]]
+    assert scored[0]["probability_drift"] is not None and scored[-1]["probability_drift"] > 0.95
+
+    with Session(get_engine()) as session:
+        configs = stream_config_history(session, "drift").versions
+        priors = prior_config_history(session, "drift").versions
+        times, stored, included = stream_history_arrays(session, "drift")
+    result = replay_stream(stored, times, configs, priors, included)
+    assert [risk["drift_level"] for risk in scored] == pytest.approx(result.drift_level.tolist(), rel=1e-10)
+    assert [risk["drift_rate"] for risk in scored] == pytest.approx(result.drift_rate.tolist(), rel=1e-8, abs=1e-12)
+    assert [risk["probability_drift"] for risk in scored] == pytest.approx(result.probability_drift.tolist(), abs=1e-9)
+
+    # A late point and an exclusion refilter the included records and rewrite the persisted state.
+    late = qc_payload("drift", 40, 5.9)
+    late["timestamp"] = (START + timedelta(hours=40, minutes=30)).isoformat()
+    late["run_id"] = "run-late"
+    assert client.post("/qc/records", json=late, headers=AUTH_HEADERS).status_code == 200
+    records = client.get("/streams/drift/chart?limit=400", headers=AUTH_HEADERS).json()["records"]
+    response = client.patch(
+        f"/qc/records/{records[10]['id']}/resolution",
+        json={"include_in_stats": False, "resolved_reason": "bubble"},
+        headers=AUTH_HEADERS,
+    )
+    assert response.status_code == 200
+    with Session(get_engine()) as session:
+        times, stored, included = stream_history_arrays(session, "drift")
+        state = session.exec(select(DriftState).where(DriftState.stream_id == "drift")).one()
+    result = replay_stream(stored, times, configs, priors, included)
+    assert state.n_obs == 300
+    assert (state.level, state.rate) == pytest.approx((result.drift_level[-1], result.drift_rate[-1]), rel=1e-10)
+
+
+def test_checkpoints_bound_refilter_for_exclusions(monkeypatch):
+    monkeypatch.setattr(drift, "CHECKPOINT_INTERVAL", 5)
+    create_stream("drift", drift_model="local_trend")
+    for index in range(23):
+        value = 5.2 + 0.04 * ((index * 11) % 7 - 3)
+        assert client.post("/qc/records", json=qc_payload("drift", index, value), headers=AUTH_HEADERS).status_code == 200
+
+    with Session(get_engine()) as session:
+        before = session.exec(select(DriftCheckpoint).order_by(DriftCheckpoint.n_obs.asc())).all()
+        assert [checkpoint.n_obs for checkpoint in before] == [5, 10, 15, 20]
+        record_id = session.exec(select(QCRecord.id).order_by(QCRecord.timestamp.asc()).offset(12)).first()
+
+    response = client.patch(
+        f"/qc/records/{record_id}/resolution",
+        json={"include_in_stats": False, "resolved_reason": "clot"},
+        headers=AUTH_HEADERS,
+    )
+    assert response.status_code == 200
+
+    with Session(get_engine()) as session:
+        checkpoints = session.exec(select(DriftCheckpoint).order_by(DriftCheckpoint.n_obs.asc())).all()
+        assert [checkpoint.n_obs for checkpoint in checkpoints] == [5, 10, 15, 20]
+        # Checkpoints before the excluded point are kept; later ones are refiltered without it.
+        assert [checkpoint.id for checkpoint in checkpoints[:2]] == [checkpoint.id for checkpoint in before[:2]]
+        assert checkpoints[1].qc_record_id < record_id < checkpoints[2].qc_record_id
+        config = stream_config_history(session, "drift").versions[0]
+        rows = session.exec(
+            select(QCRecord.id, QCRecord.result_value)
+            .where(QCRecord.include_in_stats == True)
+            .order_by(QCRecord.timestamp.asc())
+        ).all()
+        filtered = drift.kalman_filter(np.array([row[1] for row in rows]), [config], np.zeros(len(rows), dtype=int))
+        for checkpoint in checkpoints:
+            i = checkpoint.n_obs - 1
+            assert checkpoint.qc_record_id == rows[i][0]
+            assert (checkpoint.level, checkpoint.rate, checkpoint.level_var) == pytest.approx(
+                (filtered.level[i], filtered.rate[i], filtered.level_var[i]), rel=1e-10, abs=1e-14
+            )
+        state = session.exec(select(DriftState).where(DriftState.stream_id == "drift")).one()
+        assert state.n_obs == 22
+        assert (state.level, state.rate) == pytest.approx((filtered.level[-1], filtered.rate[-1]), rel=1e-10, abs=1e-14)
@@ -0,0 +1,117 @@
+import math
+from datetime import timedelta
+
+import numpy as np
+import pytest
+from conftest import START, qc_payload
+from fastapi.testclient import TestClient
+from sqlmodel import Session, select
+
+from app import hierarchy
+from app.db import get_engine
+from app.db_models import AuditEntry, PosteriorState, QCRecord
+from app.main import app
+from app.storage import prior_config_history
+
+client = TestClient(app)
+AUTH_HEADERS = {"X-API-Key": "local-dev-key"}
+
+
+def _config(stream_id: str, instrument: str, **overrides) -> dict:
+    return {
+        "stream_id": stream_id,
+        "analyte": "HbA1c",
+        "method": "HPLC",
+        "instrument": instrument,
+        "qc_level": "Level 1",
+        "control_material_lot": "LOT-001",
+        "units": "%",
+        "target_value": 5.2,
+        "sigma": 0.25,
+        "effective_from": (START - timedelta(days=1)).isoformat(),
+        **overrides,
+    }
+
+
+def test_group_fit_recovers_simulated_hyperparameters():
+    rng = np.random.default_rng(23)
+    # Two groups of 400 streams with 40 points each; the second group's variances barely differ.
+    groups = np.repeat([0, 1], 400)
+    offsets = np.where(groups == 0, 0.05, -0.1) + 0.1 * rng.standard_normal(800)
+    alpha = np.where(groups == 0, 6.0, 1000.0)
+    variances = 0.0625 * (alpha - 1) / rng.gamma(alpha)
+    n = np.full(800, 40.0)
+    samples = offsets[:, None] + np.sqrt(variances)[:, None] * rng.standard_normal((800, 40))
+    m2 = ((samples - samples.mean(axis=1, keepdims=True)) ** 2).sum(axis=1)
+    # A third group with a single stream is left unfitted.
+    fit = hierarchy.fit_groups(
+        np.append(groups, 2), np.append(n, 40.0), np.append(samples.mean(axis=1), 0.0), np.append(m2, 1.0), 3
+    )
+
+    assert fit.offset[:2] == pytest.approx([0.05, -0.1], abs=0.015)
+    assert np.sqrt(fit.between_var[:2]) == pytest.approx([0.1, 0.1], rel=0.1)
+    assert np.sqrt(fit.within_var[:2]) == pytest.approx([0.25, 0.25], rel=0.05)
+    assert fit.kappa0[:2] == pytest.approx([6.25, 6.25], rel=0.25)
+    assert fit.alpha0[0] == pytest.approx(6.0, rel=0.3)
+    assert fit.alpha0[1] == hierarchy.ALPHA0_MAX
+    assert np.isnan(fit.offset[2]) and fit.streams[2] == 1
+
+
+def test_refit_gives_opted_in_streams_a_pooled_prior():
+    rng = np.random.default_rng(5)
+    biases = {"a1": 0.1, "a2": 0.2, "a3": 0.15}
+    for stream_id in biases:
+        assert client.post("/streams", json=_config(stream_id, stream_id), headers=AUTH_HEADERS).status_code == 200
+    pooled = _config("a4", "a4", prior_pooling=True)
+    assert client.post("/streams", json=pooled, headers=AUTH_HEADERS).status_code == 200
+    for stream_id, bias in biases.items():
+        values = 5.2 + bias + 0.25 * rng.standard_normal(30)
+        response = client.post(
+            "/qc/records/batch",
+            json=[
+                qc_payload(stream_id, i, float(value), instrument_id=stream_id, run_id=f"{stream_id}-{i}")
+                for i, value in enumerate(values)
+            ],
+            headers=AUTH_HEADERS,
+        )
+        assert response.status_code == 200
+    # The new analyzer has two points of its own when the refit runs.
+    for i, value in enumerate((5.5, 5.3)):
+        assert client.post(
+            "/qc/records", json=qc_payload("a4", i, value, instrument_id="a4", run_id=f"a4-{i}"), headers=AUTH_HEADERS
+        ).status_code == 200
+
+    response = client.post("/hierarchy/refit", headers=AUTH_HEADERS)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["pooled_streams"] == ["a4"]
+    (group,) = body["groups"]
+    assert group["streams"] == 4 and group["points"] == 92
+    assert client.get("/hierarchy", headers=AUTH_HEADERS).json() == body["groups"]
+
+    with Session(get_engine()) as session:
+        prior = prior_config_history(session, "a4").active_at(START)
+        # Every hyperparameter of the stream's prior is fitted from the other three streams alone.
+        samples = [
+            np.array(session.exec(select(QCRecord.result_value).where(QCRecord.stream_id == stream_id)).all())
+            for stream_id in biases
+        ]
+        others = hierarchy.fit_groups(
+            np.zeros(3, dtype=int),
+            np.array([len(sample) for sample in samples], dtype=float),
+            np.array([sample.mean() - 5.2 for sample in samples]),
+            np.array([((sample - sample.mean()) ** 2).sum() for sample in samples]),
+            1,
+        )
+        assert prior.mu0 == pytest.approx(5.2 + others.offset[0])
+        assert prior.kappa0 == pytest.approx(others.kappa0[0])
+        assert prior.alpha0 == pytest.approx(others.alpha0[0])
+        assert prior.beta0 == pytest.approx(others.within_var[0] * (others.alpha0[0] - 1))
+        assert math.sqrt(others.within_var[0]) != pytest.approx(group["within_sd"], rel=1e-3)
+        state = session.exec(select(PosteriorState).where(PosteriorState.stream_id == "a4")).one()
+        assert state.n_obs == 2
+        assert state.kappa_n == pytest.approx(prior.kappa0 + 2)
+        assert session.exec(select(AuditEntry).where(AuditEntry.action == "pool_prior")).first() is not None
+
+    # An unchanged group leaves the prior alone.
+    assert client.post("/hierarchy/refit", headers=AUTH_HEADERS).json()["pooled_streams"] == []
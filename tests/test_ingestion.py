@@ -1,7 +1,12 @@
 from datetime import datetime, timedelta, timezone
 
+import pytest
 from fastapi.testclient import TestClient
+from sqlmodel import Session, select
 
+from app import bayesian
+from app.db import get_engine
+from app.db_models import AuditEntry, QCRecord
 from app.main import app
 
 client = TestClient(app)
@@ -76,3 +81,16 @@ def test_manual_entry_audited():
     assert audit_response.status_code == 200
     audit_entries = audit_response.json()
     assert any(entry["reason"] == "entered offline" for entry in audit_entries)
+
+
+def test_ingestion_rolls_back_as_one_unit(monkeypatch):
+    def _fail(*_args, **_kwargs):
+        raise RuntimeError("posterior update failed")
+
+    monkeypatch.setattr(bayesian, "infer_risk", _fail)
+    payload = _base_payload()
+    with pytest.raises(RuntimeError):
+        client.post("/qc/records", json=payload, headers={**AUTH_HEADERS, "Idempotency-Key": "rollback-1"})
+    with Session(get_engine()) as session:
+        assert session.exec(select(QCRecord)).all() == []
+        assert session.exec(select(AuditEntry).where(AuditEntry.action == "ingest_qc")).all() == []
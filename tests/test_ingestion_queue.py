@@ -0,0 +1,78 @@
+from datetime import datetime, timezone
+
+from fastapi.testclient import TestClient
+
+from app.main import app, drain_ingestion_queue
+
+client = TestClient(app)
+AUTH_HEADERS = {"X-API-Key": "local-dev-key"}
+
+
+def _base_payload():
+    return {
+        "stream_id": "hba1c-arch",
+        "result_value": 6.0,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "analyte": "HbA1c",
+        "qc_level": "Level 1",
+        "instrument_id": "Architect",
+        "method_id": "HPLC",
+        "operator_id": "tech1",
+        "reagent_lot": "RL-001",
+        "control_material_lot": "LOT-001",
+        "calibration_status": "ok",
+        "run_id": "run-123",
+        "units": "%",
+        "flags": [],
+        "entry_source": "automated",
+        "comments": None,
+    }
+
+
+def test_async_ingestion_returns_receipt_and_drains():
+    response = client.post("/qc/records?async=true", json=_base_payload(), headers=AUTH_HEADERS)
+    assert response.status_code == 202
+    receipt = response.json()
+    assert receipt["status"] == "pending"
+    assert receipt["response"] is None
+
+    metrics = client.get("/metrics", headers=AUTH_HEADERS).json()["ingestion_queue"]
+    assert metrics["depth"] == 1
+    assert metrics["oldest_enqueued_at"] is not None
+
+    assert drain_ingestion_queue() == 1
+    assert drain_ingestion_queue() == 0
+
+    polled = client.get(f"/qc/receipts/{receipt['id']}", headers=AUTH_HEADERS).json()
+    assert polled["status"] == "completed"
+    assert polled["qc_record_id"] is not None
+    assert polled["response"]["qc"]["signals"][0]["rule"] == "1-3s"
+    metrics = client.get("/metrics", headers=AUTH_HEADERS).json()["ingestion_queue"]
+    assert metrics["depth"] == 0
+    assert metrics["done"] == 1
+
+
+def test_async_row_errors_fail_the_receipt():
+    payload = _base_payload()
+    payload["units"] = "mmol/L"
+    headers = {**AUTH_HEADERS, "Idempotency-Key": "async-bad-units"}
+    receipt = client.post("/qc/records?async=true", json=payload, headers=headers).json()
+    repeat = client.post("/qc/records?async=true", json=payload, headers=headers)
+    assert repeat.status_code == 202
+    assert repeat.json()["id"] == receipt["id"]
+
+    drain_ingestion_queue()
+    polled = client.get(f"/qc/receipts/{receipt['id']}", headers=AUTH_HEADERS).json()
+    assert polled["status"] == "failed"
+    assert polled["error"] == "Units do not match stream configuration"
+
+    # Replaying the spent key reports the failed receipt instead of an empty result.
+    for url in ("/qc/records", "/qc/records?async=true"):
+        replay = client.post(url, json=payload, headers=headers)
+        assert replay.status_code == 409
+        assert replay.json()["id"] == receipt["id"]
+        assert replay.json()["status"] == "failed"
+    payload["units"] = "%"
+    retry = client.post("/qc/records", json=payload, headers={**AUTH_HEADERS, "Idempotency-Key": "async-bad-units-2"})
+    assert retry.status_code == 200
+    assert retry.json()["qc"]["signals"][0]["rule"] == "1-3s"
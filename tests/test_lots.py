@@ -0,0 +1,229 @@
+import math
+from datetime import timedelta
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from conftest import START, qc_payload
+from fastapi.testclient import TestClient
+from sqlmodel import Session, select
+
+from app import bayesian, lots
+from app.cache import LotStats, check_out, lot_state_cache
+from app.db import get_engine
+from app.db_models import LotState, PosteriorHistory
+from app.main import app
+from app.replay import replay_stream
+from app.storage import prior_config_history, stream_config_history, stream_history_arrays, stream_lot_offsets
+
+client = TestClient(app)
+AUTH_HEADERS = {"X-API-Key": "local-dev-key"}
+
+
+def test_lot_offsets_shrink_toward_the_pooled_prior():
+    rng = np.random.default_rng(31)
+    stats = []
+    for offset in 0.1 + 0.1 * rng.standard_normal(8):
+        lot = LotStats()
+        for value in offset + 0.25 * rng.standard_normal(30):
+            lot.add(float(value))
+        stats.append(lot)
+    prior = lots.pooled_prior(stats, sigma=0.3)
+    assert prior.offset == pytest.approx(np.mean([lot.mean for lot in stats]))
+    assert math.sqrt(prior.within_var) == pytest.approx(0.25, rel=0.1)
+    assert math.sqrt(prior.between_var) == pytest.approx(0.1, rel=0.5)
+    for lot in stats:
+        posterior = lots.lot_offset(lot, prior, threshold=0.3)
+        assert min(lot.mean, prior.offset) <= posterior.mean <= max(lot.mean, prior.offset)
+        assert posterior.sd < math.sqrt(prior.within_var / lot.n)
+    # A lot with no data yet is scored from the pooled prior alone.
+    fresh = lots.lot_offset(LotStats(), prior, threshold=0.3)
+    assert (fresh.mean, fresh.sd) == pytest.approx((prior.offset, math.sqrt(prior.between_var)))
+    # One lot cannot say how lots vary, so the prior falls back to one config SD around target.
+    assert lots.pooled_prior(stats[:1], sigma=0.3) == pytest.approx((0.0, stats[0].m2 / 29, stats[0].m2 / 29))
+
+
+def test_lot_posteriors_persist_and_follow_exclusions():
+    config = {
+        "stream_id": "lots",
+        "analyte": "HbA1c",
+        "method": "HPLC",
+        "instrument": "Architect",
+        "qc_level": "Level 1",
+        "control_material_lot": "LOT-001",
+        "units": "%",
+        "target_value": 5.2,
+        "sigma": 0.25,
+        "bias_threshold": 0.25,
+        "lot_model": True,
+        "effective_from": (START - timedelta(days=1)).isoformat(),
+    }
+    assert client.post("/streams", json=config, headers=AUTH_HEADERS).status_code == 200
+    prior = {"stream_id": "lots", "mu0": 5.2, "kappa0": 1.0, "alpha0": 2.0, "beta0": 0.0625}
+    assert client.post("/streams/lots/priors", json=prior, headers=AUTH_HEADERS).status_code == 200
+
+    rng = np.random.default_rng(2)
+    for i, value in enumerate(5.2 + 0.25 * rng.standard_normal(20)):
+        payload = qc_payload("lots", i, float(value), control_material_lot="LOT-001")
+        risk = client.post("/qc/records", json=payload, headers=AUTH_HEADERS).json()
+        assert risk["qc"]["bayesian_risk"]["lot_offset"] is not None
+    batch = [
+        qc_payload("lots", 20 + i, float(value), control_material_lot="LOT-002")
+        for i, value in enumerate(5.7 + 0.25 * rng.standard_normal(20))
+    ]
+    items = client.post("/qc/records/batch", json=batch, headers=AUTH_HEADERS).json()["results"]
+    shifted = items[-1]["result"]["qc"]["bayesian_risk"]
+    assert shifted["lot_offset"] > 0.35 and shifted["probability_lot_shift"] > 0.9
+
+    before = client.get("/streams/lots/lots", headers=AUTH_HEADERS).json()
+    assert [(lot["control_material_lot"], lot["n"]) for lot in before["lots"]] == [("LOT-001", 20), ("LOT-002", 20)]
+    assert before["lots"][-1]["lot_offset"] == pytest.approx(shifted["lot_offset"])
+    # The first point of a new lot is scored against the pooled prior straight away.
+    payload = qc_payload("lots", 40, 5.2, control_material_lot="LOT-003")
+    first = client.post("/qc/records", json=payload, headers=AUTH_HEADERS).json()
+    fresh = first["qc"]["bayesian_risk"]
+    after = client.get("/streams/lots/lots", headers=AUTH_HEADERS).json()
+    assert 0 < fresh["lot_offset"] < after["pooled_offset"]
+    assert fresh["lot_offset_sd"] < after["between_lot_sd"]
+
+    # The statistics are persisted, so a cold cache reads back the same lots.
+    lot_state_cache.clear()
+    assert client.get("/streams/lots/lots", headers=AUTH_HEADERS).json() == after
+
+    records = client.get("/streams/lots/chart?limit=100", headers=AUTH_HEADERS).json()["records"]
+    excluded = [record["id"] for record in records if record["control_material_lot"] == "LOT-002"][:15]
+    response = client.patch(
+        "/qc/records/resolution", json={"include_in_stats": False, "record_ids": excluded}, headers=AUTH_HEADERS
+    )
+    assert response.status_code == 200
+    rebuilt = client.get("/streams/lots/lots", headers=AUTH_HEADERS).json()
+    assert [lot["n"] for lot in rebuilt["lots"]] == [20, 5, 1]
+
+    # Exclusions and reinstatements move only the affected lot, to the statistics of its included points.
+    def _lot_stats(lot_number):
+        with Session(get_engine()) as session:
+            state = session.exec(select(LotState).where(LotState.control_material_lot == lot_number)).one()
+            return state.n, state.mean, state.m2
+
+    lot_values = np.array([r["result_value"] for r in records if r["control_material_lot"] == "LOT-002"]) - 5.2
+    kept = lot_values[15:]
+    assert _lot_stats("LOT-002") == pytest.approx((5, kept.mean(), ((kept - kept.mean()) ** 2).sum()))
+    response = client.patch(
+        "/qc/records/resolution", json={"include_in_stats": True, "record_ids": excluded[:5]}, headers=AUTH_HEADERS
+    )
+    assert response.status_code == 200
+    kept = np.concatenate([lot_values[:5], lot_values[15:]])
+    assert _lot_stats("LOT-002") == pytest.approx((10, kept.mean(), ((kept - kept.mean()) ** 2).sum()))
+    (lone,) = [record["id"] for record in records if record["control_material_lot"] == "LOT-003"]
+    response = client.patch(f"/qc/records/{lone}/resolution", json={"include_in_stats": False}, headers=AUTH_HEADERS)
+    assert response.status_code == 200
+    lots_left = client.get("/streams/lots/lots", headers=AUTH_HEADERS).json()["lots"]
+    assert [(lot["control_material_lot"], lot["n"]) for lot in lots_left] == [("LOT-001", 20), ("LOT-002", 10)]
+
+
+def test_concurrent_lot_updates_both_land():
+    config = {
+        "stream_id": "lots",
+        "analyte": "HbA1c",
+        "method": "HPLC",
+        "instrument": "Architect",
+        "qc_level": "Level 1",
+        "control_material_lot": "LOT-001",
+        "units": "%",
+        "target_value": 5.2,
+        "sigma": 0.25,
+        "lot_model": True,
+        "effective_from": (START - timedelta(days=1)).isoformat(),
+    }
+    assert client.post("/streams", json=config, headers=AUTH_HEADERS).status_code == 200
+    for i, value in enumerate((5.1, 5.3, 5.25)):
+        assert client.post("/qc/records", json=qc_payload("lots", i, value), headers=AUTH_HEADERS).status_code == 200
+    assert client.get("/streams/lots/lots", headers=AUTH_HEADERS).json()["lots"][0]["n"] == 3
+
+    # The second ingest reads the lots before the first commits, then commits after it.
+    with Session(get_engine()) as first, Session(get_engine()) as second:
+        stream_config = stream_config_history(first, "lots").versions[-1]
+        check_out(second, lot_state_cache, "lots")
+        lots.update_lots(first, "lots", [SimpleNamespace(**qc_payload("lots", 3, 5.4))], [stream_config])
+        first.commit()
+        lots.update_lots(second, "lots", [SimpleNamespace(**qc_payload("lots", 4, 5.0))], [stream_config])
+        second.commit()
+        (state,) = second.exec(select(LotState).where(LotState.stream_id == "lots")).all()
+    deviations = np.array([5.1, 5.3, 5.25, 5.4, 5.0]) - 5.2
+    assert state.n == 5
+    assert state.mean == pytest.approx(deviations.mean())
+    assert state.m2 == pytest.approx(((deviations - deviations.mean()) ** 2).sum())
+    # The stale copy is not checked in, so the next read reloads both points.
+    assert client.get("/streams/lots/lots", headers=AUTH_HEADERS).json()["lots"][0]["n"] == 5
+
+    # Both ingests see LOT-002 as new; the second insert conflicts and merges into the first one's row.
+    with Session(get_engine()) as first, Session(get_engine()) as second:
+        check_out(second, lot_state_cache, "lots")
+        new_lot = [SimpleNamespace(**qc_payload("lots", 5, 5.6, control_material_lot="LOT-002"))]
+        lots.update_lots(first, "lots", new_lot, [stream_config])
+        first.commit()
+        new_lot = [SimpleNamespace(**qc_payload("lots", 6, 5.8, control_material_lot="LOT-002"))]
+        lots.update_lots(second, "lots", new_lot, [stream_config])
+        second.commit()
+        (state,) = second.exec(select(LotState).where(LotState.control_material_lot == "LOT-002")).all()
+    assert (state.n, state.mean, state.m2) == pytest.approx((2, 0.5, 0.02))
+    assert [lot["n"] for lot in client.get("/streams/lots/lots", headers=AUTH_HEADERS).json()["lots"]] == [5, 2]
+
+
+def test_lot_change_does_not_move_the_posterior():
+    rng = np.random.default_rng(5)
+    values = np.concatenate([5.2 + 0.1 * rng.standard_normal(30), 5.7 + 0.1 * rng.standard_normal(20)])
+    lot_numbers = ["LOT-001"] * 30 + ["LOT-002"] * 20
+    scored = {}
+    for stream_id, lot_model in (("lots", True), ("plain", False)):
+        config = {
+            "stream_id": stream_id,
+            "analyte": "HbA1c",
+            "method": "HPLC",
+            "instrument": "Architect",
+            "qc_level": "Level 1",
+            "control_material_lot": "LOT-001",
+            "units": "%",
+            "target_value": 5.2,
+            "sigma": 0.25,
+            "bias_threshold": 0.25,
+            "lot_model": lot_model,
+            "effective_from": (START - timedelta(days=1)).isoformat(),
+        }
+        assert client.post("/streams", json=config, headers=AUTH_HEADERS).status_code == 200
+        prior = {"stream_id": stream_id, "mu0": 5.2, "kappa0": 1.0, "alpha0": 2.0, "beta0": 0.0625}
+        assert client.post(f"/streams/{stream_id}/priors", json=prior, headers=AUTH_HEADERS).status_code == 200
+        single = [
+            client.post(
+                "/qc/records",
+                json=qc_payload(stream_id, i, float(values[i]), control_material_lot=lot_numbers[i]),
+                headers=AUTH_HEADERS,
+            ).json()["qc"]
+            for i in range(40)
+        ]
+        batch = [qc_payload(stream_id, i, float(values[i]), control_material_lot=lot_numbers[i]) for i in range(40, 50)]
+        items = client.post("/qc/records/batch", json=batch, headers=AUTH_HEADERS).json()["results"]
+        scored[stream_id] = [qc["bayesian_risk"] for qc in single + [item["result"]["qc"] for item in items]]
+
+    # Without the lot model the new lot drags the posterior off target and the risk jumps.
+    plain = scored["plain"]
+    assert plain[-1]["posterior_mean"] > 5.35 and plain[-1]["risk_score"] > plain[29]["risk_score"]
+    # With it the shift is put down to the lot, and the posterior and risk stay where they were.
+    adjusted = scored["lots"]
+    assert abs(adjusted[-1]["posterior_mean"] - adjusted[29]["posterior_mean"]) < 0.05
+    assert max(risk["risk_score"] for risk in adjusted[30:]) <= max(risk["risk_score"] for risk in adjusted[:30])
+    assert adjusted[-1]["lot_offset"] > 0.35 and adjusted[-1]["probability_lot_shift"] > 0.9
+
+    # Replays and rebuilds fold the same lot-adjusted values.
+    with Session(get_engine()) as session:
+        configs = stream_config_history(session, "lots").versions
+        priors = prior_config_history(session, "lots").versions
+        times, stored, included = stream_history_arrays(session, "lots")
+        result = replay_stream(stored, times, configs, priors, included, stream_lot_offsets(session, "lots"))
+        assert [risk["posterior_mean"] for risk in adjusted] == pytest.approx(result.mu_n.tolist(), rel=1e-12)
+        history = session.exec(
+            select(PosteriorHistory.mu_n).where(PosteriorHistory.stream_id == "lots").order_by(PosteriorHistory.id)
+        ).all()
+        assert history == pytest.approx(result.mu_n.tolist(), rel=1e-12)
+        state = bayesian.rebuild_posterior_state(session, "lots")
+        assert state.mu_n == pytest.approx(result.mu_n[-1], rel=1e-9)
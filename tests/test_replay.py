@@ -0,0 +1,200 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+from conftest import START, create_stream, qc_payload
+from fastapi.testclient import TestClient
+from sqlmodel import Session
+
+from app.db import get_engine
+from app.main import app
+from app.db_models import PriorConfig
+from app.replay import replay_series, replay_stream
+from app.storage import prior_config_history, stream_config_history, stream_history_arrays
+
+client = TestClient(app)
+AUTH_HEADERS = {"X-API-Key": "local-dev-key"}
+RULES = ["1-3s", "2-2s", "R-4s", "4-1s", "10x", "CUSUM", "EWMA", {"name": "2of3-2s", "type": "count", "k": 2, "n": 3, "limit": "warn"}]
+
+
+@pytest.mark.parametrize(
+    "first, second",
+    [
+        (
+            {"baseline_start": START.isoformat(), "baseline_end": (START + timedelta(hours=20)).isoformat()},
+            {"baseline_mode": "last_n_runs", "baseline_runs": 6},
+        ),
+        (
+            {"baseline_mode": "rolling_window", "baseline_window_hours": 8, "baseline_method": "median_mad"},
+            {"target_value": 5.3, "action_limit_sd": 2.5, "rule_set": {"rules": ["1-3s", "EWMA"], "ewma": {"lambda": 0.3}}},
+        ),
+    ],
+)
+def test_replay_matches_sequential_ingestion(first, second):
+    create_stream("replay", **{"rule_set": {"rules": RULES}, **first})
+    later = (START + timedelta(hours=30)).isoformat()
+    create_stream("replay", prior=False, effective_from=later, **{"rule_set": {"rules": RULES}, **second})
+
+    rng = random.Random(17)
+    responses = []
+    for index in range(60):
+        shift = 0.3 if 35 <= index < 50 else 0.0
+        value = round(5.2 + shift + rng.gauss(0, 0.25), 3)
+        response = client.post("/qc/records", json=qc_payload("replay", index, value), headers=AUTH_HEADERS)
+        assert response.status_code == 200
+        responses.append(response.json()["qc"])
+
+    with Session(get_engine()) as session:
+        configs = stream_config_history(session, "replay").versions
+        priors = prior_config_history(session, "replay").versions
+        times, values, included = stream_history_arrays(session, "replay")
+    result = replay_stream(values, times, configs, priors, included)
+
+    fired = set()
+    for i, qc in enumerate(responses):
+        live = sorted(signal["rule"] for signal in qc["signals"])
+        assert sorted(name for name, flags in result.flags.items() if flags[i]) == live, i
+        fired.update(live)
+        assert result.risk_score[i] == qc["bayesian_risk"]["risk_score"]
+        assert result.mu_n[i] == pytest.approx(qc["bayesian_risk"]["posterior_mean"], rel=1e-9)
+    assert fired
+
+    chart = client.get("/streams/replay/chart", headers=AUTH_HEADERS).json()["records"]
+    assert result.baseline_mean == pytest.approx([record["baseline_mean"] for record in chart], rel=1e-9)
+    assert result.baseline_sd == pytest.approx([record["baseline_sd"] for record in chart], rel=1e-6)
+    assert result.cusum_upper == pytest.approx([record["cusum_upper"] for record in chart], rel=1e-6, abs=1e-9)
+    assert result.ewma == pytest.approx([record["ewma"] for record in chart], rel=1e-6, abs=1e-9)
+
+    response = client.post(
+        "/streams/replay/replay",
+        json={"start": (START + timedelta(hours=30)).isoformat(), "include_series": True},
+        headers=AUTH_HEADERS,
+    )
+    assert response.status_code == 200
+    body = response.json()
+    assert body["points"] == 30
+    assert body["series"]["risk_score"] == result.risk_score[30:].tolist()
+    assert body["signal_counts"] == {name: int(flags[30:].sum()) for name, flags in result.flags.items()}
+
+
+def test_replay_handles_exclusions_and_large_streams():
+    with Session(get_engine()) as session:
+        configs = stream_config_history(session, "hba1c-arch").versions
+        priors = prior_config_history(session, "hba1c-arch").versions
+    rng = np.random.default_rng(3)
+    count = 200_000
+    times = np.datetime64("2024-01-01T00:00:00", "us") + np.arange(count) * np.timedelta64(60, "s")
+    values = 5.2 + 0.25 * rng.standard_normal(count)
+    included = rng.random(count) > 0.01
+
+    result = replay_stream(values, times, configs, priors, included)
+    assert result.z.shape == (count,)
+    assert np.isnan(result.cusum_upper[~included]).all()
+    # Excluded rows are scored but never feed the posterior or rule history.
+    excluded = np.flatnonzero(~included[1:] & included[:-1]) + 1
+    assert (result.kappa_n[excluded] == result.kappa_n[excluded - 1]).all()
+    assert result.kappa_n[-1] == priors[0].kappa0 + included.sum()
+    with pytest.raises(ValueError):
+        replay_stream(values[::-1], times[::-1], configs, priors)
+
+
+def test_config_simulation_compares_candidate_with_current_without_writing():
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    first_day = (now - timedelta(days=200)).isoformat()
+    create_stream("whatif", rule_set={"rules": ["1-3s", "2-2s"]}, effective_from=first_day)
+
+    rng = random.Random(23)
+    recent = []
+    for index in range(80):
+        # 20 points before the 90-day window, then 60 inside it with a shift in the middle.
+        ts = now - timedelta(days=120 - index) if index < 20 else now - timedelta(days=80) + timedelta(days=index - 20)
+        shift = 0.35 if 50 <= index < 65 else 0.0
+        payload = qc_payload("whatif", index, round(5.2 + shift + rng.gauss(0, 0.25), 3), timestamp=ts.isoformat())
+        response = client.post("/qc/records", json=payload, headers=AUTH_HEADERS)
+        assert response.status_code == 200
+        if index >= 20:
+            recent.append(response.json()["qc"]["disposition"])
+
+    current = client.get("/streams/whatif/configs", headers=AUTH_HEADERS).json()[0]
+    same = {key: current[key] for key in ("analyte", "method", "instrument", "qc_level", "control_material_lot", "units")}
+    same.update(stream_id="whatif", target_value=5.2, sigma=0.25, rule_set={"rules": ["1-3s", "2-2s"]})
+    response = client.post("/streams/whatif/configs/simulate", json={"config": same}, headers=AUTH_HEADERS)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["points"] == 60
+    assert body["current"] == body["candidate"]
+    assert body["changed_dispositions"] == 0
+    assert body["current"]["dispositions"] == {name: recent.count(name) for name in ("accept", "monitor", "hold-for-review", "reject")}
+    assert body["current"]["alerts"] == sum(disposition != "accept" for disposition in recent)
+
+    stricter = {**same, "rule_set": {"rules": ["1-3s", "2-2s", "4-1s", "10x", "CUSUM"]}, "risk_threshold_warn": 20}
+    tighter_prior = {"stream_id": "whatif", "mu0": 5.2, "kappa0": 50.0, "alpha0": 20.0, "beta0": 1.25}
+    response = client.post(
+        "/streams/whatif/configs/simulate",
+        json={"config": stricter, "prior": tighter_prior, "include_series": True},
+        headers=AUTH_HEADERS,
+    )
+    body = response.json()
+    assert body["candidate"]["alerts"] > body["current"]["alerts"]
+    assert body["changed_dispositions"] > 0
+    assert len(body["candidate"]["series"]["disposition"]) == 60
+    assert "CUSUM" in body["candidate"]["signal_counts"] and "CUSUM" not in body["current"]["signal_counts"]
+
+    # Nothing was published or refolded.
+    assert len(client.get("/streams/whatif/configs", headers=AUTH_HEADERS).json()) == 1
+    assert len(client.get("/streams/whatif/priors", headers=AUTH_HEADERS).json()) == 1
+    bad = {**same, "rule_set": {"rules": [{"name": "bad", "type": "median", "n": 3}]}}
+    assert client.post("/streams/whatif/configs/simulate", json={"config": bad}, headers=AUTH_HEADERS).status_code == 422
+    assert client.post("/streams/missing/configs/simulate", json={"config": same}, headers=AUTH_HEADERS).status_code == 404
+
+
+def test_config_simulation_replays_only_the_window_from_seeded_state():
+    now = datetime.now(timezone.utc).replace(microsecond=0, second=0, minute=0)
+    first = now - timedelta(hours=9999)
+    rules = {"rules": ["1-3s", "2-2s", "CUSUM", "EWMA", "CHANGEPOINT"]}
+    create_stream("fast", rule_set=rules, drift_model="local_trend", effective_from=(first - timedelta(days=1)).isoformat())
+    rng = np.random.default_rng(41)
+    values = 5.2 + 0.25 * rng.standard_normal(10000)
+    for offset in range(0, 10000, 2000):
+        batch = [
+            qc_payload("fast", index, round(float(values[index]), 4), timestamp=(first + timedelta(hours=index)).isoformat())
+            for index in range(offset, offset + 2000)
+        ]
+        assert client.post("/qc/records/batch", json=batch, headers=AUTH_HEADERS).status_code == 200
+
+    current = client.get("/streams/fast/configs", headers=AUTH_HEADERS).json()[0]
+    same = {key: current[key] for key in ("analyte", "method", "instrument", "qc_level", "control_material_lot", "units")}
+    same.update(stream_id="fast", target_value=5.2, sigma=0.25, rule_set=rules, drift_model="local_trend")
+    prior = {"stream_id": "fast", "mu0": 5.25, "kappa0": 20.0, "alpha0": 10.0, "beta0": 0.6}
+    response = client.post(
+        "/streams/fast/configs/simulate",
+        json={"config": same, "prior": prior, "days": 7, "include_series": True},
+        headers=AUTH_HEADERS,
+    )
+    body = response.json()
+    # Well under a second: only the window and its warm-up are replayed, from checkpointed state.
+    assert body["points"] == 168 and body["elapsed_ms"] < 1000
+
+    # The window matches a replay of the whole stream.
+    with Session(get_engine()) as session:
+        configs = stream_config_history(session, "fast").versions
+        priors = prior_config_history(session, "fast").versions
+        times, stored, included = stream_history_arrays(session, "fast")
+    full = replay_series(replay_stream(stored, times, configs, priors, included), np.arange(10000 - 168, 10000))
+    series = body["current"]["series"]
+    for name in (
+        "posterior_mean",
+        "risk_score",
+        "drift_level",
+        "probability_drift",
+        "probability_changepoint",
+        "ewma",
+        "cusum_upper",
+    ):
+        assert series[name] == pytest.approx(full[name], rel=1e-9, abs=1e-9), name
+    assert series["signals"] == full["signals"]
+    candidate = replay_series(
+        replay_stream(stored, times, configs, [PriorConfig(**prior)], included), np.arange(10000 - 168, 10000)
+    )
+    assert body["candidate"]["series"]["posterior_mean"] == pytest.approx(candidate["posterior_mean"], rel=1e-9)
@@ -0,0 +1,72 @@
+import math
+
+import numpy as np
+import pytest
+
+from app import risk
+from app.bayesian import _update_posterior_array
+
+NODES, WEIGHTS = np.polynomial.legendre.leggauss(60)
+
+
+def _reference_t_cdf(t, df):
+    # Gauss-Legendre quadrature of the Student-t density from 0 to t.
+    density = math.exp(math.lgamma((df + 1) / 2) - math.lgamma(df / 2)) / math.sqrt(df * math.pi)
+    edges = np.linspace(0.0, t, 101)
+    total = 0.0
+    for low, high in zip(edges[:-1], edges[1:]):
+        x = (high - low) / 2 * NODES + (low + high) / 2
+        total += (high - low) / 2 * np.sum(WEIGHTS * density * np.exp(-(df + 1) / 2 * np.log1p(x * x / df)))
+    return 0.5 + total
+
+
+def test_student_t_cdf_matches_closed_forms_and_quadrature():
+    ts = np.linspace(-9.0, 9.0, 73)
+    for t in ts:
+        assert risk.student_t_cdf(t, 1.0) == pytest.approx(0.5 + math.atan(t) / math.pi, abs=1e-14)
+        assert risk.student_t_cdf(t, 2.0) == pytest.approx(0.5 + t / (2 * math.sqrt(2 + t * t)), abs=1e-14)
+    # Either side of the switch to Hill's transform, and far into the large-df regime.
+    for df in (3.0, 7.5, 50.0, 99.5, 100.0, 420.0, 5000.0):
+        for t in ts[::4]:
+            assert risk.student_t_cdf(t, df) == pytest.approx(_reference_t_cdf(t, df), abs=1e-12), (t, df)
+    assert risk.student_t_cdf(-2.5, 2e6) == pytest.approx(0.5 * math.erfc(2.5 / math.sqrt(2)), rel=1e-5)
+    assert risk.student_t_cdf(float("-inf"), 4.0) == 0.0
+
+    x = np.linspace(0.0, 1.0, 41)
+    for a, b in ((1.0, 1.0), (2.5, 1.0), (1.0, 0.5), (30.0, 0.5)):
+        expected = x**a if b == 1.0 else (1 - (1 - x) ** b if a == 1.0 else None)
+        computed = risk.betainc_array(np.full_like(x, a), np.full_like(x, b), x)
+        assert computed == pytest.approx([risk.betainc(a, b, value) for value in x], abs=1e-14)
+        if expected is not None:
+            assert computed == pytest.approx(expected, abs=1e-13)
+
+
+def test_vectorized_exceedance_matches_scalar_path():
+    rng = np.random.default_rng(19)
+    # Posterior trajectories from a short to a long stream, so df spans both CDF algorithms.
+    values = 5.2 + 0.25 * rng.standard_normal(600)
+    values[350:] += 0.5
+    mu_n, kappa_n, alpha_n, beta_n = _update_posterior_array(5.2, 1.0, 2.0, 0.0625, values)
+    targets = np.full(600, 5.2)
+    spreads = np.where(np.arange(600) < 300, 0.75, 0.6)
+    biases = np.full(600, 0.1)
+    # Degenerate states score zero on both paths.
+    kappa_n[5] = 0.0
+    beta_n[7] = 0.0
+
+    outside, biased = risk.exceedance_probabilities(mu_n, kappa_n, alpha_n, beta_n, targets, spreads, biases)
+    for i in range(600):
+        scalar = risk.exceedance_probability(
+            mu_n[i], kappa_n[i], alpha_n[i], beta_n[i], targets[i], spreads[i], biases[i]
+        )
+        assert (outside[i], biased[i]) == pytest.approx(scalar, rel=1e-12, abs=1e-15), i
+    assert outside[5] == biased[5] == outside[7] == 0.0
+    assert risk.risk_scores(outside).tolist() == [risk.risk_score(p) for p in outside]
+
+    # The shift pushes the posterior of mu past the bias threshold.
+    assert biased[340] < 0.01 and biased[-1] > 0.99
+    # With few points the t predictive has heavier tails than a normal of the same scale.
+    scale = math.sqrt(beta_n[3] * (kappa_n[3] + 1) / (alpha_n[3] * kappa_n[3]))
+    normal = math.erfc((targets[3] + spreads[3] - mu_n[3]) / (scale * math.sqrt(2))) / 2
+    normal += math.erfc((mu_n[3] - targets[3] + spreads[3]) / (scale * math.sqrt(2))) / 2
+    assert outside[3] > normal
@@ -0,0 +1,103 @@
+import math
+from datetime import timedelta
+
+import numpy as np
+import pytest
+from conftest import START, qc_payload
+from fastapi.testclient import TestClient
+from sqlmodel import Session, select
+
+from app import bayesian, robust
+from app.bayesian import _update_posterior
+from app.db import get_engine
+from app.db_models import PosteriorState
+from app.main import app
+from app.replay import replay_stream
+from app.storage import prior_config_history, stream_config_history, stream_history_arrays
+
+client = TestClient(app)
+AUTH_HEADERS = {"X-API-Key": "local-dev-key"}
+
+
+def test_robust_step_discounts_gross_errors_and_falls_back_when_degenerate():
+    posterior = (5.2, 30.0, 16.0, 1.0)
+    ordinary = robust.robust_step(*posterior, 5.35, 0.01, 10.0)
+    assert ordinary[4] < 0.01
+    assert ordinary[:4] == pytest.approx(_update_posterior(*posterior, 5.35), rel=1e-3)
+
+    gross = robust.robust_step(*posterior, 9.0, 0.01, 10.0)
+    conjugate = _update_posterior(*posterior, 9.0)
+    assert gross[4] > 0.99
+    assert abs(gross[0] - 5.2) < 0.01 < abs(conjugate[0] - 5.2)
+    assert gross[3] - posterior[3] < 0.01 * (conjugate[3] - posterior[3])
+
+    # A posterior without spread gives no predictive to judge against, so the step is conjugate.
+    fallback = robust.robust_step(5.2, 1.0, 2.0, 0.0, 5.3, 0.01, 10.0)
+    assert fallback[:4] == pytest.approx(_update_posterior(5.2, 1.0, 2.0, 0.0, 5.3))
+    assert math.isnan(fallback[4])
+
+
+def test_robust_stream_scores_outliers_and_matches_replay():
+    config = {
+        "stream_id": "robust",
+        "analyte": "HbA1c",
+        "method": "HPLC",
+        "instrument": "Architect",
+        "qc_level": "Level 1",
+        "control_material_lot": "LOT-001",
+        "units": "%",
+        "target_value": 5.2,
+        "sigma": 0.25,
+        "robust_contamination": 0.01,
+        "effective_from": (START - timedelta(days=1)).isoformat(),
+    }
+    assert client.post("/streams", json=config, headers=AUTH_HEADERS).status_code == 200
+    invalid = {**config, "stream_id": "invalid", "robust_contamination": 1.5}
+    assert client.post("/streams", json=invalid, headers=AUTH_HEADERS).status_code == 422
+    prior = {"stream_id": "robust", "mu0": 5.2, "kappa0": 1.0, "alpha0": 2.0, "beta0": 0.0625}
+    assert client.post("/streams/robust/priors", json=prior, headers=AUTH_HEADERS).status_code == 200
+
+    values = 5.2 + 0.25 * np.random.default_rng(17).standard_normal(80)
+    values[30] = 12.0
+    values[65] = -1.0
+    single = [
+        client.post("/qc/records", json=qc_payload("robust", i, float(values[i])), headers=AUTH_HEADERS).json()["qc"]
+        for i in range(40)
+    ]
+    batch = client.post(
+        "/qc/records/batch",
+        json=[qc_payload("robust", i, float(values[i])) for i in range(40, 80)],
+        headers=AUTH_HEADERS,
+    ).json()
+    scored = [qc["bayesian_risk"] for qc in single + [item["result"]["qc"] for item in batch["results"]]]
+    outliers = [risk["probability_outlier"] for risk in scored]
+    assert outliers[30] > 0.99 and outliers[65] > 0.99
+    assert max(p for i, p in enumerate(outliers) if i not in (30, 65)) < 0.5
+    assert abs(scored[-1]["posterior_mean"] - 5.2) < 0.1
+    assert scored[-1]["posterior_sigma"] < 0.35
+
+    with Session(get_engine()) as session:
+        configs = stream_config_history(session, "robust").versions
+        priors = prior_config_history(session, "robust").versions
+        times, stored, included = stream_history_arrays(session, "robust")
+    result = replay_stream(stored, times, configs, priors, included)
+    assert outliers == pytest.approx(result.probability_outlier.tolist(), rel=1e-9, abs=1e-12)
+    assert [risk["posterior_mean"] for risk in scored] == pytest.approx(result.mu_n.tolist(), rel=1e-12)
+    chart = client.get("/streams/robust/chart?limit=100", headers=AUTH_HEADERS).json()
+    assert chart["posterior"]["probability_outlier"] == pytest.approx(outliers)
+
+    # Excluding the gross errors refolds the robust posterior from the prior in order.
+    excluded = [chart["records"][30]["id"], chart["records"][65]["id"]]
+    response = client.patch(
+        "/qc/records/resolution", json={"include_in_stats": False, "record_ids": excluded}, headers=AUTH_HEADERS
+    )
+    assert response.status_code == 200
+    result = replay_stream(stored, times, configs, priors, np.isin(np.arange(80), [30, 65], invert=True))
+    with Session(get_engine()) as session:
+        state = session.exec(select(PosteriorState).where(PosteriorState.stream_id == "robust")).one()
+        assert state.n_obs == 78
+        assert state.mu_n == pytest.approx(result.mu_n[-1], rel=1e-12)
+        assert state.beta_n == pytest.approx(result.beta_n[-1], rel=1e-12)
+        # There is no aggregate form for robust weights, so a rebuild refolds to the same state.
+        rebuilt = bayesian.rebuild_posterior_state(session, "robust")
+        assert (rebuilt.mu_n, rebuilt.n_obs) == (pytest.approx(result.mu_n[-1], rel=1e-12), 78)
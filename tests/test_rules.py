@@ -0,0 +1,138 @@
+import random
+from datetime import timedelta
+
+import numpy as np
+from conftest import START, qc_payload
+from fastapi.testclient import TestClient
+
+from app.db_models import DEFAULT_RULE_SET, StreamConfig
+from app.main import app
+from app.rules import compile_rules
+
+client = TestClient(app)
+AUTH_HEADERS = {"X-API-Key": "local-dev-key"}
+
+
+def _reference_signals(z, recent_z, warn, action):
+    # The hard-coded Westgard chain the compiled rules replace.
+    fired = []
+    if abs(z) >= action:
+        fired.append(("1-3s", f"|z|={abs(z):.2f} exceeds action limit"))
+    if abs(z) >= warn and recent_z:
+        prev = recent_z[-1]
+        if (z >= warn and prev >= warn) or (z <= -warn and prev <= -warn):
+            direction = "high" if z > 0 else "low"
+            fired.append(("2-2s", f"Consecutive warning-level deviations in same direction ({direction})"))
+    if recent_z:
+        prev = recent_z[-1]
+        if (z >= warn and prev <= -warn) or (z <= -warn and prev >= warn):
+            fired.append(("R-4s", "Consecutive results exceed 4 SD range in opposite directions"))
+    last_four = recent_z[-3:] + [z]
+    if len(last_four) == 4 and (all(v >= 1 for v in last_four) or all(v <= -1 for v in last_four)):
+        fired.append(("4-1s", "Four consecutive results exceed 1 SD on the same side"))
+    last_ten = recent_z[-9:] + [z]
+    if len(last_ten) == 10 and (all(v > 0 for v in last_ten) or all(v < 0 for v in last_ten)):
+        fired.append(("10x", "Ten consecutive results on the same side of the mean"))
+    return fired
+
+
+def test_compiled_builtins_match_the_westgard_chain():
+    rng = random.Random(5)
+    config = StreamConfig(
+        stream_id="rules",
+        analyte="HbA1c",
+        method="HPLC",
+        instrument="Architect",
+        qc_level="Level 1",
+        control_material_lot="LOT-001",
+        units="%",
+        target_value=0.0,
+        sigma=1.0,
+        rule_set=DEFAULT_RULE_SET,
+    )
+    compiled = compile_rules(config)
+    assert compiled.lookback == 9
+
+    # Drifting z-scores so every rule fires somewhere; rows see 0..9 points of history.
+    zs = []
+    level = 0.0
+    for _ in range(3000):
+        level = 0.9 * level + rng.gauss(0, 0.6)
+        zs.append(round(level + rng.gauss(0, 1.2), 1))
+    history = np.full((len(zs), 9), np.nan)
+    for i in range(len(zs)):
+        available = min(i % 12, i, 9)
+        if available:
+            history[i, 9 - available :] = zs[i - available : i]
+    results = compiled.evaluate(np.array(zs), history)
+
+    seen = set()
+    for i, signals in enumerate(results):
+        recent = [v for v in history[i] if not np.isnan(v)]
+        expected = _reference_signals(zs[i], recent, 2.0, 3.0)
+        assert [(s.rule, s.evidence) for s in signals] == expected
+        seen.update(rule for rule, _ in expected)
+    assert seen == {"1-3s", "2-2s", "R-4s", "4-1s", "10x"}
+
+    only_13s = config.model_copy(update={"rule_set": {"rules": ["1-3s"]}})
+    assert compile_rules(only_13s).lookback == 0
+    assert compile_rules(only_13s) is compile_rules(only_13s.model_copy())
+
+
+def _stream(stream_id, rules):
+    return {
+        "stream_id": stream_id,
+        "analyte": "HbA1c",
+        "method": "HPLC",
+        "instrument": "Architect",
+        "qc_level": "Level 1",
+        "control_material_lot": "LOT-001",
+        "units": "%",
+        "target_value": 5.2,
+        "sigma": 0.25,
+        "rule_set": {"rules": rules},
+        "effective_from": (START - timedelta(days=1)).isoformat(),
+    }
+
+
+def test_custom_rules_run_in_sequential_and_batch_ingestion():
+    two_of_three = {"name": "2of3-2s", "type": "count", "k": 2, "n": 3, "limit": "warn", "severity": "action"}
+    span = {"name": "R-4s-span", "type": "range", "n": 2, "span": 3.5, "evidence": "Range {n} points"}
+    for stream_id in ("dsl-seq", "dsl-batch"):
+        assert client.post("/streams", json=_stream(stream_id, [two_of_three, span]), headers=AUTH_HEADERS).status_code == 200
+        prior = {"stream_id": stream_id, "mu0": 5.2, "kappa0": 1.0, "alpha0": 2.0, "beta0": 0.0625}
+        assert client.post(f"/streams/{stream_id}/priors", json=prior, headers=AUTH_HEADERS).status_code == 200
+
+    # z: 0, +2.4, +0.4, +2.2 (2 of 3 high), -1.4 (range 3.6), 0
+    values = [5.2, 5.8, 5.3, 5.75, 4.85, 5.2]
+    sequential = []
+    for index, value in enumerate(values):
+        response = client.post("/qc/records", json=qc_payload("dsl-seq", index, value), headers=AUTH_HEADERS)
+        sequential.append([(s["rule"], s["evidence"]) for s in response.json()["qc"]["signals"]])
+    response = client.post(
+        "/qc/records/batch", json=[qc_payload("dsl-batch", i, v) for i, v in enumerate(values)], headers=AUTH_HEADERS
+    )
+    batch = [[(s["rule"], s["evidence"]) for s in item["result"]["qc"]["signals"]] for item in response.json()["results"]]
+
+    assert sequential == batch
+    assert sequential == [
+        [],
+        [],
+        [],
+        [("2of3-2s", "2 of last 3 results beyond 2 SD (high)")],
+        [("R-4s-span", "Range 2 points")],
+        [],
+    ]
+    assert response.json()["results"][3]["result"]["qc"]["disposition"] == "reject"
+
+
+def test_invalid_rule_definitions_are_rejected():
+    for rule in (
+        {"name": "bad", "type": "count", "k": 4, "n": 3, "limit": 1},
+        {"name": "bad", "type": "median", "n": 3},
+        {"name": "bad", "type": "count", "n": 3, "limit": "warning"},
+        {"name": "1-3s", "type": "count", "n": 1, "limit": 3},
+        {"name": "bad", "type": "count", "n": 2, "limit": 1, "evidence": "{missing}"},
+    ):
+        response = client.post("/streams", json=_stream("dsl-bad", [rule]), headers=AUTH_HEADERS)
+        assert response.status_code == 422, rule